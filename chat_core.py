@@ -0,0 +1,5167 @@
+"""Blockchain Chat core: blocks, chain storage, crypto, mesh relay, sync and the BLE node
+
+Nothing here imports Kivy, so the node also runs headless (see chat_daemon.py); main.py
+builds the UI on top. Bleak is imported only when the BLE transport is first used.
+"""
+import abc
+import argparse
+import asyncio
+import json
+import functools
+import hashlib
+import heapq
+import itertools
+import logging
+import threading
+import queue
+import time
+import os
+import sys
+import base64
+import random
+import copy
+import mmap
+import struct
+import uuid
+import multiprocessing
+import math
+import shutil
+import tempfile
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ed25519, x25519
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.backends import default_backend
+
+logger = logging.getLogger("blockchain_chat")
+
+# Define UUIDs for our custom service and characteristics
+SERVICE_UUID = "0000FFE0-0000-1000-8000-00805F9B34FB"
+TX_CHAR_UUID = "0000FFE1-0000-1000-8000-00805F9B34FB"  # For receiving data
+RX_CHAR_UUID = "0000FFE2-0000-1000-8000-00805F9B34FB"  # For sending data
+
+# Binary wire codec: magic byte, version, field-presence flags, varint index/nonce,
+# raw 32-byte hashes and raw ciphertext. Optional fields are omitted when they hold defaults.
+WIRE_MAGIC = b'\xbc'  # Never the first byte of a JSON document
+WIRE_VERSION = 1
+BINARY_CODEC = "binary-1"
+JSON_CODEC = "json"
+WIRE_FLOAT = struct.Struct('>d')
+
+WIRE_HASH_TEXT = 1 << 0
+WIRE_PREVIOUS_HASH_TEXT = 1 << 1
+WIRE_PAYLOAD_HASH_TEXT = 1 << 2
+WIRE_DATA_BASE64 = 1 << 3
+WIRE_SENDER = 1 << 4
+WIRE_RECIPIENT = 1 << 5
+WIRE_MESSAGE_TYPE = 1 << 6
+WIRE_FILE_DATA = 1 << 7
+WIRE_FILE_DATA_BASE64 = 1 << 8
+WIRE_FILE_NAME = 1 << 9
+WIRE_ENCRYPTION_KEY = 1 << 10
+WIRE_ENCRYPTION_KEY_BASE64 = 1 << 11
+WIRE_EXPIRATION = 1 << 12
+WIRE_STATUS = 1 << 13
+WIRE_SIGNATURE = 1 << 14
+WIRE_SIGNATURE_ED25519 = 1 << 15
+
+
+def _write_varint(buf: bytearray, value: int):
+    while value > 0x7F:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("Truncated varint")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _write_field(buf: bytearray, value: bytes):
+    _write_varint(buf, len(value))
+    buf += value
+
+
+def _read_field(data: bytes, pos: int) -> Tuple[bytes, int]:
+    length, pos = _read_varint(data, pos)
+    if pos + length > len(data):
+        raise ValueError("Truncated field")
+    return data[pos:pos + length], pos + length
+
+
+def _pack_hash(value: str) -> Tuple[bytes, bool]:
+    """Raw digest bytes, or UTF-8 text (second item True) for non-hex placeholders like genesis "0" """
+    if value and len(value) == 64:
+        try:
+            return bytes.fromhex(value), False
+        except ValueError:
+            pass
+    return (value or "").encode('utf-8'), True
+
+
+def _pack_base64(value: str) -> Tuple[bytes, bool]:
+    """Raw bytes for canonical base64 text (second item True), else UTF-8 so the text round-trips exactly"""
+    try:
+        raw = base64.b64decode(value, validate=True)
+        if base64.b64encode(raw).decode('ascii') == value:
+            return raw, True
+    except ValueError:
+        pass
+    return value.encode('utf-8'), False
+
+
+# GATT framing: messages larger than one ATT write are split into frames of
+# magic, message id, sequence number and frame count, followed by a chunk of the message.
+FRAME_MAGIC = b'\xf7'
+FRAME_HEADER = struct.Struct('>cIHH')
+ATT_OVERHEAD = 3  # Opcode and handle bytes in every ATT write
+DEFAULT_MTU = 23
+
+# Mesh relay envelope: magic, remaining hops and the block hash, so duplicates
+# can be dropped before the block itself is parsed
+RELAY_MAGIC = b'\xa5'
+RELAY_VERSION = 1
+RELAY_HEADER = struct.Struct('>cB32s')
+
+# Chunked file transfer: a manifest block carries "manifest1:<json>" in file_data and the
+# file follows as chunk frames of magic, file id and chunk index, then the raw chunk
+MANIFEST_PREFIX = "manifest1:"
+CHUNK_MAGIC = b'\xc3'
+CHUNK_HEADER = struct.Struct('>c32sI')
+DEFAULT_CHUNK_SIZE = 16 * 1024
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+
+
+def fragment_message(data: bytes, mtu: int, message_id: int) -> List[bytes]:
+    """Split data into frames that each fit one write at the given MTU
+    Data that already fits is returned unframed, which older peers understand.
+    """
+    payload_size = max((mtu or DEFAULT_MTU) - ATT_OVERHEAD, FRAME_HEADER.size + 1)
+    if len(data) <= payload_size and data[:1] != FRAME_MAGIC:
+        return [data]
+
+    chunk_size = payload_size - FRAME_HEADER.size
+    total = (len(data) + chunk_size - 1) // chunk_size
+    if total > 0xFFFF:
+        raise ValueError(f"Message of {len(data)} bytes needs too many frames at MTU {mtu}")
+    return [
+        FRAME_HEADER.pack(FRAME_MAGIC, message_id, seq, total) + data[seq * chunk_size:(seq + 1) * chunk_size]
+        for seq in range(total)
+    ]
+
+
+class PartialMessage:
+    def __init__(self, total: int):
+        self.total = total
+        self.chunks: Dict[int, bytes] = {}
+        self.size = 0
+        self.started = time.time()
+
+
+class FrameReassembler:
+    """Reassemble framed messages per peer, accepting frames in any order
+
+    Partial messages are dropped after timeout seconds, when they grow past
+    max_message_bytes, or (oldest first) beyond max_partial_messages per peer.
+    """
+
+    def __init__(self, max_partial_messages: int = 16, max_message_bytes: int = 4 * 1024 * 1024,
+                 timeout: float = 30.0):
+        self.max_partial_messages = max_partial_messages
+        self.max_message_bytes = max_message_bytes
+        self.timeout = timeout
+        self.dropped_count = 0
+        self._partials: Dict[str, OrderedDict] = {}  # peer: {message_id: PartialMessage}
+        self._lock = threading.Lock()
+
+    def feed(self, peer: str, data: bytes) -> Optional[bytes]:
+        """Add one notification; returns the complete message once all of its frames are in"""
+        if data[:1] != FRAME_MAGIC:
+            return data
+        if len(data) < FRAME_HEADER.size:
+            self.dropped_count += 1
+            return None
+
+        _, message_id, seq, total = FRAME_HEADER.unpack_from(data)
+        chunk = data[FRAME_HEADER.size:]
+        if total == 0 or seq >= total:
+            self.dropped_count += 1
+            return None
+
+        with self._lock:
+            partials = self._partials.setdefault(peer, OrderedDict())
+            self._expire(partials)
+
+            partial = partials.get(message_id)
+            if partial is None or partial.total != total:
+                # Every frame but the last is full, so this rejects oversized messages up front
+                if (total - 1) * len(chunk) > self.max_message_bytes:
+                    self.dropped_count += 1
+                    return None
+                partial = partials[message_id] = PartialMessage(total)
+                while len(partials) > self.max_partial_messages:
+                    partials.popitem(last=False)
+                    self.dropped_count += 1
+
+            if seq not in partial.chunks:
+                partial.chunks[seq] = chunk
+                partial.size += len(chunk)
+            if partial.size > self.max_message_bytes:
+                del partials[message_id]
+                self.dropped_count += 1
+                return None
+
+            if len(partial.chunks) < total:
+                return None
+            del partials[message_id]
+            return b''.join(partial.chunks[i] for i in range(total))
+
+    def _expire(self, partials: OrderedDict):
+        deadline = time.time() - self.timeout
+        for message_id in [mid for mid, partial in partials.items() if partial.started < deadline]:
+            del partials[message_id]
+            self.dropped_count += 1
+
+    def forget(self, peer: str):
+        """Drop partial messages from a disconnected peer"""
+        with self._lock:
+            self._partials.pop(peer, None)
+
+
+# Fixed-layout block header: version, index, timestamp, previous hash, payload digest, nonce.
+# Mining only re-hashes this header, so its cost does not depend on the message size.
+HEADER_VERSION = 1
+HEADER_PREFIX_STRUCT = struct.Struct('>BQd32s32s')
+NONCE_STRUCT = struct.Struct('>Q')
+
+
+def _digest_bytes(value: str) -> bytes:
+    """Convert a hex digest to raw bytes for the header (genesis/placeholder hashes are hashed)"""
+    if value and len(value) == 64:
+        try:
+            return bytes.fromhex(value)
+        except ValueError:
+            pass
+    return hashlib.sha256((value or "").encode('utf-8')).digest()
+
+
+def header_prefix(index: int, timestamp: float, previous_hash: str, payload_hash: str) -> bytes:
+    """Header bytes up to (not including) the nonce"""
+    return HEADER_PREFIX_STRUCT.pack(
+        HEADER_VERSION,
+        index,
+        timestamp,
+        _digest_bytes(previous_hash),
+        _digest_bytes(payload_hash)
+    )
+
+
+def header_hash(index: int, timestamp: float, previous_hash: str, payload_hash: str, nonce: int) -> str:
+    """Block hash from header fields alone, so headers can be checked before bodies arrive"""
+    return hashlib.sha256(header_prefix(index, timestamp, previous_hash, payload_hash)
+                          + NONCE_STRUCT.pack(nonce)).hexdigest()
+
+
+class Block:
+    def __init__(self, index: int, previous_hash: str, timestamp: float, data: str, nonce: int = 0,
+                 sender_id: str = None, recipient_id: str = None, message_type: str = "text",
+                 file_data: str = None, file_name: str = None, encryption_key: str = None,
+                 expiration_time: float = None):
+        self.index = index
+        self.previous_hash = previous_hash
+        self.timestamp = timestamp
+        self.data = data
+        self.nonce = nonce
+        self.sender_id = sender_id
+        self.recipient_id = recipient_id
+        self.message_type = message_type  # text, file, image, etc.
+        self.file_data = file_data  # Base64 encoded file data
+        self.file_name = file_name
+        self.encryption_key = encryption_key
+        self.expiration_time = expiration_time  # For disappearing messages
+        self.status = "sent"  # sent, delivered, read
+        self.signature = None  # Sender's signature over payload_hash
+        self.payload_hash = self.calculate_payload_hash()
+        self.hash = self.calculate_hash()
+
+    def calculate_payload_hash(self) -> str:
+        """Digest of the message body; computed once per payload, not per nonce"""
+        payload_string = json.dumps({
+            "data": self.data,
+            "sender_id": self.sender_id,
+            "recipient_id": self.recipient_id,
+            "message_type": self.message_type,
+            "file_data": self.file_data,
+            "file_name": self.file_name,
+            "encryption_key": self.encryption_key,
+            "expiration_time": self.expiration_time
+        }, sort_keys=True).encode()
+        return hashlib.sha256(payload_string).hexdigest()
+
+    def update_payload_hash(self):
+        """Recompute the payload digest and hash after the body has been modified"""
+        self.payload_hash = self.calculate_payload_hash()
+        self.hash = self.calculate_hash()
+
+    def is_pruned(self) -> bool:
+        """Whether this is an expired block whose body was dropped by prune_payload"""
+        return (bool(self.expiration_time) and self.expiration_time <= time.time()
+                and not self.data and self.file_data is None and self.payload_hash != self.calculate_payload_hash())
+
+    def prune_payload(self):
+        """Drop the body of an expired message; the header and payload_hash stay, so the chain still links"""
+        self.data = ""
+        self.file_data = None
+        self.file_name = None
+        self.encryption_key = None
+
+    def header_prefix(self) -> bytes:
+        """Header bytes up to (not including) the nonce"""
+        return header_prefix(self.index, self.timestamp, self.previous_hash, self.payload_hash)
+
+    def calculate_hash(self) -> str:
+        return header_hash(self.index, self.timestamp, self.previous_hash, self.payload_hash, self.nonce)
+
+    def header(self) -> list:
+        """Compact header sent during sync: [index, timestamp, previous_hash, payload_hash, nonce]"""
+        return [self.index, self.timestamp, self.previous_hash, self.payload_hash, self.nonce]
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "index": self.index,
+            "previous_hash": self.previous_hash,
+            "timestamp": self.timestamp,
+            "data": self.data,
+            "nonce": self.nonce,
+            "hash": self.hash,
+            "payload_hash": self.payload_hash,
+            "sender_id": self.sender_id,
+            "recipient_id": self.recipient_id,
+            "message_type": self.message_type,
+            "file_data": self.file_data,
+            "file_name": self.file_name,
+            "encryption_key": self.encryption_key,
+            "expiration_time": self.expiration_time,
+            "status": self.status,
+            "signature": self.signature
+        })
+
+    @staticmethod
+    def from_json(json_str: str) -> 'Block':
+        return Block.from_dict(json.loads(json_str))
+
+    @staticmethod
+    def from_dict(data: dict) -> 'Block':
+        block = Block(
+            data['index'],
+            data['previous_hash'],
+            data['timestamp'],
+            data['data'],
+            data['nonce'],
+            data.get('sender_id'),
+            data.get('recipient_id'),
+            data.get('message_type', 'text'),
+            data.get('file_data'),
+            data.get('file_name'),
+            data.get('encryption_key'),
+            data.get('expiration_time')
+        )
+        # Keep the received digest so validate_block can detect a tampered body
+        block.payload_hash = data.get('payload_hash', block.payload_hash)
+        block.hash = data['hash']
+        block.status = data.get('status', 'sent')
+        block.signature = data.get('signature')
+        return block
+
+    def to_bytes(self) -> bytes:
+        """Compact binary encoding for the wire; see WIRE_* flags"""
+        flags = 0
+        body = bytearray()
+
+        hash_fields = []
+        for value, text_flag in ((self.hash, WIRE_HASH_TEXT),
+                                 (self.previous_hash, WIRE_PREVIOUS_HASH_TEXT),
+                                 (self.payload_hash, WIRE_PAYLOAD_HASH_TEXT)):
+            raw, is_text = _pack_hash(value)
+            if is_text:
+                flags |= text_flag
+            hash_fields.append(raw)
+        for raw in hash_fields:
+            _write_field(body, raw)
+
+        data = self.data or ""
+        if self.encryption_key:
+            data, is_base64 = _pack_base64(data)
+            if is_base64:
+                flags |= WIRE_DATA_BASE64
+        else:
+            data = data.encode('utf-8')
+        _write_field(body, data)
+
+        if self.sender_id is not None:
+            flags |= WIRE_SENDER
+            _write_field(body, self.sender_id.encode('utf-8'))
+        if self.recipient_id is not None:
+            flags |= WIRE_RECIPIENT
+            _write_field(body, self.recipient_id.encode('utf-8'))
+        if self.message_type != "text":
+            flags |= WIRE_MESSAGE_TYPE
+            _write_field(body, self.message_type.encode('utf-8'))
+        if self.file_data is not None:
+            flags |= WIRE_FILE_DATA
+            file_data, is_base64 = _pack_base64(self.file_data)
+            if is_base64:
+                flags |= WIRE_FILE_DATA_BASE64
+            _write_field(body, file_data)
+        if self.file_name is not None:
+            flags |= WIRE_FILE_NAME
+            _write_field(body, self.file_name.encode('utf-8'))
+        if self.encryption_key is not None:
+            flags |= WIRE_ENCRYPTION_KEY
+            encryption_key, is_base64 = _pack_base64(self.encryption_key)
+            if is_base64:
+                flags |= WIRE_ENCRYPTION_KEY_BASE64
+            _write_field(body, encryption_key)
+        if self.expiration_time is not None:
+            flags |= WIRE_EXPIRATION
+            body += WIRE_FLOAT.pack(self.expiration_time)
+        if self.status != "sent":
+            flags |= WIRE_STATUS
+            _write_field(body, self.status.encode('utf-8'))
+        if self.signature is not None:
+            flags |= WIRE_SIGNATURE
+            if self.signature.startswith("ed25519:"):
+                signature, is_base64 = _pack_base64(self.signature[8:])
+                if is_base64:
+                    flags |= WIRE_SIGNATURE_ED25519
+                else:
+                    signature = self.signature.encode('utf-8')
+            else:
+                signature = self.signature.encode('utf-8')
+            _write_field(body, signature)
+
+        header = bytearray(WIRE_MAGIC)
+        header.append(WIRE_VERSION)
+        _write_varint(header, flags)
+        _write_varint(header, self.index)
+        _write_varint(header, self.nonce)
+        header += WIRE_FLOAT.pack(self.timestamp)
+        return bytes(header + body)
+
+    @staticmethod
+    def from_bytes(data: bytes) -> 'Block':
+        if data[:1] != WIRE_MAGIC or len(data) < 2:
+            raise ValueError("Not a binary block")
+        if data[1] != WIRE_VERSION:
+            raise ValueError(f"Unsupported wire version {data[1]}")
+
+        flags, pos = _read_varint(data, 2)
+        index, pos = _read_varint(data, pos)
+        nonce, pos = _read_varint(data, pos)
+        if pos + WIRE_FLOAT.size > len(data):
+            raise ValueError("Truncated block")
+        timestamp, = WIRE_FLOAT.unpack_from(data, pos)
+        pos += WIRE_FLOAT.size
+
+        hashes = []
+        for text_flag in (WIRE_HASH_TEXT, WIRE_PREVIOUS_HASH_TEXT, WIRE_PAYLOAD_HASH_TEXT):
+            raw, pos = _read_field(data, pos)
+            hashes.append(raw.decode('utf-8') if flags & text_flag else raw.hex())
+        block_hash, previous_hash, payload_hash = hashes
+
+        def read_text(raw_flag=0):
+            nonlocal pos
+            raw, pos = _read_field(data, pos)
+            if flags & raw_flag:
+                return base64.b64encode(raw).decode('ascii')
+            return raw.decode('utf-8')
+
+        message = read_text(WIRE_DATA_BASE64)
+        sender_id = read_text() if flags & WIRE_SENDER else None
+        recipient_id = read_text() if flags & WIRE_RECIPIENT else None
+        message_type = read_text() if flags & WIRE_MESSAGE_TYPE else "text"
+        file_data = read_text(WIRE_FILE_DATA_BASE64) if flags & WIRE_FILE_DATA else None
+        file_name = read_text() if flags & WIRE_FILE_NAME else None
+        encryption_key = read_text(WIRE_ENCRYPTION_KEY_BASE64) if flags & WIRE_ENCRYPTION_KEY else None
+        expiration_time = None
+        if flags & WIRE_EXPIRATION:
+            if pos + WIRE_FLOAT.size > len(data):
+                raise ValueError("Truncated block")
+            expiration_time, = WIRE_FLOAT.unpack_from(data, pos)
+            pos += WIRE_FLOAT.size
+        status = read_text() if flags & WIRE_STATUS else "sent"
+        signature = None
+        if flags & WIRE_SIGNATURE:
+            signature = read_text(WIRE_SIGNATURE_ED25519)
+            if flags & WIRE_SIGNATURE_ED25519:
+                signature = "ed25519:" + signature
+
+        block = Block(index, previous_hash, timestamp, message, nonce, sender_id, recipient_id, message_type,
+                      file_data, file_name, encryption_key, expiration_time)
+        block.payload_hash = payload_hash
+        block.hash = block_hash
+        block.status = status
+        block.signature = signature
+        return block
+
+
+def compare_wire_codecs(block: Block, rounds: int = 1000) -> Dict[str, float]:
+    """Encoded size and encode/decode time (microseconds per block) of the JSON and binary codecs"""
+    results = {}
+    for name, encode, decode in ((JSON_CODEC, lambda b: b.to_json().encode('utf-8'),
+                                  lambda d: Block.from_json(d.decode('utf-8'))),
+                                 (BINARY_CODEC, Block.to_bytes, Block.from_bytes)):
+        encoded = encode(block)
+        started = time.perf_counter()
+        for _ in range(rounds):
+            encode(block)
+        encode_time = time.perf_counter() - started
+        started = time.perf_counter()
+        for _ in range(rounds):
+            decode(encoded)
+        decode_time = time.perf_counter() - started
+        results[f"{name}_bytes"] = len(encoded)
+        results[f"{name}_encode_us"] = encode_time / rounds * 1e6
+        results[f"{name}_decode_us"] = decode_time / rounds * 1e6
+    results["size_ratio"] = results[f"{BINARY_CODEC}_bytes"] / results[f"{JSON_CODEC}_bytes"]
+    return results
+
+
+class MiningCancelled(Exception):
+    """Raised when a mining job is cancelled before a valid nonce is found"""
+
+
+class MiningResult:
+    def __init__(self, block: Block, found: bool, hashes: int, elapsed: float):
+        self.block = block
+        self.found = found
+        self.hashes = hashes
+        self.elapsed = elapsed
+        self.hashes_per_second = hashes / elapsed if elapsed > 0 else 0.0
+
+
+def _process_context():
+    """Start pool workers from a fresh interpreter
+
+    Forking a process that already runs threads (the UI, the asyncio loop, the send
+    pipeline) can copy a lock mid-use and deadlock the child, so fork is never used. The
+    fork server imports chat_core once and forks workers from that clean process.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['chat_core'])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+# Per-process state for proof-of-work pool workers, set by _init_pow_worker
+_pow_stop_event = None
+_pow_hash_counter = None
+
+
+def _init_pow_worker(stop_event, hash_counter):
+    global _pow_stop_event, _pow_hash_counter
+    _pow_stop_event = stop_event
+    _pow_hash_counter = hash_counter
+
+
+def _pow_search(block: Block, difficulty: int, start_nonce: int, worker_index: int,
+                worker_count: int, batch_size: int) -> Tuple[Optional[int], Optional[str], int]:
+    """Try strided nonce batches until a match is found or the stop event is set
+    Returns: (nonce, hash, hashes_tried)
+    """
+    target = '0' * difficulty
+    header = hashlib.sha256(block.header_prefix())
+    pack_nonce = NONCE_STRUCT.pack
+    batch_start = start_nonce + worker_index * batch_size
+    stride = worker_count * batch_size
+    hashes = 0
+
+    while not _pow_stop_event.is_set():
+        for nonce in range(batch_start, batch_start + batch_size):
+            attempt = header.copy()
+            attempt.update(pack_nonce(nonce))
+            block_hash = attempt.hexdigest()
+            if block_hash.startswith(target):
+                # Tell the other workers to stop as soon as they finish their batch
+                _pow_stop_event.set()
+                tried = nonce - batch_start + 1
+                with _pow_hash_counter.get_lock():
+                    _pow_hash_counter.value += tried
+                return nonce, block_hash, hashes + tried
+
+        hashes += batch_size
+        with _pow_hash_counter.get_lock():
+            _pow_hash_counter.value += batch_size
+        batch_start += stride
+
+    return None, None, hashes
+
+
+class ProofOfWorkMiner:
+    """Mine blocks on a process pool, one strided slice of the nonce space per worker"""
+
+    def __init__(self, workers: int = None, batch_size: int = 2000, min_difficulty: int = 3,
+                 progress_interval: float = 0.5):
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.min_difficulty = min_difficulty  # Below this the pool overhead outweighs the speedup
+        self.progress_interval = progress_interval
+        self.progress_callback = None  # callback(hashes, hashes_per_second)
+        self.last_result: Optional[MiningResult] = None
+
+        self._context = _process_context()
+        self._executor = None
+        # Created up front and cleared after each job, so a cancel() that lands before mine() isn't lost
+        self._stop_event = self._context.Event()
+        self._hash_counter = self._context.Value('Q', 0)
+        self._lock = threading.Lock()  # One mining job at a time
+
+    def _ensure_pool(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=self._context,
+                initializer=_init_pow_worker,
+                initargs=(self._stop_event, self._hash_counter)
+            )
+
+    def mine(self, block: Block, difficulty: int) -> MiningResult:
+        """Find a nonce for the block that satisfies the difficulty
+        Raises MiningCancelled if cancel() is called before a nonce is found, including
+        before this call
+        """
+        with self._lock:
+            try:
+                return self._mine(block, difficulty)
+            finally:
+                self._stop_event.clear()
+
+    def _mine(self, block: Block, difficulty: int) -> MiningResult:
+        self._ensure_pool()
+        with self._hash_counter.get_lock():
+            self._hash_counter.value = 0
+
+        started = time.time()
+        pending = {
+            self._executor.submit(_pow_search, block, difficulty, block.nonce, i,
+                                  self.workers, self.batch_size)
+            for i in range(self.workers)
+        }
+        results = []
+        while pending:
+            done, pending = wait(pending, timeout=self.progress_interval)
+            results.extend(future.result() for future in done)
+            if pending and self.progress_callback:
+                elapsed = time.time() - started
+                hashes = self._hash_counter.value
+                self.progress_callback(hashes, hashes / elapsed if elapsed > 0 else 0.0)
+
+        elapsed = time.time() - started
+        hashes = sum(tried for _, _, tried in results)
+        found = [(nonce, block_hash) for nonce, block_hash, _ in results if nonce is not None]
+        if found:
+            block.nonce, block.hash = min(found)
+
+        self.last_result = MiningResult(block, bool(found), hashes, elapsed)
+        if not found:
+            raise MiningCancelled(f"Mining cancelled after {hashes} hashes")
+        return self.last_result
+
+    def cancel(self):
+        """Stop the mining job in progress, or the next one if none is running yet"""
+        self._stop_event.set()
+
+    def shutdown(self):
+        """Stop any running job and terminate the worker processes"""
+        self.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        with self._lock:
+            self._stop_event.clear()  # A later mine() restarts the pool rather than stopping at once
+
+
+class ChainStore:
+    """Append-only on-disk block log
+
+    Blocks are written as JSON lines to numbered segment files. A fixed-width index
+    (segment, offset, length per height) is memory-mapped, so opening a long chain only
+    reads the tip; older blocks are read on demand. Supports the list operations
+    Blockchain uses on its chain: len(), indexing, iteration and append().
+
+    A second small index lists the blocks whose bodies have yet to expire (height,
+    expiration time, hash), so the expiry scheduler can start without reading the chain.
+    """
+    INDEX_ENTRY = struct.Struct('>IQI')
+    EXPIRY_ENTRY = struct.Struct('>Id32s')
+
+    def __init__(self, path: str, segment_size: int = 16 * 1024 * 1024, fsync: bool = True,
+                 read_only: bool = False):
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.read_only = read_only  # For worker processes reading alongside the writer
+        os.makedirs(path, exist_ok=True)
+        self._index_path = os.path.join(path, 'chain.idx')
+        self._expiry_path = os.path.join(path, 'expiry.idx')
+        self._watermark_path = os.path.join(path, 'verified.json')
+        self._lock = threading.RLock()
+        self._readers = {}  # segment number: file opened for reading
+
+        if read_only:
+            self._count = os.path.getsize(self._index_path) // self.INDEX_ENTRY.size
+            self._index_file = self._segment_file = self._expiry_file = None
+            self._expiry = self._load_expiry() or {}
+        else:
+            self._count, self._segment_number, self._segment_offset = self._recover()
+            self._index_file = open(self._index_path, 'ab')
+            self._segment_file = open(self._segment_path(self._segment_number), 'ab')
+            # height: (expiration time, hash); None until built for a store older than the expiry index
+            self._expiry = self._load_expiry()
+            if self._expiry is None and self._count <= 1:
+                self._expiry = {}
+            self._expiry_file = None
+            if self._expiry is not None:
+                self._save_expiry()  # Drops entries for blocks a crash or a truncate took away
+        self._index_reader = open(self._index_path, 'rb')
+        self._index_map = None
+        self._mapped_count = 0
+        self._tip = self._read(self._count - 1) if self._count else None
+
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.path, f'segment-{number:06d}.log')
+
+    def _recover(self) -> Tuple[int, int, int]:
+        """Drop torn writes left by a crash
+        Returns: (block_count, active_segment, active_segment_size)
+        """
+        entry_size = self.INDEX_ENTRY.size
+        with open(self._index_path, 'a+b') as index_file:
+            index_file.seek(0, os.SEEK_END)
+            count = index_file.tell() // entry_size
+            last_entry = None
+            while count:
+                index_file.seek((count - 1) * entry_size)
+                segment, offset, length = self.INDEX_ENTRY.unpack(index_file.read(entry_size))
+                segment_path = self._segment_path(segment)
+                if os.path.exists(segment_path) and offset + length <= os.path.getsize(segment_path):
+                    last_entry = (segment, offset + length)
+                    break
+                count -= 1
+            index_file.truncate(count * entry_size)
+
+        segment, end = last_entry or (0, 0)
+        with open(self._segment_path(segment), 'a+b') as segment_file:
+            segment_file.truncate(end)
+        for name in os.listdir(self.path):
+            if name.startswith('segment-') and name.endswith('.log') and int(name[8:14]) > segment:
+                os.remove(os.path.join(self.path, name))
+        return count, segment, end
+
+    def _load_expiry(self) -> Optional[Dict[int, Tuple[float, str]]]:
+        try:
+            with open(self._expiry_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        entries = {}
+        size = self.EXPIRY_ENTRY.size
+        for position in range(0, len(data) - len(data) % size, size):
+            height, expiration_time, block_hash = self.EXPIRY_ENTRY.unpack_from(data, position)
+            # Entries are written before their block, so a crash can leave one past the end
+            if height < self._count:
+                entries[height] = (expiration_time, block_hash.hex())
+        return entries
+
+    def _save_expiry(self):
+        if self._expiry_file is not None:
+            self._expiry_file.close()
+        temp_path = self._expiry_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            for height, (expiration_time, block_hash) in sorted(self._expiry.items()):
+                f.write(self.EXPIRY_ENTRY.pack(height, expiration_time, bytes.fromhex(block_hash)))
+            self._flush(f)
+        os.replace(temp_path, self._expiry_path)
+        self._expiry_file = open(self._expiry_path, 'ab')
+
+    def expiring(self) -> List[Tuple[float, str, int]]:
+        """(expiration time, hash, height) of stored blocks whose bodies have yet to expire"""
+        with self._lock:
+            if self._expiry is None:
+                # Written before the expiry index existed: read the chain this once to build it
+                self._expiry = {height: (block.expiration_time, block.hash) for height, block in enumerate(self)
+                                if block.expiration_time and not block.is_pruned()}
+                self._save_expiry()
+            return [(expiration_time, block_hash, height)
+                    for height, (expiration_time, block_hash) in self._expiry.items()]
+
+    def _remap(self):
+        if self._index_map is not None:
+            self._index_map.close()
+            self._index_map = None
+        size = os.path.getsize(self._index_path)
+        self._mapped_count = size // self.INDEX_ENTRY.size
+        if size:
+            self._index_map = mmap.mmap(self._index_reader.fileno(), size, access=mmap.ACCESS_READ)
+
+    def _read(self, height: int) -> Block:
+        with self._lock:
+            if height >= self._mapped_count:
+                self._remap()
+            segment, offset, length = self.INDEX_ENTRY.unpack_from(self._index_map, height * self.INDEX_ENTRY.size)
+            reader = self._readers.get(segment)
+            if reader is None:
+                reader = self._readers[segment] = open(self._segment_path(segment), 'rb')
+            reader.seek(offset)
+            return Block.from_json(reader.read(length).decode('utf-8'))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, height: int) -> Block:
+        if height < 0:
+            height += self._count
+        if not 0 <= height < self._count:
+            raise IndexError("block height out of range")
+        if height == self._count - 1:
+            return self._tip
+        return self._read(height)
+
+    def __iter__(self):
+        for height in range(self._count):
+            yield self[height]
+
+    def append(self, block: Block):
+        if self.read_only:
+            raise ValueError("Chain store is open read-only")
+        record = (block.to_json() + '\n').encode('utf-8')
+        with self._lock:
+            if self._segment_offset and self._segment_offset + len(record) > self.segment_size:
+                self._segment_file.close()
+                self._segment_number += 1
+                self._segment_offset = 0
+                self._segment_file = open(self._segment_path(self._segment_number), 'ab')
+
+            # Expiry entry first, so a crash never leaves a disappearing message that won't expire;
+            # an entry without its block is dropped on the next open
+            if block.expiration_time and self._expiry is not None:
+                self._expiry_file.write(self.EXPIRY_ENTRY.pack(self._count, block.expiration_time,
+                                                               bytes.fromhex(block.hash)))
+                self._flush(self._expiry_file)
+                self._expiry[self._count] = (block.expiration_time, block.hash)
+
+            # Block first, then its index entry: a crash in between leaves an unindexed tail
+            # that _recover truncates on the next open
+            self._segment_file.write(record)
+            self._flush(self._segment_file)
+            self._index_file.write(self.INDEX_ENTRY.pack(self._segment_number, self._segment_offset, len(record)))
+            self._flush(self._index_file)
+
+            self._segment_offset += len(record)
+            self._count += 1
+            self._tip = block
+
+    def rewrite(self, blocks: Dict[int, Block]):
+        """Overwrite blocks in place with records no longer than the originals, e.g. with expired bodies pruned"""
+        if self.read_only:
+            raise ValueError("Chain store is open read-only")
+        with self._lock:
+            touched = {}
+            for height, block in sorted(blocks.items()):
+                if not 0 <= height < self._count:
+                    raise IndexError("block height out of range")
+                if height >= self._mapped_count:
+                    self._remap()
+                segment, offset, length = self.INDEX_ENTRY.unpack_from(self._index_map, height * self.INDEX_ENTRY.size)
+                record = block.to_json().encode('utf-8')
+                if len(record) + 1 > length:
+                    raise ValueError(f"Block {height} grew and can't be rewritten in place")
+                # Pad with whitespace, which JSON ignores, so offsets in the index stay valid
+                record += b' ' * (length - 1 - len(record)) + b'\n'
+                file = touched.get(segment)
+                if file is None:
+                    file = touched[segment] = open(self._segment_path(segment), 'r+b')
+                file.seek(offset)
+                file.write(record)
+                if height == self._count - 1:
+                    self._tip = block
+            pruned = [height for height, block in blocks.items()
+                      if self._expiry and height in self._expiry and block.is_pruned()]
+            for height in pruned:
+                del self._expiry[height]
+            for segment, file in touched.items():
+                self._flush(file)
+                file.close()
+                # Cached readers may still hold the old bytes in their buffers
+                reader = self._readers.pop(segment, None)
+                if reader is not None:
+                    reader.close()
+            if pruned:
+                self._save_expiry()
+
+    def truncate(self, length: int):
+        """Drop blocks from height length onwards, e.g. when switching to a heavier fork"""
+        if self.read_only:
+            raise ValueError("Chain store is open read-only")
+        if not 1 <= length <= self._count:
+            raise ValueError(f"Cannot truncate a chain of {self._count} blocks to {length}")
+        with self._lock:
+            if length == self._count:
+                return
+            if length >= self._mapped_count:
+                self._remap()
+            segment, offset, _ = self.INDEX_ENTRY.unpack_from(self._index_map, length * self.INDEX_ENTRY.size)
+            self._index_map.close()
+            self._index_map = None
+            self._mapped_count = 0
+
+            # Index first, then blocks: a crash in between leaves an unindexed tail for _recover
+            self._index_file.truncate(length * self.INDEX_ENTRY.size)
+            self._flush(self._index_file)
+            self._segment_file.close()
+            for number in range(segment + 1, self._segment_number + 1):
+                reader = self._readers.pop(number, None)
+                if reader is not None:
+                    reader.close()
+                os.remove(self._segment_path(number))
+            self._segment_file = open(self._segment_path(segment), 'ab')
+            self._segment_file.truncate(offset)
+            self._flush(self._segment_file)
+
+            self._segment_number = segment
+            self._segment_offset = offset
+            self._count = length
+            self._tip = self._read(length - 1)
+            if self._expiry and max(self._expiry) >= length:
+                self._expiry = {height: entry for height, entry in self._expiry.items() if height < length}
+                self._save_expiry()
+
+    def _flush(self, file):
+        file.flush()
+        if self.fsync:
+            os.fsync(file.fileno())
+
+    def load_watermark(self) -> Optional[Tuple[int, str]]:
+        """Height and hash up to which the chain was last verified"""
+        try:
+            with open(self._watermark_path, 'r') as f:
+                watermark = json.load(f)
+            return watermark['height'], watermark['hash']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save_watermark(self, height: int, block_hash: str):
+        temp_path = self._watermark_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({"height": height, "hash": block_hash}, f)
+        os.replace(temp_path, self._watermark_path)
+
+    def close(self):
+        with self._lock:
+            if self._index_map is not None:
+                self._index_map.close()
+                self._index_map = None
+            for file in [self._segment_file, self._index_file, self._expiry_file, self._index_reader,
+                         *self._readers.values()]:
+                if file is not None:
+                    file.close()
+            self._readers.clear()
+
+
+def _first_invalid_block(blocks, start: int, difficulty: int) -> Optional[int]:
+    """Check bodies, hashes, proof of work and previous_hash links of consecutive blocks
+    blocks must begin with the block at height start - 1
+    Returns: index of the first invalid block, or None
+    """
+    target = '0' * difficulty
+    previous_block = None
+    for index, block in enumerate(blocks, start - 1):
+        if previous_block is not None:
+            # The header only commits to payload_hash, so the body has to be checked against it
+            # too; expired blocks whose body was pruned have nothing left to check
+            if block.payload_hash != block.calculate_payload_hash() and not block.is_pruned():
+                return index
+            if block.hash != block.calculate_hash() or not block.hash.startswith(target):
+                return index
+            if block.previous_hash != previous_block.hash:
+                return index
+        previous_block = block
+    return None
+
+
+def _validate_segment(source, start: int, end: int, difficulty: int) -> Optional[int]:
+    """Pool worker: validate heights [start, end) from a store path or a list of blocks"""
+    if isinstance(source, str):
+        store = ChainStore(source, read_only=True)
+        try:
+            return _first_invalid_block((store[height] for height in range(start - 1, end)), start, difficulty)
+        finally:
+            store.close()
+    return _first_invalid_block(source, start, difficulty)
+
+
+class PendingEntry:
+    def __init__(self, block_hash: str, recipient_id: str, enqueued_at: float, size: int, block: Block = None):
+        self.block_hash = block_hash
+        self.recipient_id = recipient_id
+        self.enqueued_at = enqueued_at
+        self.size = size
+        self.block = block  # None while spilled to disk
+
+
+class PendingQueue:
+    """Store-and-forward queue indexed by recipient
+
+    Enqueue, dequeue and removal are O(1) per block. Entries expire after ttl seconds and
+    the oldest are evicted beyond max_blocks/max_bytes. With a path, every entry is also
+    written to disk so queued mail survives a restart, and entries beyond memory_limit
+    bytes are dropped from memory and read back from disk when delivered.
+    """
+
+    def __init__(self, path: str = None, ttl: float = 7 * 24 * 3600, max_blocks: int = 10000,
+                 max_bytes: int = 64 * 1024 * 1024, memory_limit: int = 4 * 1024 * 1024, fsync: bool = True):
+        self.path = path
+        self.ttl = ttl
+        self.max_blocks = max_blocks
+        self.max_bytes = max_bytes
+        self.memory_limit = memory_limit
+        self.fsync = fsync
+        self.total_bytes = 0
+        self.memory_bytes = 0
+        self.expired_count = 0
+        self.evicted_count = 0
+        self._by_recipient: Dict[str, OrderedDict] = {}  # recipient_id: {block_hash: entry}
+        self._order = OrderedDict()  # block_hash: entry, oldest first
+        self._resident = OrderedDict()  # block_hash: entry still held in memory, oldest first
+        self._last_enqueued = 0.0
+        self._lock = threading.RLock()
+
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self._load()
+
+    def _file_name(self, entry: PendingEntry) -> str:
+        # Metadata lives in the file name so a restart only lists the directory
+        recipient_hex = (entry.recipient_id or "").encode('utf-8').hex()
+        return f"{round(entry.enqueued_at * 1000000):017d}_{entry.block_hash}_{recipient_hex}.json"
+
+    def _load(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.tmp'):
+                # A write cut short by a crash; its entry was never queued
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+                continue
+            if not name.endswith('.json'):
+                continue
+            try:
+                enqueued_us, block_hash, recipient_hex = name[:-5].split('_')
+                recipient_id = bytes.fromhex(recipient_hex).decode('utf-8') or None
+                size = os.path.getsize(os.path.join(self.path, name))
+            except (ValueError, OSError):
+                continue
+            entries.append(PendingEntry(block_hash, recipient_id, int(enqueued_us) / 1000000, size))
+
+        for entry in sorted(entries, key=lambda e: e.enqueued_at):
+            self._index(entry)
+            self._last_enqueued = entry.enqueued_at
+        self.expire()
+
+    def _index(self, entry: PendingEntry):
+        self._order[entry.block_hash] = entry
+        self._by_recipient.setdefault(entry.recipient_id, OrderedDict())[entry.block_hash] = entry
+        self.total_bytes += entry.size
+        if entry.block is not None:
+            self._resident[entry.block_hash] = entry
+            self.memory_bytes += entry.size
+
+    def _unindex(self, entry: PendingEntry):
+        del self._order[entry.block_hash]
+        recipient_entries = self._by_recipient[entry.recipient_id]
+        del recipient_entries[entry.block_hash]
+        if not recipient_entries:
+            del self._by_recipient[entry.recipient_id]
+        self.total_bytes -= entry.size
+        if self._resident.pop(entry.block_hash, None) is not None:
+            self.memory_bytes -= entry.size
+        if self.path:
+            try:
+                os.remove(os.path.join(self.path, self._file_name(entry)))
+            except OSError:
+                pass
+
+    def _read_block(self, entry: PendingEntry) -> Block:
+        if entry.block is not None:
+            return entry.block
+        with open(os.path.join(self.path, self._file_name(entry)), 'r', encoding='utf-8') as f:
+            return Block.from_json(f.read())
+
+    def add(self, block: Block):
+        with self._lock:
+            if block.hash in self._order:
+                return
+            # Keep enqueue times strictly increasing so file names sort in queue order
+            self._last_enqueued = max(time.time(), self._last_enqueued + 0.000001)
+            block_json = block.to_json()
+            entry = PendingEntry(block.hash, block.recipient_id, self._last_enqueued, len(block_json), block)
+            if self.path:
+                file_path = os.path.join(self.path, self._file_name(entry))
+                with open(file_path + '.tmp', 'w', encoding='utf-8') as f:
+                    f.write(block_json)
+                    f.flush()
+                    if self.fsync:
+                        os.fsync(f.fileno())
+                os.replace(file_path + '.tmp', file_path)
+            self._index(entry)
+            self._enforce_limits()
+
+    def get(self, recipient_id: str) -> List[Block]:
+        """Queued blocks for a recipient, oldest first"""
+        with self._lock:
+            self.expire()
+            entries = self._by_recipient.get(recipient_id)
+            return [self._read_block(entry) for entry in entries.values()] if entries else []
+
+    def pop(self, recipient_id: str) -> List[Block]:
+        """Dequeue every block queued for a recipient"""
+        with self._lock:
+            blocks = self.get(recipient_id)
+            for entry in list(self._by_recipient.get(recipient_id, {}).values()):
+                self._unindex(entry)
+            return blocks
+
+    def remove(self, blocks: List[Block]):
+        self.remove_hashes([block.hash for block in blocks])
+
+    def remove_hashes(self, block_hashes: List[str]) -> int:
+        removed = 0
+        with self._lock:
+            for block_hash in block_hashes:
+                entry = self._order.get(block_hash)
+                if entry is not None:
+                    self._unindex(entry)
+                    removed += 1
+        return removed
+
+    def blocks(self) -> List[Block]:
+        """Every queued block, oldest first; reads spilled entries from disk"""
+        with self._lock:
+            return [self._read_block(entry) for entry in self._order.values()]
+
+    def expire(self, now: float = None) -> int:
+        """Drop entries older than ttl; entries are ordered by age so this stops at the first live one"""
+        now = now or time.time()
+        expired = 0
+        with self._lock:
+            while self._order:
+                entry = next(iter(self._order.values()))
+                if now - entry.enqueued_at < self.ttl:
+                    break
+                self._unindex(entry)
+                expired += 1
+        self.expired_count += expired
+        return expired
+
+    def _enforce_limits(self):
+        while self._order and (len(self._order) > self.max_blocks or self.total_bytes > self.max_bytes):
+            self._unindex(next(iter(self._order.values())))
+            self.evicted_count += 1
+
+        if self.path:
+            # Spill the oldest resident entries; their blocks stay on disk
+            while self._resident and self.memory_bytes > self.memory_limit:
+                _, entry = self._resident.popitem(last=False)
+                entry.block = None
+                self.memory_bytes -= entry.size
+
+    def recipients(self) -> List[str]:
+        with self._lock:
+            return list(self._by_recipient)
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def __contains__(self, block: Block) -> bool:
+        return block.hash in self._order
+
+
+# Every node starts from the same genesis block, so chains from different devices can be compared
+GENESIS_TIMESTAMP = 1735689600.0  # 2025-01-01T00:00:00Z
+
+
+class Blockchain:
+    def __init__(self, miner: ProofOfWorkMiner = None, store: ChainStore = None, pending: PendingQueue = None):
+        if store is not None:
+            self.chain = store
+            if not len(store):
+                store.append(self.create_genesis_block())
+        else:
+            self.chain = [self.create_genesis_block()]
+        if self.chain[0].hash != self.create_genesis_block().hash:
+            logger.warning("Blockchain: stored chain has a non-standard genesis block and cannot sync with peers")
+        self.difficulty = 2
+        self.pending_blocks = pending if pending is not None else PendingQueue()  # For store-and-forward
+        self.miner = miner  # None keeps mining single-threaded, e.g. on low-power devices
+        self.expiry = None  # ExpiryScheduler told about every block with an expiration_time
+
+        # Everything up to verified_height has already been checked; routine validation starts above it
+        self.verified_height = 0
+        self.verified_hash = self.chain[0].hash
+        watermark = store.load_watermark() if store is not None else None
+        if watermark:
+            self.verified_height, self.verified_hash = watermark
+
+    def create_genesis_block(self) -> Block:
+        return Block(0, "0", GENESIS_TIMESTAMP, "Genesis Block")
+
+    def get_latest_block(self) -> Block:
+        return self.chain[-1]
+
+    def truncate(self, length: int):
+        """Drop blocks from height length onwards"""
+        if isinstance(self.chain, ChainStore):
+            self.chain.truncate(length)
+        else:
+            del self.chain[length:]
+        if self.verified_height >= length:
+            self._set_watermark(length - 1, self.chain[length - 1].hash)
+
+    def cumulative_work(self, height: int) -> int:
+        """Expected hashes needed to produce a chain up to height
+
+        Difficulty is fixed network-wide, so every block after genesis carries the same work.
+        """
+        return height * 16 ** self.difficulty
+
+    def prune_expired(self, blocks: Dict[int, str]) -> List[str]:
+        """Drop the bodies of expired blocks, given as height: hash; returns the hashes pruned
+
+        Blocks no longer at that height (e.g. after a reorg) are skipped.
+        """
+        pruned = {}
+        for height, block_hash in blocks.items():
+            if height >= len(self.chain):
+                continue
+            block = self.chain[height]
+            if block.hash == block_hash and not block.is_pruned():
+                block.prune_payload()
+                pruned[height] = block
+        if pruned and isinstance(self.chain, ChainStore):
+            self.chain.rewrite(pruned)
+        return [block.hash for block in pruned.values()]
+
+    def meets_difficulty(self, index: int, block_hash: str) -> bool:
+        """Whether a block hash carries enough proof of work (genesis is exempt)"""
+        return index == 0 or block_hash.startswith('0' * self.difficulty)
+
+    def add_block(self, new_block: Block):
+        new_block.previous_hash = self.get_latest_block().hash
+        new_block.hash = new_block.calculate_hash()
+        self.chain.append(new_block)
+        if self.expiry is not None:
+            self.expiry.schedule(new_block, new_block.index)
+
+    def proof_of_work(self, block: Block) -> Block:
+        if self.miner is not None and self.difficulty >= self.miner.min_difficulty:
+            return self.miner.mine(block, self.difficulty).block
+        return self.proof_of_work_serial(block)
+
+    def proof_of_work_serial(self, block: Block) -> Block:
+        """Single-threaded mining loop"""
+        target = '0' * self.difficulty
+        header = hashlib.sha256(block.header_prefix())
+        while not block.hash.startswith(target):
+            block.nonce += 1
+            attempt = header.copy()
+            attempt.update(NONCE_STRUCT.pack(block.nonce))
+            block.hash = attempt.hexdigest()
+        return block
+
+    def is_chain_valid(self) -> bool:
+        return self.validate_chain() is None
+
+    def validate_chain(self, full: bool = False, workers: int = None, segment_size: int = 5000) -> Optional[int]:
+        """Validate the chain and return the index of the first invalid block, or None
+
+        Only blocks above the verified watermark are checked unless full is set.
+        With workers > 1, segments are re-hashed on a process pool, for bulk cases
+        such as importing a synced chain or a cold restart after a crash.
+        """
+        start = 1
+        if not full and self._watermark_matches():
+            start = self.verified_height + 1
+        end = len(self.chain)
+        if start >= end:
+            return None
+
+        if workers and workers > 1 and end - start > segment_size:
+            first_invalid = self._validate_parallel(start, end, workers, segment_size)
+        else:
+            first_invalid = _first_invalid_block((self.chain[height] for height in range(start - 1, end)), start,
+                                                 self.difficulty)
+
+        if first_invalid is None:
+            self._set_watermark(end - 1, self.chain[end - 1].hash)
+        return first_invalid
+
+    def _validate_parallel(self, start: int, end: int, workers: int, segment_size: int) -> Optional[int]:
+        # Workers open a disk-backed chain themselves instead of receiving pickled blocks
+        on_disk = isinstance(self.chain, ChainStore)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_process_context()) as executor:
+            futures = []
+            for segment_start in range(start, end, segment_size):
+                segment_end = min(segment_start + segment_size, end)
+                source = self.chain.path if on_disk else self.chain[segment_start - 1:segment_end]
+                futures.append(executor.submit(_validate_segment, source, segment_start, segment_end,
+                                               self.difficulty))
+
+            # Segments are in height order, so the first failure found is the lowest index
+            for future in futures:
+                first_invalid = future.result()
+                if first_invalid is not None:
+                    for pending in futures:
+                        pending.cancel()
+                    return first_invalid
+        return None
+
+    def _watermark_matches(self) -> bool:
+        """The watermark only counts if it still points into this chain"""
+        return (self.verified_height < len(self.chain)
+                and self.chain[self.verified_height].hash == self.verified_hash)
+
+    def _set_watermark(self, height: int, block_hash: str):
+        self.verified_height = height
+        self.verified_hash = block_hash
+        if isinstance(self.chain, ChainStore):
+            self.chain.save_watermark(height, block_hash)
+
+    def add_pending_block(self, block: Block):
+        """Add a block to pending queue for store-and-forward"""
+        self.pending_blocks.add(block)
+        if self.expiry is not None:
+            self.expiry.schedule(block)
+
+    def get_pending_blocks_for_recipient(self, recipient_id: str) -> List[Block]:
+        """Get all pending blocks for a specific recipient"""
+        return self.pending_blocks.get(recipient_id)
+
+    def pop_pending_blocks_for_recipient(self, recipient_id: str) -> List[Block]:
+        """Get and remove all pending blocks for a specific recipient"""
+        return self.pending_blocks.pop(recipient_id)
+
+    def remove_pending_blocks(self, blocks: List[Block]):
+        """Remove delivered blocks from pending queue"""
+        self.pending_blocks.remove(blocks)
+
+
+class OrphanPool:
+    """Blocks whose parent hasn't arrived yet, keyed by previous_hash
+
+    Bounded by count and payload size; the oldest orphans are evicted first and
+    orphans older than max_age are dropped. Each orphan keeps the peer it came from
+    and the relay hops it had left, so it can be passed on once it connects.
+    """
+
+    def __init__(self, max_blocks: int = 256, max_bytes: int = 4 * 1024 * 1024, max_age: float = 3600):
+        self.max_blocks = max_blocks
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._blocks = OrderedDict()  # hash: (block, arrival time, size, source, ttl), oldest first
+        self._children: Dict[str, List[str]] = {}  # previous_hash: orphan hashes
+        self._bytes = 0
+        self.evicted_count = 0
+
+    def __len__(self) -> int:
+        return len(self._blocks)
+
+    def __contains__(self, block_hash: str) -> bool:
+        return block_hash in self._blocks
+
+    def add(self, block: Block, source: str = None, ttl: int = None):
+        if block.hash in self._blocks:
+            return
+        size = len(block.data or '') + len(block.file_data or '')
+        self._blocks[block.hash] = (block, time.time(), size, source, ttl)
+        self._children.setdefault(block.previous_hash, []).append(block.hash)
+        self._bytes += size
+        self.expire()
+        while len(self._blocks) > self.max_blocks or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._blocks)))
+            self.evicted_count += 1
+
+    def pop_children(self, block_hash: str) -> List[Tuple[Block, Optional[str], Optional[int]]]:
+        """Remove and return (orphan, source, ttl) for orphans whose parent is block_hash"""
+        children = []
+        for child_hash in self._children.get(block_hash, [])[:]:
+            block, _, _, source, ttl = self._blocks[child_hash]
+            children.append((block, source, ttl))
+            self._remove(child_hash)
+        return children
+
+    def expire(self):
+        cutoff = time.time() - self.max_age
+        while self._blocks:
+            block_hash, (_, arrived, *_) = next(iter(self._blocks.items()))
+            if arrived >= cutoff:
+                break
+            self._remove(block_hash)
+
+    def _remove(self, block_hash: str):
+        block, _, size, _, _ = self._blocks.pop(block_hash)
+        self._bytes -= size
+        siblings = self._children[block.previous_hash]
+        siblings.remove(block_hash)
+        if not siblings:
+            del self._children[block.previous_hash]
+
+
+class ForkChoice:
+    """Competing branches off the main chain, switched to when one carries more work
+
+    Side blocks must fork from the main chain at most max_depth blocks below the tip.
+    Branches that fall further behind are pruned, and at most max_blocks side blocks
+    are kept. Between branches of equal work the one whose tip has the lower hash wins,
+    so every node that has seen both settles on the same chain.
+    """
+
+    def __init__(self, blockchain: Blockchain, max_blocks: int = 1024, max_depth: int = 100):
+        self.blockchain = blockchain
+        self.max_blocks = max_blocks
+        self.max_depth = max_depth
+        self._blocks: Dict[str, Block] = {}  # hash: side block
+        self.reorg_count = 0
+
+    def __contains__(self, block_hash: str) -> bool:
+        return block_hash in self._blocks
+
+    def on_main_chain(self, index: int, block_hash: str) -> bool:
+        chain = self.blockchain.chain
+        return 0 <= index < len(chain) and chain[index].hash == block_hash
+
+    def attaches(self, block: Block) -> bool:
+        """Whether block's parent is a side block or a main-chain block recent enough to fork from"""
+        if block.previous_hash in self._blocks:
+            return True
+        tip = self.blockchain.get_latest_block().index
+        return tip - (block.index - 1) <= self.max_depth and self.on_main_chain(block.index - 1, block.previous_hash)
+
+    def add(self, block: Block) -> Optional[List[Block]]:
+        """Store a side block; returns its branch from the fork point if that now outweighs the main chain"""
+        self._blocks[block.hash] = block
+        branch = [block]
+        while branch[0].previous_hash in self._blocks:
+            branch.insert(0, self._blocks[branch[0].previous_hash])
+        fork_height = branch[0].index - 1
+        if not self.on_main_chain(fork_height, branch[0].previous_hash):
+            return None
+        tip = self.blockchain.get_latest_block()
+        work, tip_work = self.blockchain.cumulative_work(block.index), self.blockchain.cumulative_work(tip.index)
+        if work > tip_work or (work == tip_work and block.hash < tip.hash):
+            return branch
+        self.prune()
+        return None
+
+    def switched(self, branch: List[Block], removed: List[Block]):
+        """Record a reorg: the branch is now main chain and the removed blocks become a side branch"""
+        for block in branch:
+            self._blocks.pop(block.hash, None)
+        for block in removed:
+            self._blocks[block.hash] = block
+        self.reorg_count += 1
+        self.prune()
+
+    def prune(self):
+        """Drop branches forking too far below the tip, then the oldest side blocks over the limit"""
+        floor = self.blockchain.get_latest_block().index - self.max_depth
+        stale = [block_hash for block_hash, block in self._blocks.items() if block.index <= floor]
+        for block_hash in stale:
+            del self._blocks[block_hash]
+        if len(self._blocks) > self.max_blocks:
+            for block in sorted(self._blocks.values(), key=lambda b: b.index)[:len(self._blocks) - self.max_blocks]:
+                del self._blocks[block.hash]
+
+
+class ExpiryScheduler:
+    """Purges disappearing messages when they expire
+
+    Deadlines sit in a min-heap and one thread sleeps until the earliest, so waiting
+    messages cost nothing between deadlines. Everything due within batch_delay of the
+    first deadline is purged together: bodies are pruned from the chain (in memory and
+    on disk) and queued pending copies are dropped. callback receives the expired hashes.
+    """
+
+    def __init__(self, blockchain: Blockchain, callback=None, batch_delay: float = 1.0, lock=None):
+        self.blockchain = blockchain
+        self.callback = callback
+        self.batch_delay = batch_delay
+        self.lock = lock or threading.RLock()  # Held while pruning, to keep out concurrent appends and reorgs
+        self.purged_count = 0
+        self._heap = []  # (expiration_time, block hash, chain height or None for pending copies)
+        self._scheduled = set()  # (block hash, height) already in the heap
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def schedule(self, block: Block, height: int = None):
+        """Purge block at its expiration_time; height locates it in the chain, None means the pending queue"""
+        if not block.expiration_time or block.is_pruned():
+            return
+        self._push(block.expiration_time, block.hash, height)
+
+    def _push(self, expiration_time: float, block_hash: str, height: Optional[int]):
+        with self._condition:
+            if (block_hash, height) in self._scheduled:
+                return
+            self._scheduled.add((block_hash, height))
+            heapq.heappush(self._heap, (expiration_time, block_hash, height))
+            if self._heap[0][1] == block_hash:
+                self._condition.notify()
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='expiry', daemon=True)
+            self._thread.start()
+
+    def _scan(self):
+        """Find expiring blocks stored before this run
+
+        A disk-backed chain lists them in its expiry index; an in-memory chain is walked.
+        """
+        chain = self.blockchain.chain
+        if isinstance(chain, ChainStore):
+            for expiration_time, block_hash, height in chain.expiring():
+                self._push(expiration_time, block_hash, height)
+        else:
+            for height, block in enumerate(chain):
+                if not self._running:
+                    return
+                self.schedule(block, height)
+        for block in self.blockchain.pending_blocks.blocks():
+            self.schedule(block)
+
+    def _run(self):
+        self._scan()
+        while True:
+            with self._condition:
+                while self._running and (not self._heap or self._heap[0][0] > time.time()):
+                    timeout = self._heap[0][0] - time.time() if self._heap else None
+                    self._condition.wait(timeout)
+                if not self._running:
+                    return
+            # Let deadlines close behind the first one join the batch
+            time.sleep(self.batch_delay)
+            with self._condition:
+                now = time.time()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    entry = heapq.heappop(self._heap)
+                    self._scheduled.discard(entry[1:])
+                    due.append(entry)
+            try:
+                self._purge(due)
+            except Exception as e:
+                logger.error(f"ExpiryScheduler: purge failed: {e}")
+
+    def _purge(self, due: List[tuple]):
+        chain_blocks = {height: block_hash for _, block_hash, height in due if height is not None}
+        pending_hashes = [block_hash for _, block_hash, height in due if height is None]
+        with self.lock:
+            expired = self.blockchain.prune_expired(chain_blocks)
+        self.blockchain.pending_blocks.remove_hashes(pending_hashes)
+        expired_hashes = set(expired) | set(pending_hashes)
+        self.purged_count += len(expired_hashes)
+        if expired_hashes and self.callback:
+            self.callback(expired_hashes)
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+
+
+# Session-encrypted blocks carry "aead1:<key_id>" as their encryption_key, plus the
+# RSA-wrapped session key ("aead1:<key_id>:<wrapped key>") until the recipient is known to hold it
+SESSION_KEY_PREFIX = "aead1"
+AEAD_NONCE_SIZE = 12
+
+
+class Session:
+    def __init__(self, key_id: str, key: bytes, announcement: str = None):
+        self.key_id = key_id
+        self.aead = AESGCM(key)
+        self.announcement = announcement  # RSA-wrapped key, or "x25519:<ephemeral public key>"
+        self.created = time.time()
+        self.message_count = 0
+        self.acknowledged = False  # The recipient holds the key; messages stop carrying the announcement
+
+
+def _raw_public_bytes(public_key) -> str:
+    return base64.b64encode(public_key.public_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PublicFormat.Raw
+    )).decode('utf-8')
+
+
+def _raw_private_bytes(private_key) -> str:
+    return base64.b64encode(private_key.private_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PrivateFormat.Raw,
+        encryption_algorithm=serialization.NoEncryption()
+    )).decode('utf-8')
+
+
+def _derive_session_key(shared_secret: bytes, key_id: str) -> bytes:
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=f"blockchain-chat session {key_id}".encode('utf-8'),
+        backend=default_backend()
+    ).derive(shared_secret)
+
+
+class CryptoManager:
+    def __init__(self, identity_path: str = None, fast_keys: bool = True, rekey_messages: int = 1000,
+                 rekey_seconds: float = 24 * 3600, max_inbound_sessions: int = 256, sessions_path: str = None):
+        # Identity keys are generated once, saved to identity_path and loaded on first use
+        self.identity_path = identity_path
+        # Inbound session keys are kept in sessions_path, sealed with a storage key from the identity file
+        self.sessions_path = sessions_path
+        self._sessions_loaded = False
+        self.fast_keys = fast_keys  # Use X25519/Ed25519 with peers that advertise them
+        self._identity = None
+        self._identity_keys = {}
+        self._identity_lock = threading.RLock()
+        self.contacts = {}  # contact_id: public_key
+        self.contact_x25519 = {}  # contact_id: X25519 public key
+        self.contact_ed25519 = {}  # contact_id: Ed25519 public key
+
+        # One AES-GCM key per contact and direction; the identity keys only set up new sessions
+        self.rekey_messages = rekey_messages
+        self.rekey_seconds = rekey_seconds
+        self.max_inbound_sessions = max_inbound_sessions
+        self.outbound_sessions: Dict[str, Session] = {}  # contact_id: session
+        self.inbound_sessions = OrderedDict()  # (contact_id, key_id): key, least recently used first
+        self._session_lock = threading.Lock()
+
+    def _identity_key(self, name: str, generate, serialize, deserialize):
+        """Load an identity key from disk, generating and saving it the first time"""
+        with self._identity_lock:
+            key = self._identity_keys.get(name)
+            if key is not None:
+                return key
+
+            if self._identity is None:
+                self._identity = {}
+                if self.identity_path and os.path.exists(self.identity_path):
+                    with open(self.identity_path, 'r') as f:
+                        self._identity = json.load(f)
+
+            if name in self._identity:
+                key = deserialize(self._identity[name])
+            else:
+                key = generate()
+                self._identity[name] = serialize(key)
+                if self.identity_path:
+                    temp_path = self.identity_path + '.tmp'
+                    with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                        json.dump(self._identity, f)
+                    os.replace(temp_path, self.identity_path)
+            self._identity_keys[name] = key
+            return key
+
+    @property
+    def private_key(self) -> rsa.RSAPrivateKey:
+        return self._identity_key(
+            "rsa",
+            lambda: rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend()),
+            lambda key: key.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption()
+            ).decode('utf-8'),
+            lambda pem: serialization.load_pem_private_key(pem.encode('utf-8'), password=None,
+                                                           backend=default_backend())
+        )
+
+    @property
+    def public_key(self) -> rsa.RSAPublicKey:
+        return self.private_key.public_key()
+
+    @property
+    def x25519_key(self) -> x25519.X25519PrivateKey:
+        return self._identity_key(
+            "x25519",
+            x25519.X25519PrivateKey.generate,
+            _raw_private_bytes,
+            lambda raw: x25519.X25519PrivateKey.from_private_bytes(base64.b64decode(raw))
+        )
+
+    @property
+    def ed25519_key(self) -> ed25519.Ed25519PrivateKey:
+        return self._identity_key(
+            "ed25519",
+            ed25519.Ed25519PrivateKey.generate,
+            _raw_private_bytes,
+            lambda raw: ed25519.Ed25519PrivateKey.from_private_bytes(base64.b64decode(raw))
+        )
+
+    @property
+    def storage_key(self) -> AESGCM:
+        """Local key sealing saved session keys"""
+        return AESGCM(self._identity_key(
+            "storage",
+            lambda: AESGCM.generate_key(bit_length=256),
+            lambda key: base64.b64encode(key).decode('utf-8'),
+            base64.b64decode
+        ))
+
+    def get_public_key_pem(self) -> str:
+        """Get PEM formatted public key"""
+        return self.public_key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        ).decode('utf-8')
+
+    def get_fast_public_keys(self) -> Dict[str, str]:
+        """Base64 X25519/Ed25519 public keys to advertise in the key exchange"""
+        if not self.fast_keys:
+            return {}
+        return {
+            "x25519": _raw_public_bytes(self.x25519_key.public_key()),
+            "ed25519": _raw_public_bytes(self.ed25519_key.public_key())
+        }
+
+    def add_contact(self, contact_id: str, public_key_pem: str, x25519_public: str = None,
+                    ed25519_public: str = None):
+        """Add a contact with their public key, plus any fast public keys they advertised
+
+        Keys are pinned on first use: announcing a known contact again with any key
+        changed, added or missing raises ValueError and keeps the pinned keys.
+        """
+        public_key = serialization.load_pem_public_key(
+            public_key_pem.encode('utf-8'),
+            backend=default_backend()
+        )
+        x25519_key = x25519.X25519PublicKey.from_public_bytes(base64.b64decode(x25519_public)) \
+            if x25519_public else None
+        ed25519_key = ed25519.Ed25519PublicKey.from_public_bytes(base64.b64decode(ed25519_public)) \
+            if ed25519_public else None
+
+        if contact_id in self.contacts:
+            offered = {"public_key": public_key.public_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PublicFormat.SubjectPublicKeyInfo
+            ).decode('utf-8')}
+            if x25519_key:
+                offered["x25519"] = _raw_public_bytes(x25519_key)
+            if ed25519_key:
+                offered["ed25519"] = _raw_public_bytes(ed25519_key)
+            if offered != self.get_contact_keys(contact_id):
+                raise ValueError(f"Keys for contact {contact_id} don't match the pinned keys")
+            return
+
+        self.contacts[contact_id] = public_key
+        if x25519_key:
+            self.contact_x25519[contact_id] = x25519_key
+        if ed25519_key:
+            self.contact_ed25519[contact_id] = ed25519_key
+
+    def get_contact_keys(self, contact_id: str) -> Dict[str, str]:
+        """Serialized public keys of a contact, for saving the contact list"""
+        keys = {
+            "public_key": self.contacts[contact_id].public_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PublicFormat.SubjectPublicKeyInfo
+            ).decode('utf-8')
+        }
+        if contact_id in self.contact_x25519:
+            keys["x25519"] = _raw_public_bytes(self.contact_x25519[contact_id])
+        if contact_id in self.contact_ed25519:
+            keys["ed25519"] = _raw_public_bytes(self.contact_ed25519[contact_id])
+        return keys
+
+    def _oaep(self):
+        return padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None
+        )
+
+    def _outbound_session(self, recipient_id: str) -> Session:
+        """Current session for a recipient, starting a new one when due for rekeying"""
+        session = self.outbound_sessions.get(recipient_id)
+        if (session is None or session.message_count >= self.rekey_messages
+                or time.time() - session.created >= self.rekey_seconds):
+            key_id = os.urandom(8).hex()
+            if self.fast_keys and recipient_id in self.contact_x25519:
+                # Ephemeral-static X25519 agreement: microseconds instead of an RSA operation
+                ephemeral = x25519.X25519PrivateKey.generate()
+                key = _derive_session_key(ephemeral.exchange(self.contact_x25519[recipient_id]), key_id)
+                announcement = f"x25519:{_raw_public_bytes(ephemeral.public_key())}"
+            else:
+                key = AESGCM.generate_key(bit_length=256)
+                wrapped_key = self.contacts[recipient_id].encrypt(key, self._oaep())
+                announcement = base64.b64encode(wrapped_key).decode('utf-8')
+            session = Session(key_id, key, announcement)
+            self.outbound_sessions[recipient_id] = session
+        return session
+
+    def encrypt_message(self, message: str, recipient_id: str) -> Tuple[str, str]:
+        """Encrypt a message for a recipient with the contact's AES-GCM session key
+        Returns: (encrypted_message, encryption_key)
+        """
+        if recipient_id not in self.contacts:
+            raise ValueError(f"Recipient {recipient_id} not in contacts")
+
+        with self._session_lock:
+            session = self._outbound_session(recipient_id)
+            session.message_count += 1
+            # Messages carry the announcement until the recipient is known to hold the key, so one
+            # that missed the first ones (lost, reordered or already expired) can still read the rest
+            encryption_key = f"{SESSION_KEY_PREFIX}:{session.key_id}"
+            if not session.acknowledged:
+                encryption_key += f":{session.announcement}"
+
+        nonce = os.urandom(AEAD_NONCE_SIZE)
+        encrypted = session.aead.encrypt(nonce, message.encode('utf-8'), session.key_id.encode('utf-8'))
+        return base64.b64encode(nonce + encrypted).decode('utf-8'), encryption_key
+
+    def acknowledge(self, contact_id: str, key_id: str):
+        """The contact holds session key_id; if it is still current, stop announcing it"""
+        with self._session_lock:
+            session = self.outbound_sessions.get(contact_id)
+            if session is not None and session.key_id == key_id:
+                session.acknowledged = True
+
+    def _inbound_session(self, sender_id: str, key_id: str, announcement: Optional[str]) -> AESGCM:
+        with self._session_lock:
+            self._load_inbound_sessions()
+            key = self.inbound_sessions.get((sender_id, key_id))
+            if key is not None:
+                self.inbound_sessions.move_to_end((sender_id, key_id))
+                return AESGCM(key)
+
+        if not announcement:
+            raise ValueError(f"Unknown session key {key_id} from {sender_id}")
+        if announcement.startswith("x25519:"):
+            ephemeral_public = x25519.X25519PublicKey.from_public_bytes(base64.b64decode(announcement[7:]))
+            key = _derive_session_key(self.x25519_key.exchange(ephemeral_public), key_id)
+        else:
+            key = self.private_key.decrypt(base64.b64decode(announcement), self._oaep())
+
+        with self._session_lock:
+            self.inbound_sessions[(sender_id, key_id)] = key
+            while len(self.inbound_sessions) > self.max_inbound_sessions:
+                self.inbound_sessions.popitem(last=False)
+            self._save_inbound_sessions()
+        return AESGCM(key)
+
+    def _load_inbound_sessions(self):
+        """Read saved inbound session keys on first use; call with _session_lock held"""
+        if self._sessions_loaded:
+            return
+        self._sessions_loaded = True
+        if not self.sessions_path or not os.path.exists(self.sessions_path):
+            return
+        try:
+            with open(self.sessions_path, 'rb') as f:
+                sealed = f.read()
+            entries = json.loads(self.storage_key.decrypt(sealed[:AEAD_NONCE_SIZE], sealed[AEAD_NONCE_SIZE:],
+                                                          b"inbound sessions"))
+            for contact_id, key_id, key in entries:
+                self.inbound_sessions[(contact_id, key_id)] = base64.b64decode(key)
+        except Exception as e:
+            logger.error(f"Error loading session keys: {e}")
+
+    def _save_inbound_sessions(self):
+        """Seal and write the inbound session keys; call with _session_lock held"""
+        if not self.sessions_path:
+            return
+        entries = [[contact_id, key_id, base64.b64encode(key).decode('utf-8')]
+                   for (contact_id, key_id), key in self.inbound_sessions.items()]
+        nonce = os.urandom(AEAD_NONCE_SIZE)
+        sealed = nonce + self.storage_key.encrypt(nonce, json.dumps(entries).encode('utf-8'), b"inbound sessions")
+        try:
+            temp_path = self.sessions_path + '.tmp'
+            with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+                f.write(sealed)
+            os.replace(temp_path, self.sessions_path)
+        except OSError as e:
+            logger.error(f"Error saving session keys: {e}")
+
+    def decrypt_message(self, encrypted_message: str, encryption_key: str, sender_id: str = None) -> str:
+        """Decrypt a message; blocks from peers without session support use the per-message RSA scheme"""
+        if not encryption_key.startswith(SESSION_KEY_PREFIX + ":"):
+            return self.decrypt_message_rsa(encrypted_message, encryption_key)
+
+        parts = encryption_key.split(':', 2)
+        key_id = parts[1]
+        aead = self._inbound_session(sender_id, key_id, parts[2] if len(parts) > 2 else None)
+
+        encrypted_data = base64.b64decode(encrypted_message)
+        nonce = encrypted_data[:AEAD_NONCE_SIZE]
+        decrypted_message = aead.decrypt(nonce, encrypted_data[AEAD_NONCE_SIZE:], key_id.encode('utf-8'))
+        return decrypted_message.decode('utf-8')
+
+    def encrypt_message_rsa(self, message: str, recipient_id: str) -> Tuple[str, str]:
+        """Encrypt a message with a fresh RSA-OAEP wrapped AES-CFB key (per-message scheme)
+        Returns: (encrypted_message, encryption_key)
+        """
+        if recipient_id not in self.contacts:
+            raise ValueError(f"Recipient {recipient_id} not in contacts")
+
+        # Generate a random AES key
+        aes_key = os.urandom(32)  # 256-bit key
+
+        # Encrypt the message with AES
+        iv = os.urandom(16)
+        cipher = Cipher(
+            algorithms.AES(aes_key),
+            modes.CFB(iv),
+            backend=default_backend()
+        )
+        encryptor = cipher.encryptor()
+        encrypted_message = encryptor.update(message.encode('utf-8')) + encryptor.finalize()
+
+        # Encrypt the AES key with the recipient's public key
+        encrypted_key = self.contacts[recipient_id].encrypt(
+            aes_key,
+            padding.OAEP(
+                mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                algorithm=hashes.SHA256(),
+                label=None
+            )
+        )
+
+        # Return base64 encoded encrypted message and key
+        return (
+            base64.b64encode(iv + encrypted_message).decode('utf-8'),
+            base64.b64encode(encrypted_key).decode('utf-8')
+        )
+
+    def decrypt_message_rsa(self, encrypted_message: str, encryption_key: str) -> str:
+        """Decrypt a message encrypted with encrypt_message_rsa"""
+        # Decode from base64
+        encrypted_data = base64.b64decode(encrypted_message)
+        encrypted_key = base64.b64decode(encryption_key)
+
+        # Decrypt the AES key with our private key
+        aes_key = self.private_key.decrypt(
+            encrypted_key,
+            padding.OAEP(
+                mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                algorithm=hashes.SHA256(),
+                label=None
+            )
+        )
+
+        # Extract IV and encrypted message
+        iv = encrypted_data[:16]
+        encrypted = encrypted_data[16:]
+
+        # Decrypt the message with AES
+        cipher = Cipher(
+            algorithms.AES(aes_key),
+            modes.CFB(iv),
+            backend=default_backend()
+        )
+        decryptor = cipher.decryptor()
+        decrypted_message = decryptor.update(encrypted) + decryptor.finalize()
+
+        return decrypted_message.decode('utf-8')
+
+    def sign_data(self, data: str) -> str:
+        """Sign data with private key (Ed25519 when fast keys are enabled, "ed25519:" prefixed)"""
+        if self.fast_keys:
+            signature = self.ed25519_key.sign(data.encode('utf-8'))
+            return "ed25519:" + base64.b64encode(signature).decode('utf-8')
+
+        signature = self.private_key.sign(
+            data.encode('utf-8'),
+            padding.PSS(
+                mgf=padding.MGF1(hashes.SHA256()),
+                salt_length=padding.PSS.MAX_LENGTH
+            ),
+            hashes.SHA256()
+        )
+        return base64.b64encode(signature).decode('utf-8')
+
+    def verify_own_signature(self, data: str, signature: str) -> bool:
+        """Verify a signature made by this device, e.g. on one of our blocks relayed back to us"""
+        if not signature:
+            return False
+        try:
+            if signature.startswith("ed25519:"):
+                self.ed25519_key.public_key().verify(base64.b64decode(signature[8:]), data.encode('utf-8'))
+            else:
+                self.public_key.verify(
+                    base64.b64decode(signature),
+                    data.encode('utf-8'),
+                    padding.PSS(
+                        mgf=padding.MGF1(hashes.SHA256()),
+                        salt_length=padding.PSS.MAX_LENGTH
+                    ),
+                    hashes.SHA256()
+                )
+            return True
+        except Exception:
+            return False
+
+    def verify_signature(self, data: str, signature: str, contact_id: str) -> bool:
+        """Verify signature from a contact"""
+        if signature.startswith("ed25519:"):
+            if contact_id not in self.contact_ed25519:
+                return False
+            try:
+                self.contact_ed25519[contact_id].verify(base64.b64decode(signature[8:]), data.encode('utf-8'))
+                return True
+            except Exception:
+                return False
+
+        if contact_id not in self.contacts:
+            return False
+
+        try:
+            self.contacts[contact_id].verify(
+                base64.b64decode(signature),
+                data.encode('utf-8'),
+                padding.PSS(
+                    mgf=padding.MGF1(hashes.SHA256()),
+                    salt_length=padding.PSS.MAX_LENGTH
+                ),
+                hashes.SHA256()
+            )
+            return True
+        except Exception:
+            return False
+
+
+def compare_encryption_schemes(message_size: int = 256, rounds: int = 200) -> Dict[str, float]:
+    """Messages/sec for encrypt+decrypt with session keys versus per-message RSA-wrapped keys
+
+    Sessions are measured with a contact that only has RSA keys and with one that also has
+    X25519 keys. *_key_bytes is the average encryption_key size before the recipient
+    acknowledges the session, *_acked_key_bytes after.
+    """
+    sender = CryptoManager()
+    recipient = CryptoManager()
+    fast = recipient.get_fast_public_keys()
+    sender.add_contact("rsa_only", recipient.get_public_key_pem())
+    sender.add_contact("x25519", recipient.get_public_key_pem(), fast["x25519"], fast["ed25519"])
+    message = "x" * message_size
+
+    def run(encrypt, decrypt, contact_id):
+        key_bytes = 0
+        started = time.perf_counter()
+        for _ in range(rounds):
+            encrypted_message, encryption_key = encrypt(message, contact_id)
+            decrypt(encrypted_message, encryption_key)
+            key_bytes += len(encryption_key)
+        return rounds / (time.perf_counter() - started), key_bytes / rounds
+
+    results = {}
+    for name, contact_id in (("session_rsa", "rsa_only"), ("session_x25519", "x25519")):
+        decrypt = functools.partial(recipient.decrypt_message, sender_id="sender")
+        results[f"{name}_messages_per_second"], results[f"{name}_key_bytes"] = run(
+            sender.encrypt_message, decrypt, contact_id)
+        sender.acknowledge(contact_id, sender.outbound_sessions[contact_id].key_id)
+        _, results[f"{name}_acked_key_bytes"] = run(sender.encrypt_message, decrypt, contact_id)
+    results["rsa_messages_per_second"], results["rsa_key_bytes"] = run(
+        sender.encrypt_message_rsa, recipient.decrypt_message_rsa, "rsa_only")
+    results["speedup"] = results["session_x25519_messages_per_second"] / results["rsa_messages_per_second"]
+    return results
+
+
+def _percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def measure(func, rounds: int = None, min_time: float = 0.5, max_rounds: int = 100000,
+            warmup: int = 2, min_sample: float = 0.0001) -> Dict[str, float]:
+    """Call func repeatedly and report ops/sec and per-call percentiles in microseconds
+
+    Runs exactly rounds calls if given, otherwise keeps going for min_time seconds. Without
+    rounds, fast calls are timed in batches of at least min_sample seconds, so timer
+    overhead doesn't swamp them.
+    """
+    started = time.perf_counter()
+    for _ in range(warmup):
+        func()
+    batch = 1
+    if rounds is None and warmup:
+        per_call = (time.perf_counter() - started) / warmup
+        batch = max(1, int(min_sample / per_call)) if per_call else 1000
+    samples = []
+    calls = 0
+    total = 0.0
+    while calls < (rounds or max_rounds) and (rounds or total < min_time):
+        started = time.perf_counter()
+        for _ in range(batch):
+            func()
+        elapsed = time.perf_counter() - started
+        samples.append(elapsed / batch)
+        calls += batch
+        total += elapsed
+    return {
+        "ops_per_second": calls / total if total else 0.0,
+        "p50_us": _percentile(samples, 0.50) * 1e6,
+        "p90_us": _percentile(samples, 0.90) * 1e6,
+        "p99_us": _percentile(samples, 0.99) * 1e6,
+        "rounds": calls,
+    }
+
+
+def _benchmark_chain(length: int) -> Blockchain:
+    """An in-memory chain of linked blocks; difficulty 0, so validation time isn't spent mining it first"""
+    blockchain = Blockchain()
+    blockchain.difficulty = 0
+    for index in range(1, length):
+        blockchain.chain.append(Block(index, blockchain.chain[-1].hash, GENESIS_TIMESTAMP + index,
+                                      f"message {index}", sender_id="bench"))
+    return blockchain
+
+
+def run_benchmarks(quick: bool = False) -> Dict[str, Dict[str, float]]:
+    """Benchmark the block, chain, pending queue and crypto hot paths
+
+    quick drops the slowest cases (difficulty 4, the 100k block chain, 16 KiB payloads)
+    so the suite fits in a pre-commit check.
+    """
+    results = {}
+    min_time = 0.2 if quick else 0.5
+    block = Block(1, "0" * 64, GENESIS_TIMESTAMP, "x" * 256, sender_id="bench", recipient_id="peer")
+    encoded = block.to_json()
+    results["block.calculate_hash"] = measure(block.calculate_hash, min_time=min_time)
+    results["block.calculate_payload_hash"] = measure(block.calculate_payload_hash, min_time=min_time)
+    results["block.to_json"] = measure(block.to_json, min_time=min_time)
+    results["block.from_json"] = measure(lambda: Block.from_json(encoded), min_time=min_time)
+    results["block.to_bytes"] = measure(block.to_bytes, min_time=min_time)
+
+    blockchain = Blockchain()
+    nonces = itertools.count()
+    for difficulty in ((1, 2, 3) if quick else (1, 2, 3, 4)):
+        blockchain.difficulty = difficulty
+
+        def mine():
+            candidate = Block(1, "0" * 64, GENESIS_TIMESTAMP, f"pow {next(nonces)}")
+            blockchain.proof_of_work_serial(candidate)
+
+        # Mining time is geometric in the nonce found, so higher difficulties need more rounds to settle
+        results[f"proof_of_work.d{difficulty}"] = measure(mine, rounds=max(8, 64 >> difficulty) if quick else
+                                                          max(16, 256 >> difficulty))
+
+    for length in ((1000, 10000) if quick else (1000, 10000, 100000)):
+        chain = _benchmark_chain(length)
+        results[f"is_chain_valid.{length // 1000}k"] = measure(
+            lambda: chain.validate_chain(full=True), rounds=3 if length >= 100000 else 10, warmup=1)
+
+    recipients = [f"recipient-{index}" for index in range(64)]
+    blocks = [Block(index, "0" * 64, GENESIS_TIMESTAMP, "x" * 128, recipient_id=recipients[index % 64])
+              for index in range(4096)]
+    pending = PendingQueue()
+    added = iter(blocks)
+    results["pending_queue.add"] = measure(lambda: pending.add(next(added)), rounds=len(blocks) - 2)
+    results["pending_queue.get"] = measure(lambda: pending.get(random.choice(recipients)), min_time=min_time)
+    popped = iter(recipients)
+    results["pending_queue.pop"] = measure(lambda: pending.pop(next(popped)), rounds=len(recipients) - 2)
+    with tempfile.TemporaryDirectory() as path:
+        on_disk = PendingQueue(os.path.join(path, "pending"), fsync=False)
+        added = iter(blocks)
+        results["pending_queue.add.disk"] = measure(lambda: on_disk.add(next(added)), rounds=1000)
+
+    sender = CryptoManager()
+    recipient = CryptoManager()
+    sender.add_contact("recipient", recipient.get_public_key_pem())
+    for size in ((64, 1024) if quick else (64, 1024, 16384)):
+        message = "x" * size
+        results[f"crypto.encrypt.{size}"] = measure(lambda: sender.encrypt_message(message, "recipient"),
+                                                    min_time=min_time)
+        # Unacknowledged sessions are announced on every message; warmup derives the key once and the
+        # samples hit the cache
+        encrypted_message, encryption_key = sender.encrypt_message(message, "recipient")
+        results[f"crypto.decrypt.{size}"] = measure(
+            lambda: recipient.decrypt_message(encrypted_message, encryption_key, "sender"), min_time=min_time)
+        results[f"crypto.sign.{size}"] = measure(lambda: sender.sign_data(message), min_time=min_time)
+
+    # The existing comparisons are reported alongside; they have no percentiles, so baselines skip them
+    results["wire_codecs"] = compare_wire_codecs(block, rounds=200 if quick else 1000)
+    results["encryption_schemes"] = compare_encryption_schemes(rounds=50 if quick else 200)
+    return results
+
+
+def compare_benchmarks(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+                       threshold: float = 0.2) -> List[Tuple[str, float, float]]:
+    """Benchmarks whose median time per call grew more than threshold over the baseline
+
+    The median is compared rather than ops/sec, which a few scheduler hiccups can skew.
+    Returns: [(name, baseline p50 us, current p50 us)]
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name, {}).get("p50_us")
+        after = result.get("p50_us")
+        if before and after is not None and after > before * (1 + threshold):
+            regressions.append((name, before, after))
+    return regressions
+
+
+def format_benchmarks(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]] = None) -> str:
+    lines = [f"{'benchmark':<32}{'ops/sec':>12}{'p50 us':>12}{'p90 us':>12}{'p99 us':>12}{'p50 vs base':>13}"]
+    for name, result in results.items():
+        if "ops_per_second" not in result:
+            lines.append(f"{name:<32}" + ", ".join(f"{key}={value:.4g}" for key, value in result.items()))
+            continue
+        change = ""
+        before = (baseline or {}).get(name, {}).get("p50_us")
+        if before:
+            change = f"{(result['p50_us'] / before - 1) * 100:+.1f}%"
+        lines.append(f"{name:<32}{result['ops_per_second']:>12.1f}{result['p50_us']:>12.1f}"
+                     f"{result['p90_us']:>12.1f}{result['p99_us']:>12.1f}{change:>13}")
+    return "\n".join(lines)
+
+
+def benchmark_main(args: List[str]) -> int:
+    """Command line entry point; returns 1 if any benchmark regressed past the threshold"""
+    parser = argparse.ArgumentParser(prog="main.py --benchmark", description="Run the micro-benchmark suite")
+    parser.add_argument("--quick", action="store_true", help="skip the slowest cases")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--save", help="write this run's results as JSON, e.g. to use as the next baseline")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="fail if median time per call grows by more than this fraction (default 0.2)")
+    options = parser.parse_args(args)
+
+    baseline = None
+    if options.baseline:
+        with open(options.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    results = run_benchmarks(quick=options.quick)
+    print(format_benchmarks(results, baseline))
+    if options.save:
+        with open(options.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if baseline is None:
+        return 0
+    regressions = compare_benchmarks(results, baseline, options.threshold)
+    for name, before, after in regressions:
+        print(f"REGRESSION {name}: p50 {before:.1f} -> {after:.1f} us ({(after / before - 1) * 100:+.1f}%)")
+    return 1 if regressions else 0
+
+
+class SendHandle:
+    """Tracks one outgoing message through the send pipeline
+
+    States: queued -> encrypting -> mining -> broadcast, or failed/cancelled.
+    State callbacks run on pipeline threads; UI code must hop back to the main thread.
+    """
+
+    def __init__(self, message: str, recipient_id: str = None, message_type: str = "text",
+                 file_data: str = None, file_name: str = None, expiration_seconds: int = None):
+        self.message = message
+        self.recipient_id = recipient_id
+        self.message_type = message_type
+        self.file_data = file_data
+        self.file_name = file_name
+        self.expiration_seconds = expiration_seconds
+        self.state = "queued"
+        self.block: Optional[Block] = None
+        self.error: Optional[Exception] = None
+        self.future = Future()
+        self.payload = None  # Future for (data, encryption_key) from the encryption stage
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def add_state_callback(self, callback):
+        """Register callback(handle), called on every state change"""
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def set_state(self, state: str):
+        with self._lock:
+            if self.state in ("broadcast", "failed", "cancelled"):
+                return
+            self.state = state
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logger.error(f"Send state callback failed: {e}")
+
+    def cancel(self) -> bool:
+        """Cancel the message if it has not started mining yet"""
+        if self.state not in ("queued", "encrypting"):
+            return False
+        self.set_state("cancelled")
+        self.future.cancel()
+        return True
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def result(self, timeout: float = None) -> Block:
+        """Wait for the mined block"""
+        return self.future.result(timeout)
+
+
+class SendPipeline:
+    """Encrypt and mine outgoing messages off the UI thread
+
+    Encryption runs on a small thread pool ahead of the miner. Blocks are mined and
+    broadcast by a single worker in submission order, so every conversation stays ordered.
+    """
+
+    def __init__(self, node: 'BLENode', encrypt_workers: int = 2):
+        self.node = node
+        self._encrypt_executor = ThreadPoolExecutor(max_workers=encrypt_workers,
+                                                    thread_name_prefix='send-encrypt')
+        self._jobs = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='send-pipeline', daemon=True)
+            self._thread.start()
+
+    def submit(self, handle: SendHandle) -> SendHandle:
+        handle.payload = self._encrypt_executor.submit(self._encrypt, handle)
+        self._jobs.put(handle)
+        self.start()
+        return handle
+
+    def resubmit(self, block: Block) -> SendHandle:
+        """Mine an already built block again, e.g. one of ours dropped by a reorg"""
+        handle = SendHandle(block.data, block.recipient_id, block.message_type, block.file_data, block.file_name)
+        handle.block = block
+        self._jobs.put(handle)
+        self.start()
+        return handle
+
+    def _encrypt(self, handle: SendHandle) -> Tuple[str, Optional[str]]:
+        if handle.state == "cancelled":
+            return handle.message, None
+        handle.set_state("encrypting")
+        return self.node._encrypt_payload(handle.message, handle.recipient_id)
+
+    def _run(self):
+        while True:
+            handle = self._jobs.get()
+            if handle is None:
+                break
+            if handle.state == "cancelled":
+                continue
+
+            try:
+                block = handle.block
+                if block is None:
+                    data, encryption_key = handle.payload.result()
+                    block = self.node._build_block(data, encryption_key, handle.recipient_id, handle.message_type,
+                                                   handle.file_data, handle.file_name, handle.expiration_seconds)
+                handle.set_state("mining")
+                handle.block = self.node._mine_and_append(block)
+                self.node._publish_block(handle.block)
+                handle.set_state("broadcast")
+                handle.future.set_result(handle.block)
+            except Exception as e:
+                logger.error(f"Failed to send message: {e}")
+                handle.error = e
+                handle.set_state("failed")
+                handle.future.set_exception(e)
+
+    def stop(self):
+        if self._thread is not None:
+            self._jobs.put(None)
+            self._thread.join(timeout=2)
+            self._thread = None
+        self._encrypt_executor.shutdown(wait=False)
+
+
+class SignatureCache:
+    """LRU set of block hashes whose signatures have already verified
+
+    A block relayed by several neighbours costs one verification. Only successes are
+    cached, so a copy with a forged signature cannot poison the genuine block.
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._hashes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, block_hash: str) -> bool:
+        with self._lock:
+            if block_hash in self._hashes:
+                self._hashes.move_to_end(block_hash)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, block_hash: str):
+        with self._lock:
+            self._hashes[block_hash] = True
+            self._hashes.move_to_end(block_hash)
+            while len(self._hashes) > self.max_entries:
+                self._hashes.popitem(last=False)
+
+
+class SeenCache:
+    """Bounded LRU set of block hashes already received"""
+
+    def __init__(self, max_entries: int = 8192):
+        self.max_entries = max_entries
+        self._hashes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, block_hash: bytes) -> bool:
+        with self._lock:
+            return block_hash in self._hashes
+
+    def check_and_add(self, block_hash: bytes) -> bool:
+        """Record block_hash; returns True if it had been seen before"""
+        with self._lock:
+            if block_hash in self._hashes:
+                self._hashes.move_to_end(block_hash)
+                return True
+            self._hashes[block_hash] = True
+            while len(self._hashes) > self.max_entries:
+                self._hashes.popitem(last=False)
+            return False
+
+
+class MeshRelay:
+    """Forwards received blocks so they hop between devices until delivered
+
+    Blocks travel in an envelope carrying the hops they have left. Each node forwards
+    a newly accepted block to up to fanout randomly chosen neighbours (never back to
+    the one it came from) with one hop less, and drops copies of blocks already on its
+    chain before parsing them. A block only counts as seen once it connects, so a copy
+    lost to a full inbound queue or an evicted orphan can still arrive again. Only peers that advertised relay support in the key
+    exchange get envelopes; others receive plain blocks and are never relayed to.
+    """
+
+    def __init__(self, node: 'BLENode', ttl: int = 7, fanout: int = 3, max_seen: int = 8192):
+        if not 0 < ttl <= 255:
+            raise ValueError("Relay TTL must be between 1 and 255")
+        self.node = node
+        self.ttl = ttl
+        self.fanout = fanout
+        self.seen = SeenCache(max_seen)
+        self.peers = set()  # Addresses that understand relay envelopes
+        self.relayed_count = 0
+        self.duplicate_count = 0
+        self.expired_count = 0
+
+    @staticmethod
+    def wrap(block_hash: str, ttl: int, data: bytes) -> bytes:
+        return RELAY_HEADER.pack(RELAY_MAGIC, ttl, bytes.fromhex(block_hash)) + data
+
+    @staticmethod
+    def unwrap(data: bytes) -> Tuple[int, bytes, bytes]:
+        """Returns (ttl, raw block hash, encoded block)"""
+        _, ttl, block_hash = RELAY_HEADER.unpack_from(data)
+        return ttl, block_hash, data[RELAY_HEADER.size:]
+
+    def is_duplicate(self, data: bytes) -> bool:
+        """Check a complete inbound message before it is queued for parsing"""
+        if data[:1] != RELAY_MAGIC or len(data) < RELAY_HEADER.size:
+            return False
+        if data[2:RELAY_HEADER.size] in self.seen:
+            self.duplicate_count += 1
+            return True
+        return False
+
+    def mark_seen(self, block: Block):
+        self.seen.check_and_add(bytes.fromhex(block.hash))
+
+    def targets(self, exclude: str = None) -> List[str]:
+        """Random subset of relay-capable neighbours to forward to"""
+        # Runs on the inbound writer thread while the event loop adds and drops links;
+        # list() copies the keys in one step so iteration never sees the dict resize
+        candidates = [address for address in list(self.node.peer_links)
+                      if address in self.peers and address != exclude]
+        return random.sample(candidates, min(self.fanout, len(candidates)))
+
+    def forward(self, block: Block, ttl: int, source: str):
+        """Pass on a block received with ttl hops left"""
+        if ttl <= 1 or (block.expiration_time and block.expiration_time < time.time()):
+            self.expired_count += 1
+            return
+        targets = self.targets(exclude=source)
+        if targets and self.node.loop:
+            self.relayed_count += len(targets)
+            asyncio.run_coroutine_threadsafe(self.node._broadcast_data(block, ttl - 1, targets), self.node.loop)
+
+    def forget(self, address: str):
+        self.peers.discard(address)
+
+    def metrics(self) -> Dict[str, int]:
+        return {
+            "relayed": self.relayed_count,
+            "duplicate": self.duplicate_count,
+            "expired": self.expired_count,
+            "peers": len(self.peers)
+        }
+
+
+class InboundPipeline:
+    """Staged processing for received messages
+
+    The notification handler only reassembles frames. Parsing, hash checks and
+    decryption run on a bounded thread pool; a single writer thread then validates
+    chain linkage and applies results strictly in arrival order, which keeps every
+    sender's messages in order.
+    """
+
+    def __init__(self, node: 'BLENode', workers: int = 2, max_pending: int = 256):
+        self.node = node
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='inbound-decode')
+        self._ordered = queue.Queue(maxsize=max_pending)  # (address, client, future) in arrival order
+        self._decoding = 0
+        self._thread = None
+        self._lock = threading.Lock()
+        self.received_count = 0
+        self.dropped_count = 0
+        self.applied_count = 0
+        self.failed_count = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='inbound-apply', daemon=True)
+            self._thread.start()
+
+    def submit(self, address: str, client, data: bytes) -> bool:
+        """Queue a complete message; drops it if the pipeline is full"""
+        self.received_count += 1
+        if self._ordered.full():
+            self.dropped_count += 1
+            return False
+        with self._lock:
+            self._decoding += 1
+        future = self._executor.submit(self._decode, data)
+        self._ordered.put_nowait((address, client, future))
+        self.start()
+        return True
+
+    def _decode(self, data: bytes) -> tuple:
+        try:
+            return self.node._decode_inbound(data)
+        finally:
+            with self._lock:
+                self._decoding -= 1
+
+    def _run(self):
+        while True:
+            item = self._ordered.get()
+            if item is None:
+                break
+            address, client, future = item
+            try:
+                self.node._apply_inbound(address, client, future.result())
+                self.applied_count += 1
+            except Exception as e:
+                self.failed_count += 1
+                logger.error(f"InboundPipeline: error processing notification: {e}")
+
+    def metrics(self) -> Dict[str, int]:
+        """Queue depths and counters"""
+        return {
+            "decoding": self._decoding,
+            "queued": self._ordered.qsize(),
+            "received": self.received_count,
+            "dropped": self.dropped_count,
+            "applied": self.applied_count,
+            "failed": self.failed_count
+        }
+
+    def stop(self):
+        if self._thread is not None:
+            self._ordered.put(None)
+            self._thread.join(timeout=2)
+            self._thread = None
+        self._executor.shutdown(wait=False)
+
+
+class PeerLink:
+    """Bounded outbound queue and writer task for one connected peer
+
+    Broadcasts only enqueue, so a slow peer never delays delivery to the others.
+    When the queue is full, "drop-oldest" discards the oldest message and "block"
+    makes the sender wait (up to write_timeout). Drops and failed or timed-out writes
+    count as strikes; successful writes clear them. A peer is demoted to a short queue
+    after demote_after strikes, gets its full queue back on its next successful write,
+    and is disconnected after disconnect_after.
+    """
+
+    def __init__(self, node: 'BLENode', address: str, client, max_queue: int = 64, policy: str = "drop-oldest",
+                 write_timeout: float = 10.0, demote_after: int = 5, disconnect_after: int = 20,
+                 demoted_queue: int = 4):
+        if policy not in ("drop-oldest", "block"):
+            raise ValueError(f"Unknown backpressure policy {policy}")
+        self.node = node
+        self.address = address
+        self.client = client
+        self.policy = policy
+        self.write_timeout = write_timeout
+        self.demote_after = demote_after
+        self.disconnect_after = disconnect_after
+        self.demoted_queue = demoted_queue
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self._space = asyncio.Condition()  # Notified whenever the writer frees a slot
+        self.demoted = False
+        self.strikes = 0
+        self.sent_count = 0
+        self.dropped_count = 0
+        self.failed_count = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _capacity(self) -> int:
+        return min(self.queue.maxsize, self.demoted_queue) if self.demoted else self.queue.maxsize
+
+    async def send(self, data: bytes, wait: bool = False):
+        """Queue data for this peer according to the backpressure policy
+
+        wait makes this call wait for space whatever the policy, e.g. for sync traffic
+        where a dropped message would stall the transfer.
+        """
+        if self.policy == "block" or wait:
+            try:
+                await asyncio.wait_for(self._wait_for_space(), self.write_timeout)
+            except asyncio.TimeoutError:
+                self.dropped_count += 1
+                self._strike()
+                return
+        else:
+            while self.queue.qsize() >= self._capacity():
+                self.queue.get_nowait()
+                self.dropped_count += 1
+                self._strike()
+        self.queue.put_nowait(data)
+
+    async def _wait_for_space(self):
+        async with self._space:
+            await self._space.wait_for(lambda: self.queue.qsize() < self._capacity())
+
+    async def _run(self):
+        while True:
+            data = await self.queue.get()
+            async with self._space:
+                self._space.notify_all()
+            try:
+                await asyncio.wait_for(self.node._write(self.client, data), self.write_timeout)
+                self.sent_count += 1
+                self.strikes = 0
+                if self.demoted:
+                    logger.info(f"Restoring peer {self.address}")
+                    self.demoted = False
+                    async with self._space:
+                        self._space.notify_all()
+                self.node.connections.touch(self.address)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"PeerLink: error writing to {self.address}: {e}")
+                self.failed_count += 1
+                self._strike()
+
+    def _strike(self):
+        self.strikes += 1
+        if self.strikes >= self.disconnect_after:
+            logger.warning(f"Disconnecting slow peer {self.address}")
+            asyncio.ensure_future(self.node._drop_peer(self.address))
+        elif self.strikes >= self.demote_after and not self.demoted:
+            logger.warning(f"Demoting slow peer {self.address}")
+            self.demoted = True
+
+
+class PeerSyncState:
+    """What we know about one peer's chain while catching up from it"""
+
+    def __init__(self, height: int, tip_hash: str):
+        self.height = height
+        self.tip_hash = tip_hash
+        self.headers: Dict[int, str] = {}  # height: hash of verified headers whose bodies we still need
+        self.header_height = -1  # Highest verified header
+        self.header_hash = None
+        self.headers_requested = False
+        self.requested_height = -1  # Highest body requested so far
+        self.received_height = -1  # Highest requested body connected to our chain or a side branch
+        self.requested_at = 0.0  # When the outstanding request went out, or last made progress
+        self.diverged = False
+
+    @property
+    def waiting(self) -> bool:
+        """A get_headers or get_blocks to this peer is still unanswered"""
+        return self.headers_requested or self.requested_height > self.received_height
+
+
+class ChainSync:
+    """Header-first catch-up between peers
+
+    On connect both sides send sync_status with their tip height and hash. A node that
+    is behind sends get_headers with a locator of its own block hashes; the peer replies
+    with headers following the highest block they share. Headers are checked for linkage
+    and proof of work before any body is requested, then bodies are fetched with
+    get_blocks, keeping up to max_in_flight batches outstanding. Bodies take the normal
+    inbound path; when the peer's chain forks from ours they build a side branch, which
+    replaces our blocks once it carries more work. Progress is our own chain, so a sync
+    cut short by a disconnect resumes from the new tip on the next connection.
+
+    A request that goes unanswered for request_timeout (a lost frame is enough) is asked
+    again, of another peer that is ahead of us if there is one. Every status_interval each
+    peer is sent our sync_status again, so a node that missed a block still learns of it.
+    """
+
+    MESSAGES = ("sync_status", "get_headers", "headers", "get_blocks")
+
+    def __init__(self, node: 'BLENode', headers_per_request: int = 200, batch_size: int = 16,
+                 max_in_flight: int = 2, request_timeout: float = 5.0, status_interval: float = 30.0):
+        if batch_size < 1 or max_in_flight < 1 or headers_per_request < 1:
+            raise ValueError("Sync batch sizes must be positive")
+        self.node = node
+        self.headers_per_request = headers_per_request
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.request_timeout = request_timeout
+        self.status_interval = status_interval
+        self.peers: Dict[str, PeerSyncState] = {}
+        self._lock = threading.RLock()  # Messages arrive on the inbound writer thread, timeouts on the event loop
+        self._task = None
+        self.timeout_count = 0
+
+    def start(self):
+        """Start the request watchdog; call on the event loop"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._watch())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def status_message(self) -> dict:
+        tip = self.node.blockchain.get_latest_block()
+        return {"type": "sync_status", "height": tip.index, "hash": tip.hash}
+
+    def locator(self) -> List[list]:
+        """[height, hash] pairs from our tip back to genesis, dense near the tip then doubling"""
+        chain = self.node.blockchain.chain
+        locator = []
+        height, step = len(chain) - 1, 1
+        while height > 0:
+            locator.append([height, chain[height].hash])
+            if len(locator) >= 10:
+                step *= 2
+            height -= step
+        locator.append([0, chain[0].hash])
+        return locator
+
+    def handle(self, address: str, message: dict):
+        """Dispatch one sync message; runs on the inbound writer thread"""
+        handler = {
+            "sync_status": self._on_status,
+            "get_headers": self._on_get_headers,
+            "headers": self._on_headers,
+            "get_blocks": self._on_get_blocks,
+        }.get(message.get("type"))
+        try:
+            with self._lock:
+                handler(address, message)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"ChainSync: malformed {message.get('type')} from {address}: {e}")
+
+    def forget(self, address: str):
+        with self._lock:
+            self.peers.pop(address, None)
+
+    def behind(self, state: PeerSyncState) -> bool:
+        """Whether the peer's chain wins over ours, by the same rule as ForkChoice"""
+        blockchain = self.node.blockchain
+        tip = blockchain.get_latest_block()
+        work, tip_work = blockchain.cumulative_work(state.height), blockchain.cumulative_work(tip.index)
+        return work > tip_work or (work == tip_work and state.tip_hash < tip.hash)
+
+    def _on_status(self, address: str, message: dict):
+        height, tip_hash = int(message["height"]), message["hash"]
+        state = self.peers.get(address)
+        if state is None:
+            state = self.peers[address] = PeerSyncState(height, tip_hash)
+        else:
+            # Repeated while we are still fetching from this peer; keep what is in flight
+            state.height, state.tip_hash = height, tip_hash
+        if self.behind(state) and not state.waiting and not state.diverged:
+            self._request_headers(address, state, self.locator())
+
+    def _request_headers(self, address: str, state: PeerSyncState, locator: List[list]):
+        state.headers_requested = True
+        state.requested_at = time.time()
+        self.node.send_control(address, {"type": "get_headers", "locator": locator,
+                                         "count": self.headers_per_request})
+
+    def _on_get_headers(self, address: str, message: dict):
+        chain = self.node.blockchain.chain
+        # Locator entries run from high to low, so the first match is the most recent shared block
+        ancestor = 0
+        for height, block_hash in message["locator"]:
+            if 0 <= height < len(chain) and chain[height].hash == block_hash:
+                ancestor = height
+                break
+        count = min(int(message.get("count", self.headers_per_request)), self.headers_per_request)
+        end = min(len(chain), ancestor + 1 + count)
+        self.node.send_control(address, {
+            "type": "headers",
+            "ancestor": ancestor,
+            "hash": chain[ancestor].hash,
+            "headers": [chain[height].header() for height in range(ancestor + 1, end)],
+        })
+
+    def _on_headers(self, address: str, message: dict):
+        state = self.peers.get(address)
+        if state is None:
+            return
+        state.headers_requested = False
+        chain = self.node.blockchain.chain
+        ancestor, ancestor_hash = int(message["ancestor"]), message["hash"]
+        if ancestor == state.header_height and ancestor_hash == state.header_hash:
+            pass  # Continuation of headers we already hold
+        elif ancestor < len(chain) and chain[ancestor].hash == ancestor_hash:
+            if len(chain) - 1 - ancestor > self.node.forks.max_depth:
+                # Too deep to reorganize to; the branch would never be accepted
+                state.diverged = True
+                logger.info(f"ChainSync: {address} diverged from our chain after height {ancestor}")
+                return
+            state.headers.clear()
+            state.requested_height = state.received_height = ancestor
+        else:
+            logger.warning(f"ChainSync: headers from {address} don't connect to a known block")
+            return
+
+        previous_height, previous_hash = ancestor, ancestor_hash
+        for index, timestamp, previous, payload_hash, nonce in message["headers"]:
+            block_hash = header_hash(index, timestamp, previous, payload_hash, nonce)
+            if (index != previous_height + 1 or previous != previous_hash
+                    or not self.node.blockchain.meets_difficulty(index, block_hash)):
+                logger.warning(f"ChainSync: invalid header {index} from {address}")
+                break
+            state.headers[index] = block_hash
+            previous_height, previous_hash = index, block_hash
+        state.header_height, state.header_hash = previous_height, previous_hash
+        self._request_bodies(address, state)
+
+    def _on_get_blocks(self, address: str, message: dict):
+        chain = self.node.blockchain.chain
+        start = max(int(message["start"]), 1)
+        count = min(int(message["count"]), self.batch_size * self.max_in_flight)
+        with self.node.chain_lock:
+            blocks = [chain[height] for height in range(start, min(start + count, len(chain)))]
+        self.node.send_blocks(address, blocks)
+
+    def _request_bodies(self, address: str, state: PeerSyncState):
+        start = state.requested_height + 1
+        # Request another batch whenever fewer than max_in_flight are outstanding
+        while (start <= state.header_height
+               and state.requested_height - state.received_height <= self.batch_size * (self.max_in_flight - 1)):
+            count = min(self.batch_size, state.header_height - start + 1)
+            self.node.send_control(address, {"type": "get_blocks", "start": start, "count": count})
+            state.requested_height = start + count - 1
+            state.requested_at = time.time()
+            start += count
+        # Top up headers before bodies run out
+        if (not state.headers_requested and state.header_height < state.height
+                and state.header_height - state.received_height < self.headers_per_request // 2):
+            self._request_headers(address, state, [[state.header_height, state.header_hash]])
+
+    def on_orphan(self, address: str, block: Block):
+        """Ask the peer that sent a block we can't attach for the blocks leading up to it"""
+        with self._lock:
+            state = self.peers.get(address)
+            if state is None:
+                state = self.peers[address] = PeerSyncState(block.index, block.hash)
+            elif block.index > state.height:
+                state.height, state.tip_hash = block.index, block.hash
+            # A sync already under way brings the parent along
+            if state.waiting or state.diverged:
+                return
+            self._request_headers(address, state, self.locator())
+
+    def on_block_connected(self, block: Block):
+        """Advance every peer whose headers include block once it joins our chain or a side branch"""
+        with self._lock:
+            self._advance(block)
+
+    def _advance(self, block: Block):
+        for address, state in list(self.peers.items()):
+            if state.headers.get(block.index) != block.hash:
+                continue
+            del state.headers[block.index]
+            state.received_height = max(state.received_height, block.index)
+            state.requested_at = time.time()
+            if state.received_height == state.requested_height:
+                # Every body asked for is in: move the verified watermark past the batch, so a
+                # restart doesn't check it again
+                first_invalid = self.node.blockchain.validate_chain()
+                if first_invalid is not None:
+                    logger.error(f"ChainSync: chain invalid from height {first_invalid} after a batch from {address}")
+            self._request_bodies(address, state)
+
+    def expire_requests(self, now: float = None):
+        """Give up on requests unanswered for request_timeout and ask again, of another peer if one is ahead"""
+        now = time.time() if now is None else now
+        with self._lock:
+            for address, state in list(self.peers.items()):
+                if not state.waiting or now - state.requested_at <= self.request_timeout:
+                    continue
+                self.timeout_count += 1
+                logger.info(f"ChainSync: no answer from {address}, asking again")
+                state.headers_requested = False
+                state.requested_height = state.received_height
+                source = self._next_source(address)
+                if source is None:
+                    continue
+                retry = self.peers[source]
+                if source == address and state.header_height > state.received_height:
+                    self._request_bodies(address, state)
+                else:
+                    self._request_headers(source, retry, self.locator())
+
+    def _next_source(self, stalled: str) -> Optional[str]:
+        """Another linked peer ahead of us with nothing in flight, else stalled itself while it is linked"""
+        for address, state in self.peers.items():
+            if (address != stalled and address in self.node.peer_links and not state.waiting
+                    and not state.diverged and self.behind(state)):
+                return address
+        return stalled if stalled in self.node.peer_links else None
+
+    async def _watch(self):
+        announced_at = time.time()
+        while True:
+            await asyncio.sleep(self.request_timeout / 2)
+            now = time.time()
+            self.expire_requests(now)
+            if now - announced_at >= self.status_interval:
+                announced_at = now
+                status = self.status_message()
+                for address in list(self.node.peer_links):
+                    self.node.send_control(address, status)
+
+
+class FileManifest:
+    """What a manifest block promises: file name, size, chunk size and per-chunk digests
+
+    The file id is derived from the chunk digests, so it names the content, not the sender.
+    """
+
+    def __init__(self, name: str, size: int, chunk_size: int, chunk_hashes: List[str], sha256: str):
+        if chunk_size < 1 or size < 0 or len(chunk_hashes) != -(-size // chunk_size):
+            raise ValueError("Inconsistent file manifest")
+        self.name = name
+        self.size = size
+        self.chunk_size = chunk_size
+        self.chunk_hashes = chunk_hashes
+        self.sha256 = sha256  # Digest of the whole file, checked once the last chunk is in
+        self.file_id = hashlib.sha256(f"{size}:{chunk_size}:{''.join(chunk_hashes)}".encode('utf-8')).hexdigest()
+
+    @property
+    def chunk_count(self) -> int:
+        return len(self.chunk_hashes)
+
+    def chunk_length(self, index: int) -> int:
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def to_file_data(self) -> str:
+        return MANIFEST_PREFIX + json.dumps({
+            "name": self.name,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "chunks": self.chunk_hashes,
+            "sha256": self.sha256,
+        }, separators=(',', ':'))
+
+    @staticmethod
+    def from_file_data(file_data: Optional[str]) -> Optional['FileManifest']:
+        """The manifest in a block's file_data, or None for inline attachments and plain messages"""
+        if not file_data or not file_data.startswith(MANIFEST_PREFIX):
+            return None
+        data = json.loads(file_data[len(MANIFEST_PREFIX):])
+        return FileManifest(data["name"], int(data["size"]), int(data["chunk_size"]), data["chunks"], data["sha256"])
+
+    @staticmethod
+    def from_path(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE, name: str = None) -> 'FileManifest':
+        """Hash a file chunk by chunk; only one chunk is in memory at a time"""
+        chunk_hashes = []
+        whole = hashlib.sha256()
+        size = 0
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                chunk_hashes.append(hashlib.sha256(chunk).hexdigest())
+                whole.update(chunk)
+                size += len(chunk)
+        return FileManifest(name or os.path.basename(path), size, chunk_size, chunk_hashes, whole.hexdigest())
+
+
+def pack_chunk(file_id: str, index: int, data: bytes) -> bytes:
+    return CHUNK_HEADER.pack(CHUNK_MAGIC, bytes.fromhex(file_id), index) + data
+
+
+def unpack_chunk(data: bytes) -> Tuple[str, int, bytes]:
+    """Returns: (file id, chunk index, chunk bytes)"""
+    magic, file_id, index = CHUNK_HEADER.unpack_from(data)
+    if magic != CHUNK_MAGIC:
+        raise ValueError("Not a file chunk")
+    return file_id.hex(), index, data[CHUNK_HEADER.size:]
+
+
+class IncomingTransfer:
+    """A download in progress: chunks land in a .part file, confirmed ones are listed in a .json beside it"""
+
+    def __init__(self, manifest: FileManifest, part_path: str, received: bytearray = None):
+        self.manifest = manifest
+        self.part_path = part_path
+        self.state_path = part_path[:-len('.part')] + '.json'
+        self.received = received if received is not None else bytearray(manifest.chunk_count)  # 1 per confirmed chunk
+        self.received_count = sum(self.received)
+        self.requested: Dict[int, float] = {}  # chunk index: when it was requested from source
+        self.source = None  # Address we are downloading from
+        self.tried = set()  # Sources that stalled or sent bad chunks
+        self.last_progress = time.time()
+
+    @property
+    def complete(self) -> bool:
+        return self.received_count == self.manifest.chunk_count
+
+    def missing(self, limit: int) -> List[int]:
+        indexes = []
+        for index, have in enumerate(self.received):
+            if not have and index not in self.requested:
+                indexes.append(index)
+                if len(indexes) >= limit:
+                    break
+        return indexes
+
+    def save(self, fsync: bool):
+        with open(self.state_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({"manifest": self.manifest.to_file_data(),
+                       "received": base64.b64encode(bytes(self.received)).decode('ascii')}, f)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    @staticmethod
+    def load(state_path: str) -> 'IncomingTransfer':
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        manifest = FileManifest.from_file_data(state["manifest"])
+        received = bytearray(base64.b64decode(state["received"]))
+        return IncomingTransfer(manifest, state_path[:-len('.json')] + '.part', received)
+
+
+class BlobStore:
+    """Content-addressed attachment files, one copy per SHA-256 digest
+
+    Blobs live at <digest[:2]>/<digest> under directory and are never rewritten, so a
+    file that is sent, forwarded or received again is stored once. Every block that
+    carries a blob holds one reference (its hash); expired or reorged-out blocks
+    release theirs, and collect_garbage() deletes blobs nobody has referenced for grace
+    seconds. Blobs of mmap_threshold bytes or more are read through a memory map, so
+    serving a chunk is a slice of the page cache rather than an open, seek and read.
+
+    Reference changes are appended to refs.log, one JSON line each, and folded into the
+    refs.json snapshot every compact_after changes and on close.
+    """
+
+    def __init__(self, directory: str, grace: float = 3600.0, mmap_threshold: int = 256 * 1024,
+                 max_maps: int = 8, fsync: bool = True, compact_after: int = 1000):
+        self.directory = directory
+        self.grace = grace  # Newly stored files wait this long for the block that references them
+        self.mmap_threshold = mmap_threshold
+        self.max_maps = max_maps
+        self.fsync = fsync
+        self.compact_after = compact_after
+        self._refs: Dict[str, set] = {}  # digest: hashes of the blocks that carry it
+        self._released: Dict[str, float] = {}  # digest: when its last reference went
+        self._maps = OrderedDict()  # digest: (file, mmap), least recently read first
+        self._lock = threading.RLock()
+        self._index_path = os.path.join(directory, "refs.json")
+        self._journal_path = os.path.join(directory, "refs.log")
+        self._journal = None
+        self._journal_records = 0
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self._index_path, 'r', encoding='utf-8') as f:
+                self._refs = {digest: set(holders) for digest, holders in json.load(f).items()}
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError, AttributeError) as e:
+            logger.warning(f"BlobStore: ignoring unreadable reference index: {e}")
+        self._replay()
+
+    def _replay(self):
+        """Apply the changes logged since the last snapshot, then fold them into it"""
+        try:
+            with open(self._journal_path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                op, *args = json.loads(line)
+            except ValueError:
+                continue  # A line cut short by a crash; its change was never acknowledged
+            if op == "add":
+                digest, holder = args
+                self._refs.setdefault(digest, set()).add(holder)
+            elif op == "release":
+                for digest, refs in list(self._refs.items()):
+                    refs -= set(args[0])
+                    if not refs:
+                        del self._refs[digest]
+        self._compact()
+
+    def path(self, digest: str) -> str:
+        if len(digest) != 64 or not all(c in '0123456789abcdef' for c in digest):
+            raise ValueError(f"Not a SHA-256 digest: {digest!r}")
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def has(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def put_file(self, path: str) -> str:
+        """Copy a file into the store, hashing it on the way; returns its digest"""
+        os.makedirs(self.directory, exist_ok=True)
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with open(path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+                for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                    digest.update(chunk)
+                    dst.write(chunk)
+                dst.flush()
+                if self.fsync:
+                    os.fsync(dst.fileno())
+            return self.adopt(tmp_path, digest.hexdigest())
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def adopt(self, path: str, digest: str) -> str:
+        """Move a file whose digest the caller has already checked into the store"""
+        target = self.path(digest)
+        with self._lock:
+            if os.path.exists(target):
+                os.remove(path)  # Already stored; keep the existing copy
+                os.utime(target)  # Restart its grace period
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(path, target)
+        return digest
+
+    def read(self, digest: str, offset: int = 0, length: int = None) -> bytes:
+        with self._lock:
+            entry = self._maps.get(digest)
+            if entry is not None:
+                self._maps.move_to_end(digest)
+                data = entry[1]
+                return data[offset:len(data) if length is None else offset + length]
+            path = self.path(digest)
+            size = os.path.getsize(path)
+            if size < self.mmap_threshold:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    return f.read(size - offset if length is None else length)
+            f = open(path, 'rb')
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[digest] = (f, data)
+            while len(self._maps) > self.max_maps:
+                self._close_map(next(iter(self._maps)))
+            return data[offset:size if length is None else offset + length]
+
+    def _close_map(self, digest: str):
+        f, data = self._maps.pop(digest)
+        data.close()
+        f.close()
+
+    def add_ref(self, digest: str, holder: str):
+        with self._lock:
+            holders = self._refs.setdefault(digest, set())
+            if holder not in holders:
+                holders.add(holder)
+                self._released.pop(digest, None)
+                self._log(["add", digest, holder])
+
+    def release(self, holders) -> List[str]:
+        """Drop the references of the given blocks; returns digests nothing refers to any more"""
+        holders = set(holders)
+        now = time.time()
+        unreferenced = []
+        released = set()
+        with self._lock:
+            for digest, refs in list(self._refs.items()):
+                if refs & holders:
+                    released |= refs & holders
+                    refs -= holders
+                    if not refs:
+                        del self._refs[digest]
+                        self._released[digest] = now
+                        unreferenced.append(digest)
+            if released:
+                self._log(["release", sorted(released)])
+        return unreferenced
+
+    def refcount(self, digest: str) -> int:
+        return len(self._refs.get(digest, ()))
+
+    def _log(self, record: list):
+        """Append one reference change; call with _lock held"""
+        if self._journal is None:
+            self._journal = open(self._journal_path, 'a', encoding='utf-8')
+        self._journal.write(json.dumps(record) + '\n')
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+        self._journal_records += 1
+        if self._journal_records >= self.compact_after:
+            self._compact()
+
+    def _compact(self):
+        """Write the snapshot and start an empty log; call with _lock held or before the store is shared"""
+        with open(self._index_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({digest: sorted(holders) for digest, holders in self._refs.items()}, f)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(self._index_path + '.tmp', self._index_path)
+        # A crash before the log is gone replays it onto the new snapshot, which changes nothing
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if os.path.exists(self._journal_path):
+            os.remove(self._journal_path)
+        self._journal_records = 0
+
+    def collect_garbage(self, now: float = None) -> List[str]:
+        """Delete blobs without references whose grace period is over; returns their digests"""
+        now = time.time() if now is None else now
+        due = []
+        with self._lock:
+            for name in os.listdir(self.directory):
+                folder = os.path.join(self.directory, name)
+                if name.endswith('.tmp'):
+                    if now - os.path.getmtime(folder) > self.grace:
+                        os.remove(folder)  # Left by a copy that crashed
+                    continue
+                if len(name) != 2 or not os.path.isdir(folder):
+                    continue
+                for digest in os.listdir(folder):
+                    if digest in self._refs:
+                        continue
+                    since = max(os.path.getmtime(os.path.join(folder, digest)), self._released.get(digest, 0))
+                    if now - since >= self.grace:
+                        due.append(digest)
+            return self.remove(due)
+
+    def remove(self, digests) -> List[str]:
+        """Delete the given blobs now unless something references them; returns the ones deleted"""
+        removed = []
+        with self._lock:
+            for digest in digests:
+                if digest in self._refs:
+                    continue
+                if digest in self._maps:
+                    self._close_map(digest)
+                try:
+                    os.remove(self.path(digest))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"BlobStore: can't remove {digest}: {e}")
+                    continue
+                self._released.pop(digest, None)
+                removed.append(digest)
+        if removed:
+            logger.info(f"BlobStore: removed {len(removed)} unreferenced blobs")
+        return removed
+
+    def close(self):
+        with self._lock:
+            while self._maps:
+                self._close_map(next(iter(self._maps)))
+            if self._journal is not None:
+                self._compact()
+
+
+class FileTransfers:
+    """Chunked, resumable attachment transfer between peers
+
+    Sharing a file mines only a small manifest block (name, size and a SHA-256 per
+    chunk); the file goes into the BlobStore and is served as chunk frames on request. A receiver
+    pulls chunks from the peer that delivered the manifest, keeping up to window
+    requests in flight. Each chunk is checked against its digest, written at its offset
+    in a .part file and acked once that progress is saved, so after a reconnect or a
+    restart only unconfirmed chunks are asked for again. A download that stalls for
+    stall_timeout moves to another connected peer. Any node holding the complete file
+    serves it, so attachments of broadcast messages spread through the mesh along with
+    their blocks. Chunks are not encrypted, so the attachment of a direct message is only
+    kept by its sender and fetched by its recipient; relays carry just the manifest
+    block. A file whose digest is already in the store is never fetched again.
+    """
+
+    MESSAGES = ("file_request", "file_ack")
+
+    def __init__(self, node: 'BLENode', directory: str, blobs: BlobStore = None, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 window: int = 4, stall_timeout: float = 15.0, auto_download_bytes: int = 8 * 1024 * 1024,
+                 gc_interval: float = 600.0, fsync: bool = True):
+        if chunk_size < 1 or window < 1:
+            raise ValueError("Chunk size and window must be positive")
+        self.node = node
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.window = window
+        self.stall_timeout = stall_timeout
+        self.auto_download_bytes = auto_download_bytes  # Larger files wait for download()
+        self.gc_interval = gc_interval
+        self.fsync = fsync
+        self.blobs = blobs if blobs is not None else BlobStore(os.path.join(directory, "blobs"), fsync=fsync)
+        self.progress_callback = None  # callback(file_id, chunks done, chunk count, path once complete)
+        self.shared: Dict[str, FileManifest] = {}  # file id: manifest of files in the blob store
+        self.known: Dict[str, Tuple[FileManifest, str]] = {}  # file id: (manifest, address) seen but not fetched
+        self.incoming: Dict[str, IncomingTransfer] = {}
+        self.acked: Dict[Tuple[str, str], set] = {}  # (address, file id): chunks the peer confirmed
+        self._lock = threading.RLock()
+        self._task = None
+        self._partial_dir = os.path.join(directory, "partial")
+        os.makedirs(self._partial_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.directory, "manifests.json"), 'r', encoding='utf-8') as f:
+                for file_id, file_data in json.load(f).items():
+                    manifest = FileManifest.from_file_data(file_data)
+                    if self.blobs.has(manifest.sha256):
+                        self.shared[file_id] = manifest
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"FileTransfers: ignoring unreadable shared file index: {e}")
+        for name in os.listdir(self._partial_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                transfer = IncomingTransfer.load(os.path.join(self._partial_dir, name))
+                self.incoming[transfer.manifest.file_id] = transfer
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.warning(f"FileTransfers: dropping unreadable partial download {name}: {e}")
+
+    def _save_shared(self):
+        path = os.path.join(self.directory, "manifests.json")
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({file_id: manifest.to_file_data() for file_id, manifest in self.shared.items()}, f)
+        os.replace(path + '.tmp', path)
+
+    def start(self):
+        """Start the stall watchdog; call on the event loop"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._watch())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.blobs.close()
+
+    def share(self, path: str) -> FileManifest:
+        """Copy a file into the blob store and start serving it; the caller sends the manifest in a block"""
+        digest = self.blobs.put_file(path)
+        manifest = FileManifest.from_path(self.blobs.path(digest), self.chunk_size, os.path.basename(path))
+        with self._lock:
+            self.shared[manifest.file_id] = manifest
+            self._save_shared()
+        return manifest
+
+    def local_path(self, file_id: str) -> Optional[str]:
+        """Where a complete copy of the file is, if we have one"""
+        manifest = self.shared.get(file_id)
+        return self.blobs.path(manifest.sha256) if manifest else None
+
+    def progress(self, file_id: str) -> Tuple[int, int]:
+        """(chunks confirmed, chunk count) of a download; complete files report all chunks"""
+        with self._lock:
+            if file_id in self.shared:
+                count = self.shared[file_id].chunk_count
+                return count, count
+            transfer = self.incoming.get(file_id)
+            if transfer is not None:
+                return transfer.received_count, transfer.manifest.chunk_count
+            manifest = self.known.get(file_id, (None,))[0]
+            return 0, manifest.chunk_count if manifest else 0
+
+    def on_block(self, block: Block, address: Optional[str]):
+        """Reference the attachment of a newly connected manifest block and start fetching it
+
+        address is None for blocks we mined ourselves.
+        """
+        try:
+            manifest = FileManifest.from_file_data(block.file_data)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"FileTransfers: bad manifest in block {block.hash}: {e}")
+            return
+        if manifest is None:
+            return
+        if block.recipient_id not in (None, self.node.device_id) and block.sender_id != self.node.device_id:
+            return  # Someone else's direct message: relay the block, not the file
+        self.blobs.add_ref(manifest.sha256, block.hash)
+        with self._lock:
+            if manifest.file_id in self.shared or manifest.file_id in self.incoming or self._deduplicate(manifest):
+                return
+            self.known[manifest.file_id] = (manifest, address)
+        if manifest.size <= self.auto_download_bytes:
+            self.download(manifest.file_id)
+
+    def _deduplicate(self, manifest: FileManifest) -> bool:
+        """Serve a file straight from the store if its content arrived under another manifest"""
+        if not self.blobs.has(manifest.sha256):
+            return False
+        self.shared[manifest.file_id] = manifest
+        self._save_shared()
+        if self.progress_callback:
+            self.progress_callback(manifest.file_id, manifest.chunk_count, manifest.chunk_count,
+                                   self.blobs.path(manifest.sha256))
+        return True
+
+    def release(self, block_hashes, expired: bool = False):
+        """Drop the references of blocks that left the chain
+
+        Blobs of expired messages are deleted straight away, along with their downloads;
+        blocks lost to a reorg usually come back, so theirs wait for garbage collection.
+        """
+        unreferenced = set(self.blobs.release(block_hashes))
+        if not unreferenced or not expired:
+            return
+        with self._lock:
+            for file_id, transfer in list(self.incoming.items()):
+                if transfer.manifest.sha256 in unreferenced:
+                    del self.incoming[file_id]
+                    for path in (transfer.part_path, transfer.state_path):
+                        if os.path.exists(path):
+                            os.remove(path)
+            for file_id, (manifest, _) in list(self.known.items()):
+                if manifest.sha256 in unreferenced:
+                    del self.known[file_id]
+            self._drop_blobs(self.blobs.remove(unreferenced))
+
+    def _drop_blobs(self, digests: List[str]):
+        digests = set(digests)
+        dropped = [file_id for file_id, manifest in self.shared.items() if manifest.sha256 in digests]
+        for file_id in dropped:
+            del self.shared[file_id]
+        if dropped:
+            self._save_shared()
+
+    def download(self, file_id: str) -> bool:
+        """Fetch a file announced by a manifest block; False if we never saw its manifest"""
+        with self._lock:
+            if file_id in self.shared or file_id in self.incoming:
+                return True
+            if file_id not in self.known:
+                return False
+            manifest, address = self.known.pop(file_id)
+            if self._deduplicate(manifest):
+                return True
+            part_path = os.path.join(self._partial_dir, file_id + '.part')
+            with open(part_path, 'wb') as f:
+                f.truncate(manifest.size)
+            transfer = self.incoming[file_id] = IncomingTransfer(manifest, part_path)
+            transfer.save(self.fsync)
+            if transfer.complete:  # Empty file
+                self._finish(transfer)
+                return True
+            self._set_source(transfer, address if address in self.node.peer_links else None)
+        return True
+
+    def on_peer_connected(self, address: str):
+        """Resume downloads that have no source on a new link"""
+        with self._lock:
+            for transfer in list(self.incoming.values()):
+                if transfer.source is None:
+                    self._set_source(transfer, address)
+
+    def forget(self, address: str):
+        with self._lock:
+            for transfer in self.incoming.values():
+                if transfer.source == address:
+                    transfer.source = None
+                    transfer.requested.clear()
+
+    def _set_source(self, transfer: IncomingTransfer, address: Optional[str]):
+        transfer.source = address
+        transfer.requested.clear()
+        transfer.last_progress = time.time()
+        if address is not None:
+            self._request_more(transfer)
+
+    def _request_more(self, transfer: IncomingTransfer):
+        indexes = transfer.missing(self.window - len(transfer.requested))
+        if not indexes or transfer.source is None:
+            return
+        now = time.time()
+        for index in indexes:
+            transfer.requested[index] = now
+        self.node.send_control(transfer.source, {"type": "file_request", "file_id": transfer.manifest.file_id,
+                                                 "chunks": indexes})
+
+    def handle(self, address: str, message: dict):
+        """Dispatch one transfer message; runs on the inbound writer thread"""
+        handler = {
+            "file_request": self._on_request,
+            "file_ack": self._on_ack,
+        }.get(message.get("type"))
+        try:
+            handler(address, message)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"FileTransfers: malformed {message.get('type')} from {address}: {e}")
+
+    def _on_request(self, address: str, message: dict):
+        with self._lock:
+            manifest = self.shared.get(message["file_id"])
+            transfer = self.incoming.get(message["file_id"])
+            if manifest is None and transfer is None:
+                return  # Not ours to serve; the receiver's watchdog moves on to another peer
+            indexes = [int(index) for index in message["chunks"][:self.window]]
+            if manifest is None:
+                manifest = transfer.manifest
+            for index in indexes:
+                if not 0 <= index < manifest.chunk_count:
+                    raise ValueError(f"chunk {index} out of range")
+            # At most one window of chunks is read and held for the peer's queue
+            if transfer is None:
+                chunks = [pack_chunk(manifest.file_id, index, self.blobs.read(
+                    manifest.sha256, index * manifest.chunk_size, manifest.chunk_length(index))) for index in indexes]
+            else:
+                # A download in progress serves the chunks it already has, so relays pass files on as they arrive
+                chunks = []
+                with open(transfer.part_path, 'rb') as f:
+                    for index in indexes:
+                        if transfer.received[index]:
+                            f.seek(index * manifest.chunk_size)
+                            chunks.append(pack_chunk(manifest.file_id, index, f.read(manifest.chunk_length(index))))
+        self.node.send_raw(address, chunks)
+
+    def _on_ack(self, address: str, message: dict):
+        with self._lock:
+            self.acked.setdefault((address, message["file_id"]), set()).update(int(i) for i in message["chunks"])
+
+    def upload_progress(self, file_id: str) -> int:
+        """Most chunks any one peer has confirmed for a file we serve"""
+        with self._lock:
+            return max([len(chunks) for (_, acked_id), chunks in self.acked.items() if acked_id == file_id],
+                       default=0)
+
+    def on_chunk(self, address: str, file_id: str, index: int, data: bytes):
+        """Check, store and ack one chunk; runs on the inbound writer thread"""
+        with self._lock:
+            transfer = self.incoming.get(file_id)
+            if transfer is None or not 0 <= index < transfer.manifest.chunk_count or transfer.received[index]:
+                return
+            manifest = transfer.manifest
+            transfer.requested.pop(index, None)
+            if len(data) != manifest.chunk_length(index) or hashlib.sha256(data).hexdigest() != manifest.chunk_hashes[index]:
+                logger.warning(f"FileTransfers: chunk {index} of {file_id} from {address} failed its digest check")
+                transfer.tried.add(address)
+                self._set_source(transfer, self._next_source(transfer))
+                return
+            with open(transfer.part_path, 'r+b') as f:
+                f.seek(index * manifest.chunk_size)
+                f.write(data)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            transfer.received[index] = 1
+            transfer.received_count += 1
+            transfer.last_progress = time.time()
+            transfer.save(self.fsync)
+            # Acked only once saved, so the sender's count never runs ahead of what survives a restart
+            self.node.send_control(address, {"type": "file_ack", "file_id": file_id, "chunks": [index]})
+            if transfer.complete:
+                self._finish(transfer)
+                return
+            if address == transfer.source:
+                self._request_more(transfer)
+        if self.progress_callback:
+            self.progress_callback(file_id, transfer.received_count, manifest.chunk_count, None)
+
+    def _finish(self, transfer: IncomingTransfer):
+        manifest = transfer.manifest
+        digest = hashlib.sha256()
+        with open(transfer.part_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(manifest.chunk_size), b''):
+                digest.update(chunk)
+        del self.incoming[manifest.file_id]
+        if digest.hexdigest() != manifest.sha256:
+            # Every chunk matched its digest, so the manifest itself is inconsistent
+            logger.error(f"FileTransfers: {manifest.name} does not match its manifest, discarding it")
+            os.remove(transfer.part_path)
+            os.remove(transfer.state_path)
+            return
+        self.blobs.adopt(transfer.part_path, manifest.sha256)
+        os.remove(transfer.state_path)
+        self.shared[manifest.file_id] = manifest
+        self._save_shared()
+        path = self.blobs.path(manifest.sha256)
+        logger.info(f"FileTransfers: received {manifest.name} ({manifest.size} bytes)")
+        if self.progress_callback:
+            self.progress_callback(manifest.file_id, manifest.chunk_count, manifest.chunk_count, path)
+
+    def _next_source(self, transfer: IncomingTransfer) -> Optional[str]:
+        linked = list(self.node.peer_links)
+        candidates = [address for address in linked if address not in transfer.tried]
+        if not candidates:
+            # Everyone has had a go; start over rather than give up on a mesh that may have changed
+            transfer.tried.clear()
+            candidates = linked
+        return candidates[0] if candidates else None
+
+    async def _watch(self):
+        collected_at = time.time()
+        while True:
+            await asyncio.sleep(self.stall_timeout / 2)
+            now = time.time()
+            if now - collected_at >= self.gc_interval:
+                collected_at = now
+                with self._lock:
+                    self._drop_blobs(self.blobs.collect_garbage(now))
+            with self._lock:
+                for transfer in list(self.incoming.values()):
+                    # Ask again for chunks the source skipped, e.g. ones a relay didn't have yet
+                    expired = [index for index, at in transfer.requested.items() if now - at > self.stall_timeout / 2]
+                    for index in expired:
+                        del transfer.requested[index]
+                    if transfer.source is None:
+                        self._set_source(transfer, self._next_source(transfer))
+                    elif now - transfer.last_progress > self.stall_timeout:
+                        logger.info(f"FileTransfers: {transfer.manifest.name} stalled on {transfer.source}")
+                        transfer.tried.add(transfer.source)
+                        self._set_source(transfer, self._next_source(transfer))
+                    elif expired:
+                        self._request_more(transfer)
+
+
+class Transport(abc.ABC):
+    """Where a node gets its links and its scanner from; BLENode only talks to these two objects"""
+
+    @abc.abstractmethod
+    def create_client(self, address: str, disconnected_callback=None):
+        """Return an unconnected client with connect/disconnect/start_notify/write_gatt_char"""
+
+    @abc.abstractmethod
+    def create_scanner(self, detection_callback):
+        """Return a scanner with start/stop that reports (device, advertisement_data)"""
+
+    def attach(self, node: 'BLENode'):
+        """Called once the node is built; transports that accept links keep it to deliver them"""
+
+
+class BleakTransport(Transport):
+    # Bleak is imported on first use; it is slow to import and simulated nodes never need it
+    def create_client(self, address: str, disconnected_callback=None):
+        from bleak import BleakClient
+        return BleakClient(address, disconnected_callback=disconnected_callback)
+
+    def create_scanner(self, detection_callback):
+        from bleak import BleakScanner
+        return BleakScanner(detection_callback=detection_callback)
+
+
+class DiscoveredDevice:
+    def __init__(self, address: str, name: str, rssi: Optional[float], seen_at: float):
+        self.address = address
+        self.name = name
+        self.rssi = rssi  # Smoothed signal strength in dBm
+        self.first_seen = seen_at
+        self.last_seen = seen_at
+        self.seen_count = 1
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "address": self.address,
+            "rssi": None if self.rssi is None else round(self.rssi),
+            "last_seen": self.last_seen
+        }
+
+
+class DeviceScanner:
+    """Background BLE discovery feeding a cache of nearby devices
+
+    Advertisements arrive through a detection callback while the scanner runs, so
+    readers get the current cache immediately instead of waiting out a scan. RSSI is
+    smoothed with an exponential moving average. Devices not heard from for max_age
+    seconds are dropped, as are the least recently seen beyond max_devices. The duty
+    cycle alternates scan and pause windows; shorter pauses find devices sooner at the
+    cost of battery.
+    """
+
+    DUTY_CYCLES = {
+        "low_power": (2.0, 18.0),  # (seconds scanning, seconds paused)
+        "balanced": (5.0, 10.0),
+        "low_latency": (10.0, 0.0),
+    }
+
+    def __init__(self, name_prefix: str, transport: 'Transport' = None, mode: str = "balanced",
+                 rssi_alpha: float = 0.3, max_age: float = 60.0, max_devices: int = 128):
+        self.name_prefix = name_prefix
+        self.transport = transport or BleakTransport()
+        self.rssi_alpha = rssi_alpha
+        self.max_age = max_age
+        self.max_devices = max_devices
+        self.set_mode(mode)
+        self.change_callback = None  # Called when a device appears or ages out; runs on the event loop
+        self._devices = OrderedDict()  # address: DiscoveredDevice, least recently seen first
+        self._lock = threading.Lock()
+        self._task = None
+
+    def set_mode(self, mode: str):
+        if mode not in self.DUTY_CYCLES:
+            raise ValueError(f"Unknown scan mode {mode}")
+        self.mode = mode
+        self.scan_seconds, self.pause_seconds = self.DUTY_CYCLES[mode]
+
+    def start(self):
+        """Start scanning; call on the event loop"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        try:
+            scanner = self.transport.create_scanner(self._on_detection)
+        except Exception as e:
+            logger.error(f"DeviceScanner: can't scan: {e}")
+            return
+        while True:
+            try:
+                await scanner.start()
+                try:
+                    await asyncio.sleep(self.scan_seconds)
+                finally:
+                    await scanner.stop()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"DeviceScanner: scan failed: {e}")
+            self.age()
+            # Always yield for a moment so a zero pause can't starve the loop
+            await asyncio.sleep(max(self.pause_seconds, 0.1))
+
+    def _on_detection(self, device, advertisement_data):
+        name = device.name or getattr(advertisement_data, 'local_name', None)
+        if not name or not name.startswith(self.name_prefix):
+            return
+        rssi = getattr(advertisement_data, 'rssi', None)
+        if rssi is None:
+            rssi = getattr(device, 'rssi', None)
+        self.observe(device.address, name, rssi)
+
+    def observe(self, address: str, name: str, rssi: Optional[float], seen_at: float = None):
+        seen_at = seen_at or time.time()
+        with self._lock:
+            entry = self._devices.get(address)
+            is_new = entry is None
+            if is_new:
+                entry = self._devices[address] = DiscoveredDevice(address, name, rssi, seen_at)
+            else:
+                entry.name = name
+                entry.last_seen = seen_at
+                entry.seen_count += 1
+                if rssi is not None:
+                    entry.rssi = rssi if entry.rssi is None else \
+                        self.rssi_alpha * rssi + (1 - self.rssi_alpha) * entry.rssi
+                self._devices.move_to_end(address)
+            while len(self._devices) > self.max_devices:
+                self._devices.popitem(last=False)
+        if is_new and self.change_callback:
+            self.change_callback()
+
+    def age(self, now: float = None) -> int:
+        """Drop devices not seen for max_age seconds"""
+        cutoff = (now or time.time()) - self.max_age
+        removed = 0
+        with self._lock:
+            for address in [address for address, entry in self._devices.items() if entry.last_seen < cutoff]:
+                del self._devices[address]
+                removed += 1
+        if removed and self.change_callback:
+            self.change_callback()
+        return removed
+
+    def devices(self) -> List[dict]:
+        """Nearby devices, strongest signal first"""
+        cutoff = time.time() - self.max_age
+        with self._lock:
+            entries = [entry for entry in self._devices.values() if entry.last_seen >= cutoff]
+        entries.sort(key=lambda entry: entry.rssi if entry.rssi is not None else -1000, reverse=True)
+        return [entry.to_dict() for entry in entries]
+
+
+class PeerConnection:
+    """Connection state of one peer the ConnectionManager looks after"""
+
+    def __init__(self, address: str):
+        self.address = address
+        self.state = "idle"  # connecting, connected, disconnected, backoff, evicted, failed
+        self.wanted = True  # Reconnect after drops; cleared by explicit disconnects and evictions
+        self.attempts = 0  # Failed connects since the last success
+        self.last_activity = 0.0
+        self.reconnect_handle = None
+
+
+class ConnectionManager:
+    """Opens and keeps up links to peers
+
+    Connects run concurrently, at most max_parallel at a time, and at most
+    max_connections links are held; when full, the least useful link is evicted
+    (anything before favourites, then the longest idle). Dropped links are noticed
+    through Bleak's disconnect callback and a periodic health check, then retried
+    with exponential backoff and jitter. Every state change is reported through the
+    node's device_list_callback(address, state).
+    """
+
+    def __init__(self, node: 'BLENode', max_connections: int = 7, max_parallel: int = 3,
+                 health_interval: float = 10.0, connect_timeout: float = 20.0,
+                 backoff_base: float = 1.0, backoff_max: float = 120.0):
+        self.node = node
+        self.max_connections = max_connections
+        self.max_parallel = max_parallel
+        self.health_interval = health_interval
+        self.connect_timeout = connect_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.peers: Dict[str, PeerConnection] = {}
+        self._semaphore = None
+        self._health_task = None
+        self._stopped = False
+
+    def start(self):
+        """Start health checks; call on the event loop"""
+        self._stopped = False
+        if self._health_task is None:
+            self._health_task = asyncio.ensure_future(self._health_loop())
+
+    def stop(self):
+        self._stopped = True
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        for peer in self.peers.values():
+            if peer.reconnect_handle is not None:
+                peer.reconnect_handle.cancel()
+                peer.reconnect_handle = None
+
+    async def connect(self, address: str) -> bool:
+        peer = self.peers.get(address)
+        if peer is None:
+            peer = self.peers[address] = PeerConnection(address)
+        peer.wanted = True
+        if address in self.node.connected_devices:
+            return True
+        if peer.state == "connecting":
+            return False
+        if len(self.node.connected_devices) >= self.max_connections and not await self._evict_for(address):
+            self._set_state(peer, "failed")
+            return False
+
+        self._set_state(peer, "connecting")
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_parallel)
+        async with self._semaphore:
+            try:
+                connected = await asyncio.wait_for(
+                    self.node._open_link(address, self._on_client_disconnected), self.connect_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"ConnectionManager: timed out connecting to {address}")
+                connected = False
+
+        if connected:
+            peer.attempts = 0
+            peer.last_activity = time.time()
+            self._set_state(peer, "connected")
+        else:
+            self._schedule_reconnect(peer)
+        return connected
+
+    async def connect_many(self, addresses: List[str]) -> List[bool]:
+        return await asyncio.gather(*(self.connect(address) for address in addresses))
+
+    async def disconnect(self, address: str):
+        """Close a link for good; it won't be reconnected"""
+        peer = self.peers.get(address)
+        if peer is not None:
+            peer.wanted = False
+            if peer.reconnect_handle is not None:
+                peer.reconnect_handle.cancel()
+                peer.reconnect_handle = None
+        await self.node._drop_peer(address)
+
+    def accepted(self, address: str):
+        """Track a link the peer opened; the peer is the one to reconnect it"""
+        peer = self.peers.get(address)
+        if peer is None:
+            peer = self.peers[address] = PeerConnection(address)
+            peer.wanted = False
+        peer.last_activity = time.time()
+        self._set_state(peer, "connected")
+
+    def touch(self, address: str):
+        """Record traffic on a link, so busy links are the last to be evicted"""
+        peer = self.peers.get(address)
+        if peer is not None:
+            peer.last_activity = time.time()
+
+    def on_dropped(self, address: str):
+        """Called by the node whenever a link goes away"""
+        peer = self.peers.get(address)
+        if peer is None:
+            self.node._emit_link_event(address, "disconnected")
+            return
+        if peer.state != "evicted":
+            self._set_state(peer, "disconnected")
+        self._schedule_reconnect(peer)
+
+    def _schedule_reconnect(self, peer: PeerConnection):
+        if not peer.wanted or self._stopped or not self.node.running:
+            if peer.state not in ("evicted", "disconnected"):
+                self._set_state(peer, "failed")
+            return
+        delay = min(self.backoff_max, self.backoff_base * 2 ** peer.attempts)
+        # Jitter spreads out peers that dropped together, e.g. when we walk out of range
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        peer.attempts += 1
+        self._set_state(peer, "backoff")
+        loop = asyncio.get_event_loop()
+        peer.reconnect_handle = loop.call_later(delay, lambda: asyncio.ensure_future(self._reconnect(peer.address)))
+
+    async def _reconnect(self, address: str):
+        peer = self.peers.get(address)
+        if peer is None:
+            return
+        peer.reconnect_handle = None
+        if peer.wanted and not self._stopped and address not in self.node.connected_devices:
+            await self.connect(address)
+
+    def _on_client_disconnected(self, client):
+        # Bleak calls this on the event loop when the link drops
+        if client.address in self.node.connected_devices:
+            asyncio.ensure_future(self.node._drop_peer(client.address))
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            for address, client in list(self.node.connected_devices.items()):
+                if not getattr(client, 'is_connected', True):
+                    logger.info(f"ConnectionManager: {address} failed its health check")
+                    await self.node._drop_peer(address)
+
+    def _usefulness(self, address: str) -> Tuple[bool, float]:
+        favorite = self.node.favorites.get(address, {}).get("is_favorite", False)
+        peer = self.peers.get(address)
+        return favorite, peer.last_activity if peer else 0.0
+
+    async def _evict_for(self, address: str) -> bool:
+        """Close the least useful link to make room; favourites are never evicted"""
+        candidates = [candidate for candidate in self.node.connected_devices if candidate != address]
+        if not candidates:
+            return False
+        victim = min(candidates, key=self._usefulness)
+        if self._usefulness(victim)[0]:
+            return False
+        peer = self.peers.get(victim)
+        if peer is not None:
+            peer.wanted = False
+            self._set_state(peer, "evicted")
+        await self.node._drop_peer(victim)
+        return True
+
+    def _set_state(self, peer: PeerConnection, state: str):
+        peer.state = state
+        self.node._emit_link_event(peer.address, state)
+
+
+def _mobile_platform() -> bool:
+    """Android or iOS, detected the way kivy.utils.platform does"""
+    return 'ANDROID_ARGUMENT' in os.environ or os.environ.get('KIVY_BUILD') in ('android', 'ios')
+
+
+class JsonFileStore:
+    """Small JSON key/value file; same file format as Kivy's JsonStore"""
+
+    def __init__(self, path: Optional[str]):
+        self.path = path  # None keeps the data in memory only
+        self._lock = threading.Lock()
+        self._data = {}
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self._data = json.load(f)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._data
+
+    def __getitem__(self, key: str):
+        return self._data[key]
+
+    def __setitem__(self, key: str, value):
+        with self._lock:
+            self._data[key] = value
+            if not self.path:
+                return
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(self._data, f)
+            os.replace(self.path + '.tmp', self.path)
+
+
+class BLENode:
+    def __init__(self, transport: Transport = None, data_dir: str = None, persist: bool = True):
+        """transport defaults to Bleak; data_dir holds this node's files (default: working directory);
+        persist=False keeps the chain, pending queue, identity and settings in memory, e.g. for
+        simulated nodes; only received files go to disk, under a temporary directory if data_dir is None
+        """
+        self.data_dir = data_dir
+        self.transport = transport or BleakTransport()
+        # Phones and tablets keep the single-threaded miner to save battery
+        miner = None
+        if (os.cpu_count() or 1) > 1 and not _mobile_platform():
+            miner = ProofOfWorkMiner()
+        if persist:
+            self.blockchain = Blockchain(miner=miner, store=ChainStore(self._path('blockchain_chat_chain')),
+                                         pending=PendingQueue(self._path('blockchain_chat_pending')))
+        else:
+            self.blockchain = Blockchain(miner=miner)
+        self.connected_devices: Dict[str, object] = {}  # address: client from the transport
+        self.peer_codecs: Dict[str, str] = {}  # address: wire codec agreed during key exchange
+        self.peer_devices: Dict[str, str] = {}  # address: device id announced in the key exchange
+        self.peer_links: Dict[str, PeerLink] = {}  # address: outbound queue and writer task
+        # contact id: (height, hash, key id) of our block announcing the current session to that contact
+        self._announcements: Dict[str, Tuple[int, str, str]] = {}
+        self.reassembler = FrameReassembler()
+        self._message_ids = itertools.count(1)
+        self.message_callback = None
+        self.device_list_callback = None
+        self.running = True
+        self.loop = None
+        self.thread = None
+        self.device_name = "BlockchainChat"
+        self.scanner = DeviceScanner(self.device_name, self.transport)
+        self.connections = ConnectionManager(self)
+        self.favorites = {}  # address: device info, kept by the app; favourites are never evicted
+        self.is_server = False  # Flag to indicate if this device is acting as server
+        self.persist = persist
+        self.store = JsonFileStore(self._saved('blockchain_chat.json'))  # Local storage
+        self.device_id = self._load_device_id()  # Unique device ID, stable across restarts
+        self.crypto_manager = CryptoManager(identity_path=self._saved('blockchain_chat_identity.json'),
+                                            sessions_path=self._saved('blockchain_chat_sessions.bin'))
+        self.groups = {}  # group_id: group_info
+        self.chain_lock = threading.RLock()  # Guards appends from the send pipeline and BLE callbacks
+        self.signature_cache = SignatureCache()
+        # Reject blocks from senders we have no key for; off by default, so their blocks are unauthenticated
+        self.require_signatures = False
+        self.send_pipeline = SendPipeline(self)
+        self.inbound_pipeline = InboundPipeline(self)
+        self.chain_sync = ChainSync(self)
+        files_dir = self._path('blockchain_chat_files')
+        if not persist and not data_dir:
+            files_dir = tempfile.mkdtemp(prefix="blockchain_chat_files_")
+        self.transfers = FileTransfers(self, files_dir)
+        self.relay = MeshRelay(self)
+        self.orphans = OrphanPool()
+        self.forks = ForkChoice(self.blockchain)
+        self.reorg_callback = None  # Called with blocks removed from the chain by a reorg
+        self.expired_callback = None  # Called with hashes of disappearing messages that expired
+        self.expiry = ExpiryScheduler(self.blockchain, self._on_expired, lock=self.chain_lock)
+        self.blockchain.expiry = self.expiry
+
+        # Load saved data
+        self._load_data()
+        self.transport.attach(self)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.data_dir, name) if self.data_dir else name
+
+    def _saved(self, name: str) -> Optional[str]:
+        """Path for a file that only a persistent node keeps"""
+        return self._path(name) if self.persist else None
+
+    def _load_device_id(self) -> str:
+        """Device ID generated on first launch and kept, so peers' contact tables stay valid"""
+        try:
+            if 'identity' in self.store:
+                return self.store['identity']['device_id']
+        except Exception as e:
+            logger.error(f"Error loading device ID: {e}")
+        device_id = str(uuid.uuid4())
+        try:
+            self.store['identity'] = {'device_id': device_id}
+        except Exception as e:
+            logger.error(f"Error saving device ID: {e}")
+        return device_id
+
+    def _load_data(self):
+        """Load saved data from local storage"""
+        try:
+            if 'contacts' in self.store:
+                for contact_id, keys in self.store['contacts'].items():
+                    # Older saves stored only the PEM
+                    if isinstance(keys, str):
+                        keys = {"public_key": keys}
+                    self.crypto_manager.add_contact(contact_id, keys["public_key"], keys.get("x25519"),
+                                                    keys.get("ed25519"))
+
+            if 'groups' in self.store:
+                self.groups = self.store['groups']
+        except Exception as e:
+            logger.error(f"Error loading data: {e}")
+
+    def _save_data(self):
+        """Save data to local storage"""
+        try:
+            self.store['contacts'] = {contact_id: self.crypto_manager.get_contact_keys(contact_id)
+                                      for contact_id in self.crypto_manager.contacts}
+            self.store['groups'] = self.groups
+        except Exception as e:
+            logger.error(f"Error saving data: {e}")
+
+    def start(self):
+        """Start the BLE node in a separate thread"""
+        self.thread = threading.Thread(target=self._run_async_loop, daemon=True)
+        self.thread.start()
+        self.expiry.start()
+        # Blocks stored since the last verified watermark, e.g. before a crash, are checked in the background
+        workers = self.blockchain.miner.workers if self.blockchain.miner is not None else None
+        threading.Thread(target=self.check_chain, args=(workers,), name='chain-check', daemon=True).start()
+
+    def check_chain(self, workers: int = None) -> bool:
+        """Validate blocks above the verified watermark, dropping everything from the first invalid one
+
+        A dropped tail is fetched again from peers by chain sync. workers > 1 validates long
+        spans on a process pool.
+        """
+        with self.chain_lock:
+            first_invalid = self.blockchain.validate_chain(workers=workers)
+            if first_invalid is None:
+                return True
+            logger.error(f"BLENode: stored chain is invalid from height {first_invalid}, "
+                         f"dropping {len(self.blockchain.chain) - first_invalid} blocks")
+            self.blockchain.truncate(first_invalid)
+            return False
+
+    def _on_expired(self, block_hashes):
+        self.transfers.release(block_hashes, expired=True)
+        if self.expired_callback:
+            self.expired_callback(block_hashes)
+
+    def _run_async_loop(self):
+        """Run the asyncio event loop in a separate thread"""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self.scanner.start)
+        self.loop.call_soon(self.connections.start)
+        self.loop.call_soon(self.transfers.start)
+        self.loop.call_soon(self.chain_sync.start)
+        self.loop.run_forever()
+
+    def validate_block(self, block: Block) -> bool:
+        """Validate a block before adding to blockchain"""
+        return self.extends_tip(block) and self.check_block_hashes(block)
+
+    def extends_tip(self, block: Block) -> bool:
+        """Whether block links directly onto the current tip"""
+        latest_block = self.blockchain.get_latest_block()
+        return block.index == latest_block.index + 1 and block.previous_hash == latest_block.hash
+
+    def check_block_hashes(self, block: Block) -> bool:
+        """Whether the body matches its digest and the header matches its hash"""
+        if block.payload_hash != block.calculate_payload_hash() and not block.is_pruned():
+            return False
+        if block.hash != block.calculate_hash():
+            return False
+        return self.blockchain.meets_difficulty(block.index, block.hash)
+
+    def check_block_signature(self, block: Block) -> bool:
+        """Whether block is signed by its sender_id
+
+        Blocks claiming to come from a known contact, or from us, must carry a valid signature.
+        Senders we have no key for can't be checked: unless require_signatures is set their
+        blocks pass unsigned or with any signature at all, so a sender_id we haven't exchanged
+        keys with proves nothing. Leaving it off lets a mesh relay blocks from devices that are
+        never in range of each other.
+        """
+        if block.hash in self.signature_cache:
+            return True
+        if block.sender_id == self.device_id:
+            ok = self.crypto_manager.verify_own_signature(block.payload_hash, block.signature)
+        elif block.sender_id in self.crypto_manager.contacts:
+            ok = self.crypto_manager.verify_signature(block.payload_hash, block.signature or '', block.sender_id)
+        else:
+            ok = not self.require_signatures
+        if ok and block.signature:
+            self.signature_cache.add(block.hash)
+        return ok
+
+    def _decode_inbound(self, data: bytes) -> tuple:
+        """Parse, check and decrypt one message; runs on the inbound worker pool
+        Returns: ("key_exchange", message), ("sync", message), ("file", message),
+        ("chunk", file_id, index, data), ("invalid", block)
+        or ("block", block, plaintext, ttl), where ttl is None for blocks that are not relayed
+        """
+        if data[:1] == CHUNK_MAGIC:
+            return ("chunk",) + unpack_chunk(data)
+        ttl = None
+        if data[:1] == RELAY_MAGIC:
+            ttl, _, data = MeshRelay.unwrap(data)
+        if data[:1] == WIRE_MAGIC:
+            block = Block.from_bytes(data)
+        else:
+            msg_data = json.loads(data.decode('utf-8'))
+            if msg_data.get("type") == "key_exchange":
+                return ("key_exchange", msg_data)
+            if msg_data.get("type") in ChainSync.MESSAGES:
+                return ("sync", msg_data)
+            if msg_data.get("type") in FileTransfers.MESSAGES:
+                return ("file", msg_data)
+            block = Block.from_dict(msg_data)
+
+        # Hashes are checked on the ciphertext, before anything is decrypted
+        if not self.check_block_hashes(block) or not self.check_block_signature(block):
+            return ("invalid", block)
+
+        plaintext = None
+        if block.encryption_key and block.recipient_id == self.device_id:
+            try:
+                plaintext = self.crypto_manager.decrypt_message(block.data, block.encryption_key, block.sender_id)
+            except Exception as e:
+                logger.error(f"Decryption failed: {e}")
+        return ("block", block, plaintext, ttl)
+
+    def _apply_inbound(self, address: str, client, result: tuple):
+        """Apply one decoded message; runs on the single inbound writer thread, in arrival order"""
+        kind = result[0]
+        if kind == "key_exchange":
+            msg_data = result[1]
+            # Add contact, with fast key types if the peer supports them
+            try:
+                self.crypto_manager.add_contact(msg_data["device_id"], msg_data["public_key"],
+                                                msg_data.get("x25519"), msg_data.get("ed25519"))
+            except ValueError as e:
+                # Someone else claiming a known device id; ignore the whole exchange
+                logger.warning(f"Refusing key exchange from {address}: {e}")
+                return
+            # Peers that predate the binary codec don't advertise any
+            if BINARY_CODEC in msg_data.get("codecs", []):
+                self.peer_codecs[address] = BINARY_CODEC
+            if msg_data.get("relay") == RELAY_VERSION:
+                self.relay.peers.add(address)
+            self.peer_devices[address] = msg_data["device_id"]
+            self._save_data()
+            self._deliver_pending(address)
+            self.transfers.on_peer_connected(address)
+            return
+        if kind == "sync":
+            self.chain_sync.handle(address, result[1])
+            return
+        if kind == "file":
+            self.transfers.handle(address, result[1])
+            return
+        if kind == "chunk":
+            self.transfers.on_chunk(address, *result[1:])
+            return
+        if kind != "block":
+            return
+
+        _, block, plaintext, ttl = result
+        with self.chain_lock:
+            connected, added, removed = self._connect_block(block, address, ttl)
+        if not connected:
+            return
+        # Orphans the block completed travel on too, each as it arrived
+        for connected_block, source, hops in connected:
+            self.relay.mark_seen(connected_block)
+            if hops is not None:
+                self.relay.forward(connected_block, hops, source)
+
+        if removed:
+            self.transfers.release(removed_block.hash for removed_block in removed)
+            if self.reorg_callback:
+                self.reorg_callback(removed)
+            # Our own messages on the losing branch are mined again on top of the new tip
+            added_hashes = {added_block.hash for added_block in added}
+            for removed_block in removed:
+                if removed_block.sender_id == self.device_id and removed_block.hash not in added_hashes:
+                    self.send_pipeline.resubmit(copy.copy(removed_block))
+        if self.message_callback:
+            for added_block in added:
+                self.message_callback(self.display_block(added_block, plaintext if added_block is block else None))
+        for added_block in added:
+            if added_block.file_data:
+                self.transfers.on_block(added_block, address)
+        self._note_acknowledgements(added)
+
+    def _connect_block(self, block: Block, source: str = None, ttl: int = None) \
+            -> Tuple[List[Tuple[Block, Optional[str], Optional[int]]], List[Block], List[Block]]:
+        """Attach a block to the main chain, a side branch or the orphan pool; call with chain_lock held
+
+        Orphans waiting on a newly connected block are connected after it. An orphan's
+        missing parent is requested from the peer that sent it.
+        Returns: ((block, source, ttl) for each block connected, block first if it connected,
+        blocks added to the main chain, blocks removed from it)
+        """
+        connected = []
+        added, removed = [], []
+        candidates = [(block, source, ttl)]
+        while candidates:
+            current, current_source, current_ttl = candidates.pop(0)
+            if current.hash in self.forks or self.forks.on_main_chain(current.index, current.hash):
+                continue  # Already have it
+            if self.extends_tip(current):
+                self.blockchain.add_block(current)
+                added.append(current)
+            elif self.forks.attaches(current):
+                branch = self.forks.add(current)
+                if branch:
+                    dropped = self._reorganize(branch)
+                    dropped_hashes = {dropped_block.hash for dropped_block in dropped}
+                    added_hashes = {added_block.hash for added_block in added}
+                    # Blocks added earlier in this call were never shown, so they aren't reported as removed
+                    removed += [dropped_block for dropped_block in dropped if dropped_block.hash not in added_hashes]
+                    added = [added_block for added_block in added if added_block.hash not in dropped_hashes] + branch
+            elif current is block:
+                self.orphans.add(current, source, ttl)
+                if source is not None:
+                    self.chain_sync.on_orphan(source, current)
+                continue
+            else:
+                continue
+            connected.append((current, current_source, current_ttl))
+            self.chain_sync.on_block_connected(current)
+            candidates.extend(self.orphans.pop_children(current.hash))
+        return connected, added, removed
+
+    def _reorganize(self, branch: List[Block]) -> List[Block]:
+        """Replace the main chain above the fork point with branch; returns the blocks taken off"""
+        fork_height = branch[0].index - 1
+        chain = self.blockchain.chain
+        dropped = [chain[height] for height in range(fork_height + 1, len(chain))]
+        self.blockchain.truncate(fork_height + 1)
+        for block in branch:
+            self.blockchain.add_block(block)
+        self.forks.switched(branch, dropped)
+        logger.info(f"BLENode: reorganized at height {fork_height}, "
+                    f"{len(dropped)} blocks replaced by {len(branch)}")
+        return dropped
+
+    def display_block(self, block: Block, plaintext: str = None) -> Block:
+        """Block for the UI, decrypted if it is addressed to us
+
+        The chain keeps blocks as received, since they are served to other peers during sync.
+        """
+        if plaintext is None and block.encryption_key and block.recipient_id == self.device_id:
+            try:
+                plaintext = self.crypto_manager.decrypt_message(block.data, block.encryption_key, block.sender_id)
+            except Exception as e:
+                logger.error(f"Decryption failed: {e}")
+        if plaintext is None:
+            return block
+        display = copy.copy(block)
+        display.data = plaintext
+        return display
+
+    def send_message(self, message: str, recipient_id: str = None, message_type: str = "text",
+                     file_data: str = None, file_name: str = None, expiration_seconds: int = None) -> Block:
+        """Send a message to all connected devices or specific recipient (blocks until mined)"""
+        data, encryption_key = self._encrypt_payload(message, recipient_id)
+        new_block = self._build_block(data, encryption_key, recipient_id, message_type,
+                                      file_data, file_name, expiration_seconds)
+        mined_block = self._mine_and_append(new_block)
+        self._publish_block(mined_block)
+        return mined_block
+
+    def send_message_async(self, message: str, recipient_id: str = None, message_type: str = "text",
+                           file_data: str = None, file_name: str = None,
+                           expiration_seconds: int = None) -> SendHandle:
+        """Queue a message for encryption, mining and broadcast; returns immediately"""
+        handle = SendHandle(message, recipient_id, message_type, file_data, file_name, expiration_seconds)
+        return self.send_pipeline.submit(handle)
+
+    def send_file(self, path: str, recipient_id: str = None, message: str = None,
+                  expiration_seconds: int = None) -> SendHandle:
+        """Share a file: only its manifest goes into a block, peers then fetch the chunks"""
+        manifest = self.transfers.share(path)
+        extension = os.path.splitext(path)[1].lower()
+        message_type = "image" if extension in IMAGE_EXTENSIONS else "file"
+        return self.send_message_async(message or manifest.name, recipient_id, message_type,
+                                       file_data=manifest.to_file_data(), file_name=manifest.name,
+                                       expiration_seconds=expiration_seconds)
+
+    def _encrypt_payload(self, message: str, recipient_id: str = None) -> Tuple[str, Optional[str]]:
+        """Encrypt message if recipient is specified
+        Returns: (data, encryption_key)
+        """
+        if recipient_id and recipient_id in self.crypto_manager.contacts:
+            try:
+                return self.crypto_manager.encrypt_message(message, recipient_id)
+            except Exception as e:
+                logger.error(f"Encryption failed: {e}")
+                # Send unencrypted if encryption fails
+        return message, None
+
+    def _build_block(self, data: str, encryption_key: Optional[str], recipient_id: str = None,
+                     message_type: str = "text", file_data: str = None, file_name: str = None,
+                     expiration_seconds: int = None) -> Block:
+        expiration_time = None
+        if expiration_seconds:
+            expiration_time = time.time() + expiration_seconds
+
+        latest_block = self.blockchain.get_latest_block()
+        block = Block(
+            latest_block.index + 1,
+            latest_block.hash,
+            datetime.now().timestamp(),
+            data,
+            sender_id=self.device_id,
+            recipient_id=recipient_id,
+            message_type=message_type,
+            file_data=file_data,
+            file_name=file_name,
+            encryption_key=encryption_key,
+            expiration_time=expiration_time
+        )
+        # The payload digest covers sender, recipient and body, and does not change while mining
+        block.signature = self.crypto_manager.sign_data(block.payload_hash)
+        return block
+
+    def _mine_and_append(self, block: Block) -> Block:
+        """Mine block on top of the current tip, re-mining if another block lands first"""
+        while True:
+            with self.chain_lock:
+                latest_block = self.blockchain.get_latest_block()
+                block.index = latest_block.index + 1
+                block.previous_hash = latest_block.hash
+                block.nonce = 0
+                block.hash = block.calculate_hash()
+
+            mined_block = self.blockchain.proof_of_work(block)
+
+            with self.chain_lock:
+                if self.blockchain.get_latest_block().hash == mined_block.previous_hash:
+                    self.blockchain.add_block(mined_block)
+                    return mined_block
+
+    def _publish_block(self, block: Block):
+        if block.file_data:
+            self.transfers.on_block(block, None)
+        if self.message_callback:
+            self.message_callback(block)
+
+        self._hold_for_recipient(block)
+        self._track_announcement(block)
+        self.broadcast_block(block)
+
+    def _track_announcement(self, block: Block):
+        """Remember the block that announced our current session to its recipient"""
+        if not block.recipient_id or not block.encryption_key:
+            return
+        parts = block.encryption_key.split(':', 2)
+        if parts[0] != SESSION_KEY_PREFIX or len(parts) < 3:
+            return
+        with self.chain_lock:
+            announced = self._announcements.get(block.recipient_id)
+            chain = self.blockchain.chain
+            # Keep the earliest announcement still on our chain; a reorg may have replaced it
+            if (announced is None or announced[2] != parts[1] or announced[0] >= len(chain)
+                    or chain[announced[0]].hash != announced[1]):
+                self._announcements[block.recipient_id] = (block.index, block.hash, parts[1])
+
+    def _note_acknowledgements(self, added: List[Block]):
+        """Stop announcing a session once its contact has built on the block that announced it
+
+        A contact's block above ours on the same chain was mined on top of it, so the contact
+        holds that block and, with it, the session key.
+        """
+        with self.chain_lock:
+            chain = self.blockchain.chain
+            for block in added:
+                announced = self._announcements.get(block.sender_id)
+                if announced is None:
+                    continue
+                height, block_hash, key_id = announced
+                if height < block.index and height < len(chain) and chain[height].hash == block_hash:
+                    self.crypto_manager.acknowledge(block.sender_id, key_id)
+                    del self._announcements[block.sender_id]
+
+    def _deliver_pending(self, address: str):
+        """Send a peer the direct messages held while it was out of range
+
+        Needs both its key exchange and its outbound queue, which come up in either order.
+        """
+        device_id = self.peer_devices.get(address)
+        if device_id is None or address not in self.peer_links:
+            return
+        pending = self.blockchain.pop_pending_blocks_for_recipient(device_id)
+        if pending:
+            self.send_blocks(address, pending)
+
+    def _hold_for_recipient(self, block: Block):
+        """Queue a direct message we sent for store-and-forward while its recipient isn't linked to us
+
+        Relays don't hold what they forward: the mesh already carries it, and only the sender
+        delivers it again when the recipient comes into range.
+        """
+        if not block.recipient_id or block.recipient_id == self.device_id:
+            return
+        if block.recipient_id not in list(self.peer_devices.values()):
+            self.blockchain.add_pending_block(block)
+
+    def broadcast_block(self, block: Block):
+        """Broadcast a block to all connected devices"""
+        if not self.loop:
+            return
+
+        # Our own echoes come back from the mesh; drop them like any other duplicate
+        self.relay.mark_seen(block)
+        # Schedule the broadcast in the asyncio loop
+        asyncio.run_coroutine_threadsafe(self._broadcast_data(block, self.relay.ttl), self.loop)
+
+    def _encode_block(self, block: Block, address: str, encoded: Dict[str, bytes] = None) -> bytes:
+        """Encode a block with the codec negotiated with a peer; encoded caches one copy per codec"""
+        codec = self.peer_codecs.get(address, JSON_CODEC)
+        if encoded is not None and codec in encoded:
+            return encoded[codec]
+        data = block.to_bytes() if codec == BINARY_CODEC else block.to_json().encode('utf-8')
+        if encoded is not None:
+            encoded[codec] = data
+        return data
+
+    async def _write(self, client, data: bytes):
+        """Write data to a peer, fragmented to fit its negotiated MTU"""
+        message_id = next(self._message_ids) & 0xFFFFFFFF
+        for frame in fragment_message(data, getattr(client, 'mtu_size', DEFAULT_MTU), message_id):
+            await client.write_gatt_char(RX_CHAR_UUID, frame)
+
+    async def _broadcast_data(self, block: Block, ttl: int, addresses: List[str] = None):
+        """Send a block to the given peers (default: all), in a relay envelope where supported"""
+        encoded = {}
+        links = [(address, self.peer_links.get(address)) for address in addresses] \
+            if addresses is not None else list(self.peer_links.items())
+        sends = []
+        for address, link in links:
+            if link is None:
+                continue
+            data = self._encode_block(block, address, encoded)
+            if address in self.relay.peers:
+                data = MeshRelay.wrap(block.hash, ttl, data)
+            sends.append(link.send(data))
+        # Each peer's writer task drains its own queue, so peers are served concurrently
+        await asyncio.gather(*sends)
+
+    def send_control(self, address: str, message: dict):
+        """Queue a JSON control message for one peer; safe to call from any thread"""
+        link = self.peer_links.get(address)
+        if link is None or not self.loop:
+            return
+        data = json.dumps(message).encode('utf-8')
+        asyncio.run_coroutine_threadsafe(link.send(data, wait=True), self.loop)
+
+    def send_blocks(self, address: str, blocks: List[Block]):
+        """Queue blocks for one peer in order, waiting for queue space rather than dropping"""
+        if address not in self.peer_links or not self.loop:
+            return
+        encoded = [self._encode_block(block, address) for block in blocks]
+        asyncio.run_coroutine_threadsafe(self._send_all(address, encoded), self.loop)
+
+    def send_raw(self, address: str, messages: List[bytes]):
+        """Queue already encoded messages for one peer in order, e.g. file chunks; safe to call from any thread"""
+        if address not in self.peer_links or not self.loop:
+            return
+        asyncio.run_coroutine_threadsafe(self._send_all(address, messages), self.loop)
+
+    async def _send_all(self, address: str, messages: List[bytes]):
+        link = self.peer_links.get(address)
+        for data in messages:
+            if self.peer_links.get(address) is not link:
+                return  # Disconnected; the peer resumes from its tip when it reconnects
+            await link.send(data, wait=True)
+
+    async def _drop_peer(self, address: str):
+        """Disconnect a peer and forget its per-connection state"""
+        if address not in self.connected_devices and address not in self.peer_links:
+            return  # Already dropped, e.g. by both the disconnect callback and a health check
+        link = self.peer_links.pop(address, None)
+        if link:
+            link.stop()
+        client = self.connected_devices.pop(address, None)
+        self.peer_codecs.pop(address, None)
+        self.peer_devices.pop(address, None)
+        self.reassembler.forget(address)
+        self.chain_sync.forget(address)
+        self.relay.forget(address)
+        self.transfers.forget(address)
+        if client:
+            try:
+                await client.disconnect()
+            except Exception as e:
+                logger.warning(f"Error disconnecting {address}: {e}")
+        self.connections.on_dropped(address)
+
+    async def scan_devices(self) -> List[dict]:
+        """Nearby BLE devices from the background scanner's cache"""
+        return self.scanner.devices()
+
+    async def connect_to_device(self, address: str) -> bool:
+        """Connect to a BLE device, reconnecting automatically if the link drops"""
+        return await self.connections.connect(address)
+
+    def _emit_link_event(self, address: str, state: str):
+        if self.device_list_callback:
+            self.device_list_callback(address, state)
+
+    def _key_exchange_message(self) -> bytes:
+        return json.dumps({
+            "type": "key_exchange",
+            "device_id": self.device_id,
+            "public_key": self.crypto_manager.get_public_key_pem(),
+            "codecs": [BINARY_CODEC, JSON_CODEC],
+            "relay": RELAY_VERSION,
+            **self.crypto_manager.get_fast_public_keys()
+        }).encode('utf-8')
+
+    def _on_frame(self, address: str, client, data: bytes):
+        """Handle one frame from a peer; runs on the event loop, so only reassemble here"""
+        try:
+            self.connections.touch(address)
+            data = self.reassembler.feed(address, bytes(data))
+            if data is not None and not self.relay.is_duplicate(data):
+                self.inbound_pipeline.submit(address, client, data)
+        except Exception as e:
+            logger.error(f"Error processing notification from {address}: {e}")
+
+    async def _start_link(self, address: str, client):
+        """Start the peer's outbound queue once keys are on their way"""
+        # Everything after the handshake goes through the peer's outbound queue
+        link = PeerLink(self, address, client)
+        self.peer_links[address] = link
+        link.start()
+        self._deliver_pending(address)
+
+        # Advertise our tip; whichever side is behind starts a header-first sync
+        await link.send(json.dumps(self.chain_sync.status_message()).encode('utf-8'), wait=True)
+
+    async def _accept_link(self, address: str, client):
+        """A peer connected to us; transports that can accept connections call this on our loop"""
+        self.connected_devices[address] = client
+        self.connections.accepted(address)
+        await self._write(client, self._key_exchange_message())
+        await self._start_link(address, client)
+
+    async def _open_link(self, address: str, disconnected_callback=None) -> bool:
+        """Connect, exchange keys and start the peer's outbound queue"""
+        try:
+            client = self.transport.create_client(address, disconnected_callback)
+            await client.connect()
+
+            # Store the client
+            self.connected_devices[address] = client
+
+            # Exchange public keys
+            await self._write(client, self._key_exchange_message())
+
+            # Subscribe to the TX characteristic
+            await client.start_notify(TX_CHAR_UUID, lambda characteristic, data: self._on_frame(address, client, data))
+
+            await self._start_link(address, client)
+            return True
+        except Exception as e:
+            logger.error(f"Error connecting to device {address}: {e}")
+            # Undo a half-finished handshake, so a retry starts clean
+            client = self.connected_devices.pop(address, None)
+            link = self.peer_links.pop(address, None)
+            if link:
+                link.stop()
+            if client:
+                try:
+                    await client.disconnect()
+                except Exception:
+                    pass
+            return False
+
+    async def _send_block_to_client(self, client, block):
+        """Helper method to send a block to a client"""
+        try:
+            link = self.peer_links.get(client.address)
+            if link:
+                await link.send(self._encode_block(block, client.address))
+            else:
+                await self._write(client, self._encode_block(block, client.address))
+        except Exception as e:
+            logger.error(f"Error sending block to {client.address}: {e}")
+
+    def stop(self):
+        """Stop the BLE node"""
+        self.running = False
+        self.send_pipeline.stop()
+        self.inbound_pipeline.stop()
+        self.expiry.stop()
+        if self.loop and self.thread:
+            stopped = asyncio.run_coroutine_threadsafe(self._stop_server(), self.loop)
+            try:
+                stopped.result(timeout=2)
+            except Exception as e:
+                logger.warning(f"BLENode: clean shutdown failed: {e}")
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=2)
+        if self.blockchain.miner:
+            self.blockchain.miner.shutdown()
+        if isinstance(self.blockchain.chain, ChainStore):
+            self.blockchain.chain.close()
+
+    async def _stop_server(self):
+        """Stop the BLE server"""
+        self.scanner.stop()
+        self.connections.stop()
+        self.transfers.stop()
+        self.chain_sync.stop()
+        # Disconnect all clients
+        for link in self.peer_links.values():
+            link.stop()
+        self.peer_links.clear()
+        for address, client in list(self.connected_devices.items()):
+            try:
+                await client.disconnect()
+            except:
+                pass
+            self.reassembler.forget(address)
+        self.connected_devices.clear()
+        self.peer_codecs.clear()
+
+
+class LoopbackAdvertisement:
+    def __init__(self, address: str, name: str, rssi: float):
+        self.address = address
+        self.name = name
+        self.local_name = name
+        self.rssi = rssi
+
+
+class LoopbackClient:
+    """One end of a simulated link; the node at the other end holds the mirror endpoint"""
+
+    def __init__(self, mesh: 'LoopbackMesh', node: 'BLENode', local_address: str, address: str,
+                 disconnected_callback=None):
+        self.mesh = mesh
+        self.node = node  # The node this endpoint belongs to
+        self.local_address = local_address
+        self.address = address  # The node at the other end
+        self.mtu_size = mesh.mtu
+        self.is_connected = False
+        self.peer: Optional['LoopbackClient'] = None
+        self._disconnected_callback = disconnected_callback
+        self._notify_handler = None
+        self._next_delivery = 0.0  # Frames on one link arrive in order, as over GATT
+
+    async def connect(self):
+        await self.mesh.open(self)
+
+    async def disconnect(self):
+        self.mesh.close(self)
+
+    async def start_notify(self, uuid, handler):
+        self._notify_handler = handler
+
+    async def write_gatt_char(self, uuid, data):
+        self.mesh.transmit(self, bytes(data))
+        await asyncio.sleep(0)
+
+    def deliver(self, data: bytes):
+        if not self.is_connected:
+            return
+        if self._notify_handler is not None:
+            self._notify_handler(None, bytearray(data))
+        else:
+            # Links the peer opened have no subscription; their frames go straight to the node
+            self.node._on_frame(self.address, self, data)
+
+    def remote_closed(self):
+        self.is_connected = False
+        if self._disconnected_callback:
+            self._disconnected_callback(self)
+
+
+class LoopbackScanner:
+    def __init__(self, mesh: 'LoopbackMesh', address: str, detection_callback):
+        self.mesh = mesh
+        self.address = address
+        self.detection_callback = detection_callback
+
+    async def start(self):
+        for neighbour in self.mesh.neighbours(self.address):
+            node = self.mesh.nodes.get(neighbour)
+            if node is not None:
+                self.detection_callback(LoopbackAdvertisement(neighbour, node.device_name, self.mesh.rssi),
+                                        None)
+
+    async def stop(self):
+        pass
+
+
+class LoopbackMesh:
+    """In-process radio medium: nodes in range of each other can link up and exchange frames
+
+    Every frame is delayed by latency plus up to jitter seconds and dropped with
+    probability loss; frames on one link keep their order. Range is explicit: only
+    pairs joined with link() can see and connect to each other.
+    """
+
+    def __init__(self, latency: float = 0.02, jitter: float = 0.01, loss: float = 0.0,
+                 mtu: int = DEFAULT_MTU, rssi: float = -60.0, seed: int = None):
+        if not 0.0 <= loss < 1.0:
+            raise ValueError("loss must be in [0, 1)")
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.mtu = mtu
+        self.rssi = rssi
+        self.nodes: Dict[str, 'BLENode'] = {}
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.bytes_sent = 0
+        self._edges = set()
+        self._endpoints: List[LoopbackClient] = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def link(self, a: str, b: str):
+        """Put two nodes in range of each other"""
+        with self._lock:
+            self._edges.add(frozenset((a, b)))
+
+    def unlink(self, a: str, b: str):
+        """Take two nodes out of range; open links between them drop"""
+        with self._lock:
+            self._edges.discard(frozenset((a, b)))
+            endpoints = [endpoint for endpoint in self._endpoints
+                         if {endpoint.local_address, endpoint.address} == {a, b}]
+        for endpoint in endpoints:
+            self.close(endpoint, notify_self=True)
+
+    def in_range(self, a: str, b: str) -> bool:
+        return frozenset((a, b)) in self._edges
+
+    def neighbours(self, address: str) -> List[str]:
+        with self._lock:
+            return [other for edge in self._edges if address in edge for other in edge if other != address]
+
+    async def open(self, client: LoopbackClient):
+        remote = self.nodes.get(client.address)
+        if remote is None or remote.loop is None or not self.in_range(client.local_address, client.address):
+            raise ConnectionError(f"{client.address} is out of range")
+        back = LoopbackClient(self, remote, client.address, client.local_address,
+                              remote.connections._on_client_disconnected)
+        client.peer, back.peer = back, client
+        client.is_connected = back.is_connected = True
+        with self._lock:
+            self._endpoints.extend((client, back))
+        # The remote side answers on its own loop, like a GATT server would
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(
+            remote._accept_link(client.local_address, back), remote.loop))
+
+    def transmit(self, client: LoopbackClient, data: bytes):
+        if not client.is_connected:
+            raise ConnectionError(f"Not connected to {client.address}")
+        with self._lock:
+            self.frames_sent += 1
+            self.bytes_sent += len(data)
+            if self._random.random() < self.loss:
+                self.frames_dropped += 1
+                return
+            deliver_at = max(time.monotonic() + self.latency + self._random.uniform(0, self.jitter),
+                             client._next_delivery)
+            client._next_delivery = deliver_at
+        peer = client.peer
+        peer.node.loop.call_soon_threadsafe(self._schedule, peer, deliver_at, data)
+
+    @staticmethod
+    def _schedule(endpoint: LoopbackClient, deliver_at: float, data: bytes):
+        asyncio.get_event_loop().call_later(max(0.0, deliver_at - time.monotonic()), endpoint.deliver, data)
+
+    def close(self, client: LoopbackClient, notify_self: bool = False):
+        peer = client.peer
+        was_connected = client.is_connected
+        client.is_connected = False
+        with self._lock:
+            for endpoint in (client, peer):
+                if endpoint in self._endpoints:
+                    self._endpoints.remove(endpoint)
+        if notify_self and was_connected and client.node.loop:
+            client.node.loop.call_soon_threadsafe(client.remote_closed)
+        if peer is not None and peer.is_connected and peer.node.loop:
+            peer.node.loop.call_soon_threadsafe(peer.remote_closed)
+
+
+class LoopbackTransport(Transport):
+    """Transport for one simulated node on a LoopbackMesh"""
+
+    def __init__(self, mesh: LoopbackMesh, address: str):
+        self.mesh = mesh
+        self.address = address
+        self.node = None
+
+    def create_client(self, address: str, disconnected_callback=None):
+        return LoopbackClient(self.mesh, self.node, self.address, address, disconnected_callback)
+
+    def create_scanner(self, detection_callback):
+        return LoopbackScanner(self.mesh, self.address, detection_callback)
+
+    def attach(self, node: 'BLENode'):
+        self.node = node
+        self.mesh.nodes[self.address] = node
+
+
+class MeshSimulation:
+    """Run many BLENodes in one process over a LoopbackMesh and measure how messages spread
+
+    Typical use:
+        simulation = MeshSimulation(size=30, topology="random", degree=3, loss=0.02)
+        simulation.start()
+        try:
+            print(simulation.run(messages=50))
+        finally:
+            simulation.stop()
+    """
+
+    TOPOLOGIES = ("full", "line", "ring", "star", "grid", "random")
+
+    def __init__(self, size: int = 10, topology: str = "random", degree: int = 3,
+                 latency: float = 0.02, jitter: float = 0.01, loss: float = 0.0,
+                 mtu: int = DEFAULT_MTU, seed: int = None, difficulty: int = 1, sync_timeout: float = 0.5):
+        if topology not in self.TOPOLOGIES:
+            raise ValueError(f"Unknown topology {topology}")
+        if size < 2:
+            raise ValueError("A mesh needs at least two nodes")
+        self.size = size
+        self.topology = topology
+        self.degree = degree
+        self.difficulty = difficulty
+        # Simulated links answer in milliseconds, so lost sync requests are asked again much sooner than over BLE
+        self.sync_timeout = sync_timeout
+        self.mesh = LoopbackMesh(latency=latency, jitter=jitter, loss=loss, mtu=mtu, seed=seed)
+        self.addresses = [f"LOOP-{index:04d}" for index in range(size)]
+        self.nodes: List[BLENode] = []
+        self.edges = self._build_edges(random.Random(seed))
+        self._random = random.Random(seed)
+        # Keyed by message text rather than block hash, since a reorg re-mines a message under a new hash
+        self._sent: Dict[str, Tuple[str, float]] = {}  # text: (sender address, publish time)
+        self._received: Dict[str, Dict[str, float]] = {}  # text: {receiver address: first arrival time}
+        self._lock = threading.Lock()
+        self._data_dir = None
+        self._started_at = None
+        self._converged_at = None
+
+    def _build_edges(self, rng: random.Random) -> List[Tuple[int, int]]:
+        n = self.size
+        if self.topology == "full":
+            return [(a, b) for a in range(n) for b in range(a + 1, n)]
+        if self.topology == "star":
+            return [(0, b) for b in range(1, n)]
+        if self.topology == "grid":
+            side = math.ceil(math.sqrt(n))
+            return [(a, b) for a in range(n) for b in (a + 1, a + side)
+                    if b < n and (b == a + side or b % side)]
+        edges = {(a, a + 1) for a in range(n - 1)}
+        if self.topology in ("ring", "random") and n > 2:
+            edges.add((0, n - 1))
+        if self.topology == "random":
+            # Start from a ring so the mesh is connected, then add random links up to the target degree
+            degrees = [len([edge for edge in edges if a in edge]) for a in range(n)]
+            for a in range(n):
+                for _ in range(4 * self.degree):
+                    if degrees[a] >= self.degree:
+                        break
+                    b = rng.randrange(n)
+                    edge = (min(a, b), max(a, b))
+                    if a == b or edge in edges:
+                        continue
+                    edges.add(edge)
+                    degrees[a] += 1
+                    degrees[b] += 1
+        return sorted(edges)
+
+    def start(self, timeout: float = 30.0):
+        """Build the nodes, connect every edge and wait for the handshakes
+
+        Handshakes run without frame loss, so every run starts from the same connected mesh.
+        """
+        self._data_dir = tempfile.mkdtemp(prefix="blockchain_chat_mesh_")
+        max_degree = max([len([edge for edge in self.edges if index in edge]) for index in range(self.size)])
+        for address in self.addresses:
+            data_dir = os.path.join(self._data_dir, address)
+            os.makedirs(data_dir)
+            node = BLENode(transport=LoopbackTransport(self.mesh, address), data_dir=data_dir, persist=False)
+            node.blockchain.difficulty = self.difficulty
+            node.chain_sync.request_timeout = self.sync_timeout
+            node.chain_sync.status_interval = 4 * self.sync_timeout
+            node.connections.max_connections = max(node.connections.max_connections, max_degree)
+            node.message_callback = functools.partial(self._on_message, address)
+            node.start()
+            self.nodes.append(node)
+        for a, b in self.edges:
+            self.mesh.link(self.addresses[a], self.addresses[b])
+
+        deadline = time.monotonic() + timeout
+        while any(node.loop is None or not node.loop.is_running() for node in self.nodes):
+            if time.monotonic() > deadline:
+                raise TimeoutError("Simulated nodes did not start")
+            time.sleep(0.01)
+
+        loss, self.mesh.loss = self.mesh.loss, 0.0
+        # Links are opened from the lower-numbered end only; the other end accepts
+        connects = [asyncio.run_coroutine_threadsafe(
+            self.nodes[a].connect_to_device(self.addresses[b]), self.nodes[a].loop) for a, b in self.edges]
+        wait(connects, timeout=timeout)
+        while not all(self.addresses[b] in self.nodes[a].relay.peers and self.addresses[a] in self.nodes[b].relay.peers
+                      for a, b in self.edges):
+            if time.monotonic() > deadline:
+                raise TimeoutError("Simulated nodes did not finish their handshakes")
+            time.sleep(0.01)
+        self.mesh.loss = loss
+
+    def _on_message(self, address: str, block: Block):
+        with self._lock:
+            self._received.setdefault(block.data, {}).setdefault(address, time.monotonic())
+
+    def send(self, index: int = None, text: str = None) -> Block:
+        """Mine and broadcast a message from one node (random by default)"""
+        if index is None:
+            index = self._random.randrange(self.size)
+        text = text or f"message {len(self._sent)} from {self.addresses[index]}"
+        block = self.nodes[index].send_message(text)
+        with self._lock:
+            self._sent[text] = (self.addresses[index], time.monotonic())
+            if self._started_at is None:
+                self._started_at = self._sent[text][1]
+        return block
+
+    def converged(self) -> bool:
+        """Every node has the same tip and every sent message is on it"""
+        tips = {node.blockchain.get_latest_block().hash for node in self.nodes}
+        if len(tips) != 1:
+            return False
+        chain = self.nodes[0].blockchain.chain
+        on_chain = {chain[index].data for index in range(len(chain))}
+        return all(text in on_chain for text in self._sent)
+
+    def wait_converged(self, timeout: float = 30.0) -> bool:
+        deadline = time.monotonic() + timeout
+        while not self.converged():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.02)
+        self._converged_at = time.monotonic()
+        return True
+
+    def run(self, messages: int = 20, interval: float = 0.0, timeout: float = 30.0) -> Dict[str, float]:
+        """Send messages from random nodes, wait for the mesh to converge and report"""
+        for _ in range(messages):
+            self.send()
+            if interval:
+                time.sleep(interval)
+        self.wait_converged(timeout)
+        return self.report()
+
+    def report(self) -> Dict[str, float]:
+        latencies = []
+        last_arrival = None
+        with self._lock:
+            for text, (sender, sent_at) in self._sent.items():
+                for receiver, arrived_at in self._received.get(text, {}).items():
+                    if receiver == sender:
+                        continue
+                    latencies.append(max(0.0, arrived_at - sent_at))
+                    last_arrival = max(last_arrival or arrived_at, arrived_at)
+            expected = len(self._sent) * (self.size - 1)
+            last_sent = max([sent_at for _, sent_at in self._sent.values()], default=None)
+        elapsed = (last_arrival - self._started_at) if last_arrival and self._started_at else 0.0
+
+        def ms(value):
+            return round(value * 1000, 2) if value is not None else None
+
+        return {
+            "nodes": self.size,
+            "links": len(self.edges),
+            "messages": len(self._sent),
+            "delivery_ratio": len(latencies) / expected if expected else 0.0,
+            "latency_p50_ms": ms(_percentile(latencies, 0.50)),
+            "latency_p90_ms": ms(_percentile(latencies, 0.90)),
+            "latency_p99_ms": ms(_percentile(latencies, 0.99)),
+            "deliveries_per_second": len(latencies) / elapsed if elapsed > 0 else 0.0,
+            "convergence_seconds": round(self._converged_at - last_sent, 3)
+            if self._converged_at and last_sent else None,
+            "frames_sent": self.mesh.frames_sent,
+            "frames_dropped": self.mesh.frames_dropped,
+            "reorgs": sum(node.forks.reorg_count for node in self.nodes),
+        }
+
+    def stop(self):
+        for node in self.nodes:
+            node.stop()
+        self.nodes = []
+        if self._data_dir:
+            shutil.rmtree(self._data_dir, ignore_errors=True)
+            self._data_dir = None
+
+
+if __name__ == '__main__':
+    sys.exit(benchmark_main(sys.argv[1:]))
@@ -0,0 +1,232 @@
+"""Headless Blockchain Chat node for always-on relay boxes
+
+Runs a BLENode without Kivy: it relays blocks, keeps store-and-forward queues for
+peers that are out of range, and answers a local control socket with one JSON
+request and one JSON reply per line.
+
+    python chat_daemon.py run --data-dir /var/lib/blockchain-chat
+    python chat_daemon.py status
+    python chat_daemon.py send "hello mesh"
+"""
+import time
+
+STARTED = time.perf_counter()  # Cold start is measured from here, before the heavy imports
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+from collections import deque
+
+from chat_core import BLENode, Transport, logger
+
+DEFAULT_SOCKET = "blockchain_chat.sock"
+
+
+class NodeDaemon:
+    """Owns a headless BLENode and serves its control socket
+
+    Commands: status, peers, messages, send {text, recipient}, connect {address},
+    disconnect {address}, stop.
+    """
+
+    def __init__(self, data_dir: str = None, socket_path: str = None, port: int = None,
+                 auto_connect: bool = True, history: int = 100, transport: Transport = None):
+        self.data_dir = data_dir
+        self.transport = transport  # Defaults to Bleak; a LoopbackTransport runs the daemon on a simulated mesh
+        self.socket_path = socket_path or os.path.join(data_dir or "", DEFAULT_SOCKET)
+        self.port = port  # TCP on localhost instead of a Unix socket, e.g. on Windows
+        self.auto_connect = auto_connect
+        self.messages = deque(maxlen=history)  # Recent blocks received, newest last
+        self.node = None
+        self.startup_ms = None
+        self._server = None
+        self._stopping = None
+
+    def start(self):
+        self.node = BLENode(transport=self.transport, data_dir=self.data_dir)
+        self.node.message_callback = self._on_message
+        self.node.device_list_callback = self._on_link_event
+        if self.auto_connect:
+            self.node.scanner.change_callback = self._connect_discovered
+        self.node.start()
+
+    def _on_message(self, block):
+        self.messages.append({
+            "index": block.index,
+            "hash": block.hash,
+            "sender_id": block.sender_id,
+            "recipient_id": block.recipient_id,
+            "message_type": block.message_type,
+            "data": block.data,
+            "timestamp": block.timestamp,
+        })
+        logger.info(f"NodeDaemon: block {block.index} {block.hash[:12]} from {block.sender_id}")
+
+    def _on_link_event(self, address=None, state=None):
+        if address:
+            logger.info(f"NodeDaemon: {address} {state}")
+
+    def _connect_discovered(self):
+        # Runs on the node's event loop; relay boxes link up with everything in range
+        connections = self.node.connections
+        for device in self.node.scanner.devices():
+            if len(self.node.connected_devices) >= connections.max_connections:
+                break
+            address = device["address"]
+            peer = connections.peers.get(address)
+            if address not in self.node.connected_devices and (peer is None or peer.state in ("failed", "disconnected")):
+                asyncio.ensure_future(connections.connect(address))
+
+    def status(self) -> dict:
+        node = self.node
+        tip = node.blockchain.get_latest_block()
+        return {
+            "device_id": node.device_id,
+            "height": tip.index,
+            "tip": tip.hash,
+            "peers": len(node.connected_devices),
+            "nearby": len(node.scanner.devices()),
+            "pending": len(node.blockchain.pending_blocks),
+            "relay": node.relay.metrics(),
+            "inbound": node.inbound_pipeline.metrics(),
+            "reorgs": node.forks.reorg_count,
+            "startup_ms": self.startup_ms,
+        }
+
+    async def _node_call(self, coroutine):
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, self.node.loop))
+
+    async def handle(self, request: dict) -> dict:
+        command = request.get("command")
+        if command == "status":
+            return self.status()
+        if command == "peers":
+            return {"connected": sorted(self.node.connected_devices), "nearby": self.node.scanner.devices()}
+        if command == "messages":
+            return {"messages": list(self.messages)[-int(request.get("limit", 20)):]}
+        if command == "send":
+            if not request.get("text"):
+                raise ValueError("send needs text")
+            loop = asyncio.get_event_loop()
+            # Mining blocks, so keep it off the control loop
+            block = await loop.run_in_executor(None, self.node.send_message, request["text"],
+                                               request.get("recipient"))
+            return {"index": block.index, "hash": block.hash}
+        if command == "connect":
+            return {"connected": await self._node_call(self.node.connect_to_device(request["address"]))}
+        if command == "disconnect":
+            await self._node_call(self.node.connections.disconnect(request["address"]))
+            return {}
+        if command == "stop":
+            self._stopping.set()
+            return {}
+        raise ValueError(f"Unknown command {command}")
+
+    async def _serve_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    reply = {"ok": True, **await self.handle(json.loads(line))}
+                except Exception as e:
+                    reply = {"ok": False, "error": str(e)}
+                writer.write(json.dumps(reply).encode('utf-8') + b"\n")
+                await writer.drain()
+                if self._stopping.is_set():
+                    break
+        finally:
+            writer.close()
+
+    async def serve(self):
+        """Run until stopped by a signal or a stop command"""
+        self._stopping = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self._stopping.set)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows: Ctrl+C still raises KeyboardInterrupt
+
+        self.start()
+        if self.port is not None:
+            self._server = await asyncio.start_server(self._serve_client, "127.0.0.1", self.port)
+        else:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)  # Left over from a crash
+            self._server = await asyncio.start_unix_server(self._serve_client, self.socket_path)
+            os.chmod(self.socket_path, 0o600)
+        self.startup_ms = round((time.perf_counter() - STARTED) * 1000, 1)
+        logger.info(f"NodeDaemon: ready in {self.startup_ms} ms, control socket "
+                    f"{self.port if self.port is not None else self.socket_path}")
+        try:
+            await self._stopping.wait()
+        finally:
+            self._server.close()
+            await self._server.wait_closed()
+            if self.port is None and os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self.node.stop()
+
+
+def control(request: dict, socket_path: str = DEFAULT_SOCKET, port: int = None, timeout: float = 120.0) -> dict:
+    """Send one request to a running daemon and return its reply"""
+    if port is not None:
+        sock = socket.create_connection(("127.0.0.1", port), timeout=timeout)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+    with sock, sock.makefile('rwb') as stream:
+        stream.write(json.dumps(request).encode('utf-8') + b"\n")
+        stream.flush()
+        return json.loads(stream.readline())
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(description="Headless Blockchain Chat node")
+    parser.add_argument("--data-dir", help="where the chain, identity and queues live (default: current directory)")
+    parser.add_argument("--socket", help=f"control socket path (default: <data-dir>/{DEFAULT_SOCKET})")
+    parser.add_argument("--port", type=int, help="serve control on this localhost TCP port instead")
+    commands = parser.add_subparsers(dest="command")
+    run = commands.add_parser("run", help="run the node")
+    run.add_argument("--no-auto-connect", action="store_true", help="don't connect to discovered devices")
+    run.add_argument("--log-level", default="INFO")
+    commands.add_parser("status")
+    commands.add_parser("peers")
+    messages = commands.add_parser("messages")
+    messages.add_argument("--limit", type=int, default=20)
+    send = commands.add_parser("send")
+    send.add_argument("text")
+    send.add_argument("--recipient")
+    for name in ("connect", "disconnect"):
+        commands.add_parser(name).add_argument("address")
+    commands.add_parser("stop")
+    options = parser.parse_args(args)
+
+    socket_path = options.socket or os.path.join(options.data_dir or "", DEFAULT_SOCKET)
+    if options.command in (None, "run"):
+        logging.basicConfig(level=getattr(options, "log_level", "INFO"),
+                            format="%(asctime)s %(levelname)s %(message)s")
+        daemon = NodeDaemon(options.data_dir, socket_path, options.port,
+                            auto_connect=not getattr(options, "no_auto_connect", False))
+        asyncio.run(daemon.serve())
+        return 0
+
+    request = {"command": options.command}
+    for key in ("text", "recipient", "address", "limit"):
+        if getattr(options, key, None) is not None:
+            request[key] = getattr(options, key)
+    reply = control(request, socket_path, options.port)
+    print(json.dumps(reply, indent=2))
+    return 0 if reply.get("ok") else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,17 @@
 import asyncio
 import json
-import hashlib
-import threading
+import itertools
 import time
 import os
+import sys
+import threading
 import base64
-import uuid
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict
+from datetime import datetime
+from typing import List
+# Kivy parses the command line on import; leave benchmark options to us
+if sys.argv[1:2] == ['--benchmark']:
+    os.environ.setdefault('KIVY_NO_ARGS', '1')
 from kivy.app import App
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.label import Label
@@ -27,32 +31,23 @@ from kivy.uix.switch import Switch
 from kivy.uix.checkbox import CheckBox
 from kivy.uix.spinner import Spinner
 from kivy.uix.dropdown import DropDown
+from kivy.uix.filechooser import FileChooserListView
 from kivy.uix.effectwidget import EffectWidget
 from kivy.uix.stencilview import StencilView
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
 from kivy.clock import Clock
 from kivy.graphics import Color, Rectangle, RoundedRectangle, Ellipse, Line
-from kivy.core.window import Window
+from kivy.core.image import Image as CoreImage
 from kivy.metrics import dp
 from kivy.utils import platform
 from kivy.animation import Animation
 from kivy.effects.scroll import ScrollEffect
 from kivy.properties import StringProperty, ListProperty, NumericProperty, BooleanProperty, ObjectProperty
-from kivy.storage.jsonstore import JsonStore
-from kivy.logger import Logger
-from bleak import BleakScanner, BleakClient, BleakGATTCharacteristic
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.backends import default_backend
 import qrcode
 from io import BytesIO
-
-# Define UUIDs for our custom service and characteristics
-SERVICE_UUID = "0000FFE0-0000-1000-8000-00805F9B34FB"
-TX_CHAR_UUID = "0000FFE1-0000-1000-8000-00805F9B34FB"  # For receiving data
-RX_CHAR_UUID = "0000FFE2-0000-1000-8000-00805F9B34FB"  # For sending data
+from chat_core import BLENode, Block, DeviceScanner, FileManifest, benchmark_main, logger
 
 # Color scheme
 PRIMARY_COLOR = (0.2, 0.6, 0.9, 1)  # Blue
@@ -88,372 +83,90 @@ class AnimatedLabel(Label):
         self.valign = 'middle'
 
 
-class Block:
-    def __init__(self, index: int, previous_hash: str, timestamp: float, data: str, nonce: int = 0,
-                 sender_id: str = None, recipient_id: str = None, message_type: str = "text",
-                 file_data: str = None, file_name: str = None, encryption_key: str = None,
-                 expiration_time: float = None):
-        self.index = index
-        self.previous_hash = previous_hash
-        self.timestamp = timestamp
-        self.data = data
-        self.nonce = nonce
-        self.hash = self.calculate_hash()
-        self.sender_id = sender_id
-        self.recipient_id = recipient_id
-        self.message_type = message_type  # text, file, image, etc.
-        self.file_data = file_data  # Base64 encoded file data
-        self.file_name = file_name
-        self.encryption_key = encryption_key
-        self.expiration_time = expiration_time  # For disappearing messages
-        self.status = "sent"  # sent, delivered, read
-
-    def calculate_hash(self) -> str:
-        block_string = json.dumps({
-            "index": self.index,
-            "previous_hash": self.previous_hash,
-            "timestamp": self.timestamp,
-            "data": self.data,
-            "nonce": self.nonce,
-            "sender_id": self.sender_id,
-            "recipient_id": self.recipient_id,
-            "message_type": self.message_type,
-            "file_data": self.file_data,
-            "file_name": self.file_name,
-            "encryption_key": self.encryption_key,
-            "expiration_time": self.expiration_time
-        }, sort_keys=True).encode()
-        return hashlib.sha256(block_string).hexdigest()
-
-    def to_json(self) -> str:
-        return json.dumps({
-            "index": self.index,
-            "previous_hash": self.previous_hash,
-            "timestamp": self.timestamp,
-            "data": self.data,
-            "nonce": self.nonce,
-            "hash": self.hash,
-            "sender_id": self.sender_id,
-            "recipient_id": self.recipient_id,
-            "message_type": self.message_type,
-            "file_data": self.file_data,
-            "file_name": self.file_name,
-            "encryption_key": self.encryption_key,
-            "expiration_time": self.expiration_time,
-            "status": self.status
-        })
-
-    @staticmethod
-    def from_json(json_str: str) -> 'Block':
-        data = json.loads(json_str)
-        block = Block(
-            data['index'],
-            data['previous_hash'],
-            data['timestamp'],
-            data['data'],
-            data['nonce'],
-            data.get('sender_id'),
-            data.get('recipient_id'),
-            data.get('message_type', 'text'),
-            data.get('file_data'),
-            data.get('file_name'),
-            data.get('encryption_key'),
-            data.get('expiration_time')
-        )
-        block.hash = data['hash']
-        block.status = data.get('status', 'sent')
-        return block
-
-
-class Blockchain:
-    def __init__(self):
-        self.chain = [self.create_genesis_block()]
-        self.difficulty = 2
-        self.pending_blocks = []  # For store-and-forward
-
-    def create_genesis_block(self) -> Block:
-        return Block(0, "0", datetime.now().timestamp(), "Genesis Block")
-
-    def get_latest_block(self) -> Block:
-        return self.chain[-1]
-
-    def add_block(self, new_block: Block):
-        new_block.previous_hash = self.get_latest_block().hash
-        new_block.hash = new_block.calculate_hash()
-        self.chain.append(new_block)
-
-    def proof_of_work(self, block: Block) -> Block:
-        while not block.hash.startswith('0' * self.difficulty):
-            block.nonce += 1
-            block.hash = block.calculate_hash()
-        return block
-
-    def is_chain_valid(self) -> bool:
-        for i in range(1, len(self.chain)):
-            current_block = self.chain[i]
-            previous_block = self.chain[i - 1]
-
-            if current_block.hash != current_block.calculate_hash():
-                return False
-            if current_block.previous_hash != previous_block.hash:
-                return False
-        return True
-
-    def add_pending_block(self, block: Block):
-        """Add a block to pending list for store-and-forward"""
-        self.pending_blocks.append(block)
-
-    def get_pending_blocks_for_recipient(self, recipient_id: str) -> List[Block]:
-        """Get all pending blocks for a specific recipient"""
-        return [block for block in self.pending_blocks if block.recipient_id == recipient_id]
-
-    def remove_pending_blocks(self, blocks: List[Block]):
-        """Remove delivered blocks from pending list"""
-        for block in blocks:
-            if block in self.pending_blocks:
-                self.pending_blocks.remove(block)
-
-
-class CryptoManager:
-    def __init__(self):
-        self.private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,
-            backend=default_backend()
-        )
-        self.public_key = self.private_key.public_key()
-        self.contacts = {}  # contact_id: public_key
-
-    def get_public_key_pem(self) -> str:
-        """Get PEM formatted public key"""
-        return self.public_key.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        ).decode('utf-8')
-
-    def add_contact(self, contact_id: str, public_key_pem: str):
-        """Add a contact with their public key"""
-        public_key = serialization.load_pem_public_key(
-            public_key_pem.encode('utf-8'),
-            backend=default_backend()
-        )
-        self.contacts[contact_id] = public_key
-
-    def encrypt_message(self, message: str, recipient_id: str) -> Tuple[str, str]:
-        """Encrypt a message for a recipient
-        Returns: (encrypted_message, encryption_key)
-        """
-        if recipient_id not in self.contacts:
-            raise ValueError(f"Recipient {recipient_id} not in contacts")
-
-        # Generate a random AES key
-        aes_key = os.urandom(32)  # 256-bit key
-
-        # Encrypt the message with AES
-        iv = os.urandom(16)
-        cipher = Cipher(
-            algorithms.AES(aes_key),
-            modes.CFB(iv),
-            backend=default_backend()
-        )
-        encryptor = cipher.encryptor()
-        encrypted_message = encryptor.update(message.encode('utf-8')) + encryptor.finalize()
-
-        # Encrypt the AES key with the recipient's public key
-        encrypted_key = self.contacts[recipient_id].encrypt(
-            aes_key,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
-
-        # Return base64 encoded encrypted message and key
-        return (
-            base64.b64encode(iv + encrypted_message).decode('utf-8'),
-            base64.b64encode(encrypted_key).decode('utf-8')
-        )
-
-    def decrypt_message(self, encrypted_message: str, encryption_key: str) -> str:
-        """Decrypt a message"""
-        # Decode from base64
-        encrypted_data = base64.b64decode(encrypted_message)
-        encrypted_key = base64.b64decode(encryption_key)
-
-        # Decrypt the AES key with our private key
-        aes_key = self.private_key.decrypt(
-            encrypted_key,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
-
-        # Extract IV and encrypted message
-        iv = encrypted_data[:16]
-        encrypted = encrypted_data[16:]
+class MessageRow(RecycleDataViewBehavior, BoxLayout):
+    """One message in the chat history; rows are recycled as the list scrolls"""
 
-        # Decrypt the message with AES
-        cipher = Cipher(
-            algorithms.AES(aes_key),
-            modes.CFB(iv),
-            backend=default_backend()
-        )
-        decryptor = cipher.decryptor()
-        decrypted_message = decryptor.update(encrypted) + decryptor.finalize()
-
-        return decrypted_message.decode('utf-8')
-
-    def sign_data(self, data: str) -> str:
-        """Sign data with private key"""
-        signature = self.private_key.sign(
-            data.encode('utf-8'),
-            padding.PSS(
-                mgf=padding.MGF1(hashes.SHA256()),
-                salt_length=padding.PSS.MAX_LENGTH
-            ),
-            hashes.SHA256()
-        )
-        return base64.b64encode(signature).decode('utf-8')
-
-    def verify_signature(self, data: str, signature: str, contact_id: str) -> bool:
-        """Verify signature from a contact"""
-        if contact_id not in self.contacts:
-            return False
-
-        try:
-            self.contacts[contact_id].verify(
-                base64.b64decode(signature),
-                data.encode('utf-8'),
-                padding.PSS(
-                    mgf=padding.MGF1(hashes.SHA256()),
-                    salt_length=padding.PSS.MAX_LENGTH
-                ),
-                hashes.SHA256()
-            )
-            return True
-        except Exception:
-            return False
-
-
-class MessageBubble(BoxLayout):
-    def __init__(self, block, is_self=True, device_type=None, **kwargs):
-        super(MessageBubble, self).__init__(**kwargs)
+    def __init__(self, **kwargs):
+        super(MessageRow, self).__init__(**kwargs)
         self.orientation = 'horizontal'
-        self.size_hint_y = None
-        self.height = self.minimum_height
         self.padding = [dp(10), dp(5)]
-        self.block = block
-        self.is_self = is_self
-        self.device_type = device_type
-
-        # Device icon
-        if not is_self and device_type:
-            device_icon = Image(
-                source=self.get_device_icon(device_type),
-                size_hint=(None, 1),
-                width=dp(30),
-                mipmap=True
-            )
-            self.add_widget(device_icon)
-
-        # Message container
-        msg_container = BoxLayout(orientation='vertical', size_hint_x=0.8)
-        if is_self:
-            self.pos_hint = {'right': 1}
-            msg_container.pos_hint = {'right': 1}
-        else:
-            self.pos_hint = {'x': 0}
-            msg_container.pos_hint = {'x': 0}
-
-        # Message background
-        with msg_container.canvas.before:
-            Color(PRIMARY_COLOR[0], PRIMARY_COLOR[1], PRIMARY_COLOR[2], 1) if is_self else Color(0.9, 0.9, 0.9, 1)
-            self.rect = RoundedRectangle(pos=msg_container.pos, size=msg_container.size, radius=[dp(10)])
+        self.row_key = None
+        self.expiration_time = None
 
-        msg_container.bind(pos=self.update_rect, size=self.update_rect)
+        # Built once per row and re-attached to fit each message it shows
+        self.device_icon = Image(size_hint=(None, 1), width=dp(30), mipmap=True)
+        self.msg_container = BoxLayout(orientation='vertical', size_hint_x=0.8)
+        with self.msg_container.canvas.before:
+            self.rect_color = Color(*PRIMARY_COLOR)
+            self.rect = RoundedRectangle(pos=self.msg_container.pos, size=self.msg_container.size, radius=[dp(10)])
+        self.msg_container.bind(pos=self.update_rect, size=self.update_rect)
 
-        # Message content
-        if block.message_type == "text":
-            msg_label = AnimatedLabel(
-                text=block.data,
-                size_hint_y=None,
-                height=dp(30)
-            )
-            msg_label.bind(texture_size=msg_label.setter('size'))
-            msg_container.add_widget(msg_label)
-        elif block.message_type in ["image", "file"]:
-            # File/image preview
-            if block.message_type == "image":
-                img = AsyncImage(
-                    source=block.data,
-                    size_hint=(None, None),
-                    size=(dp(150), dp(150)),
-                    mipmap=True
-                )
-                msg_container.add_widget(img)
-
-            # File name
-            file_label = AnimatedLabel(
-                text=block.file_name or "File",
-                size_hint_y=None,
-                height=dp(20),
-                bold=True
-            )
-            file_label.bind(texture_size=file_label.setter('size'))
-            msg_container.add_widget(file_label)
+        self.msg_label = AnimatedLabel(size_hint_y=None, height=dp(30))
+        self.image = AsyncImage(size_hint=(None, None), size=(dp(150), dp(150)), mipmap=True)
+        self.file_label = AnimatedLabel(size_hint_y=None, height=dp(20), bold=True)
 
         # Timestamp and status
-        info_layout = BoxLayout(size_hint_y=None, height=dp(20))
-
-        timestamp = datetime.fromtimestamp(block.timestamp).strftime("%H:%M")
-        time_label = Label(
-            text=timestamp,
-            color=LIGHT_TEXT_COLOR,
-            size_hint_x=0.7,
-            font_size=dp(10),
-            halign='left'
-        )
-
-        # Status icon
-        status_icon = "atlas://data/images/defaulttheme/checkbox_on" if block.status == "read" else \
-            "atlas://data/images/defaulttheme/checkbox_off" if block.status == "delivered" else \
-                "atlas://data/images/defaulttheme/checkbox_blank"
-
-        status_img = Image(
-            source=status_icon,
-            size_hint=(None, 1),
-            width=dp(15)
-        )
-
-        info_layout.add_widget(time_label)
-        info_layout.add_widget(status_img)
-        msg_container.add_widget(info_layout)
+        self.info_layout = BoxLayout(size_hint_y=None, height=dp(20))
+        self.time_label = Label(color=LIGHT_TEXT_COLOR, size_hint_x=0.7, font_size=dp(10), halign='left')
+        self.status_img = Image(size_hint=(None, 1), width=dp(15))
+        self.info_layout.add_widget(self.time_label)
+        self.info_layout.add_widget(self.status_img)
 
         # Expiration timer if disappearing message
-        if block.expiration_time and block.expiration_time > time.time():
-            remaining = block.expiration_time - time.time()
-            timer_label = Label(
-                text=f"Disappears in {int(remaining)}s",
-                color=ACCENT_COLOR,
-                size_hint_y=None,
-                height=dp(15),
-                font_size=dp(10),
-                italic=True
-            )
-            msg_container.add_widget(timer_label)
+        self.timer_label = Label(color=ACCENT_COLOR, size_hint_y=None, height=dp(15),
+                                 font_size=dp(10), italic=True)
 
-            # Start countdown timer
-            Clock.schedule_once(lambda dt: self.update_expiration_timer(timer_label, block), 1)
+    def refresh_view_attrs(self, rv, index, data):
+        self.clear_widgets()
+        self.msg_container.clear_widgets()
+        self.row_key = data['row_key']
+        is_self = data['is_self']
 
-        self.add_widget(msg_container)
+        if not is_self and data.get('device_type'):
+            self.device_icon.source = self.get_device_icon(data['device_type'])
+            self.add_widget(self.device_icon)
 
-        # Animate entrance
-        self.opacity = 0
-        anim = Animation(opacity=1, duration=0.3)
-        anim.start(self)
+        self.rect_color.rgba = PRIMARY_COLOR if is_self else (0.9, 0.9, 0.9, 1)
+        self.pos_hint = {'right': 1} if is_self else {'x': 0}
+        self.msg_container.pos_hint = self.pos_hint
+
+        # Message content
+        if data['message_type'] == "text":
+            self.msg_label.text = data['text']
+            self.msg_container.add_widget(self.msg_label)
+        elif data['message_type'] in ["image", "file"]:
+            if data['message_type'] == "image":
+                # Chunked attachments show once their blob is in the store; older blocks carry the image inline
+                if data.get('file_id'):
+                    texture = rv.texture_for(data['blob'], data['file_name']) if data.get('source') else None
+                    if texture is not None:
+                        self.image.source = ''
+                        self.image.texture = texture
+                        self.msg_container.add_widget(self.image)
+                elif data['text']:
+                    self.image.source = data['text']
+                    self.msg_container.add_widget(self.image)
+            self.file_label.text = data['file_name'] or "File"
+            done, total = data.get('progress') or (0, 0)
+            if total and done < total:
+                self.file_label.text += f" ({done * 100 // total}%)"
+            self.msg_container.add_widget(self.file_label)
+
+        self.time_label.text = datetime.fromtimestamp(data['timestamp']).strftime("%H:%M")
+        self.status_img.source = self.get_status_icon(data['status'])
+        self.msg_container.add_widget(self.info_layout)
+
+        self.expiration_time = data['expiration_time']
+        if self.expiration_time and self.expiration_time > time.time():
+            self.update_timer()
+            self.msg_container.add_widget(self.timer_label)
+            rv.start_timers()
+
+        self.add_widget(self.msg_container)
+        return super(MessageRow, self).refresh_view_attrs(rv, index, {'height': data['height']})
+
+    def update_timer(self):
+        self.timer_label.text = f"Disappears in {max(int(self.expiration_time - time.time()), 0)}s"
 
     def update_rect(self, instance, value):
         self.rect.pos = instance.pos
@@ -472,14 +185,195 @@ class MessageBubble(BoxLayout):
         else:
             return 'atlas://data/images/defaulttheme/device'
 
-    def update_expiration_timer(self, label, block):
-        if block.expiration_time <= time.time():
-            # Remove the message
-            self.parent.remove_widget(self)
+    def get_status_icon(self, status):
+        if status == "read":
+            return "atlas://data/images/defaulttheme/checkbox_on"
+        elif status == "delivered":
+            return "atlas://data/images/defaulttheme/checkbox_off"
+        elif status in ("queued", "encrypting", "mining"):
+            return "atlas://data/images/defaulttheme/checkbox_radio_off"
+        elif status == "failed":
+            return "atlas://data/images/defaulttheme/close"
         else:
-            remaining = int(block.expiration_time - time.time())
-            label.text = f"Disappears in {remaining}s"
-            Clock.schedule_once(lambda dt: self.update_expiration_timer(label, block), 1)
+            return "atlas://data/images/defaulttheme/checkbox_blank"
+
+
+class ChatHistory(RecycleView):
+    """Chat pane that only builds widgets for visible rows
+
+    Opens on the newest page_size blocks and loads older pages from the chain as the
+    user scrolls to the top. At most max_rows rows are held; the oldest are dropped
+    (and paged back in on demand) as new messages arrive. Countdowns tick only while a
+    visible row has one; expired rows are removed by the node's expiry scheduler.
+    """
+
+    def __init__(self, node: 'BLENode', device_type: str = None, page_size: int = 50, max_rows: int = 1000,
+                 **kwargs):
+        super(ChatHistory, self).__init__(**kwargs)
+        self.node = node
+        self.device_type = device_type  # Icon shown next to other people's messages
+        self.page_size = page_size
+        self.max_rows = max_rows
+        self.viewclass = MessageRow
+        self._first_height = None  # Chain height of the oldest loaded block
+        self._loading = False  # An older page is being loaded; set until its rows are anchored
+        self._pending_keys = itertools.count(1)
+        self._timer_event = None
+        self._textures = OrderedDict()  # blob digest: decoded texture, least recently shown first
+
+        layout = RecycleBoxLayout(orientation='vertical', size_hint_y=None, default_size_hint=(1, None),
+                                  default_size=(None, dp(60)), padding=[dp(10), dp(5)])
+        layout.bind(minimum_height=layout.setter('height'))
+        self.add_widget(layout)
+        self.bind(scroll_y=self.on_scroll)
+
+    def row_for(self, block: Block, row_key: str = None, status: str = None) -> dict:
+        is_self = block.sender_id == self.node.device_id
+        # Rough wrapped height, so rows can be laid out without rendering them
+        lines = max(1, len(block.data or '') // 40 + 1) if block.message_type == "text" else 1
+        height = dp(40) + dp(20) * lines
+        if block.message_type == "image":
+            height += dp(150)
+        if block.expiration_time:
+            height += dp(15)
+        manifest = None
+        try:
+            manifest = FileManifest.from_file_data(block.file_data)
+        except (ValueError, KeyError, TypeError):
+            pass
+        file_id = manifest.file_id if manifest else None
+        return {
+            'row_key': row_key or block.hash,
+            'block_hash': block.hash,
+            'block_index': block.index,
+            'is_self': is_self,
+            'device_type': None if is_self else self.device_type,
+            'message_type': block.message_type,
+            'text': block.data,
+            'file_name': block.file_name,
+            'file_id': file_id,
+            'blob': manifest.sha256 if manifest else None,
+            'source': self.node.transfers.local_path(file_id) if file_id else None,
+            'progress': self.node.transfers.progress(file_id) if file_id else None,
+            'timestamp': block.timestamp,
+            # Messages from others are marked read as soon as they are shown
+            'status': status or (block.status if is_self else "read"),
+            'expiration_time': block.expiration_time,
+            'height': height,
+        }
+
+    def texture_for(self, digest: str, file_name: str):
+        """Decode an image blob once; blobs have no extension, so the loader is picked from the file name"""
+        texture = self._textures.get(digest)
+        if texture is not None:
+            self._textures.move_to_end(digest)
+            return texture
+        extension = os.path.splitext(file_name or '')[1].lstrip('.').lower() or 'png'
+        try:
+            data = self.node.transfers.blobs.read(digest)
+            texture = CoreImage(BytesIO(data), ext=extension).texture
+        except Exception as e:
+            logger.error(f"ChatHistory: can't show image {file_name}: {e}")
+            return None
+        self._textures[digest] = texture
+        while len(self._textures) > 32:
+            self._textures.popitem(last=False)
+        return texture
+
+    def rows_for(self, blocks) -> List[dict]:
+        """Rows for stored blocks, leaving out messages that have expired"""
+        now = time.time()
+        return [self.row_for(self.node.display_block(block)) for block in blocks
+                if not block.expiration_time or block.expiration_time > now]
+
+    def load_latest(self):
+        """Show the newest page; reads only that page from the chain"""
+        chain = self.node.blockchain.chain
+        end = len(chain)
+        self._first_height = max(1, end - self.page_size)  # Genesis isn't a message
+        self.data = self.rows_for(chain[height] for height in range(self._first_height, end))
+        self.scroll_y = 0
+
+    def load_older(self, *args):
+        if self._first_height is None or self._first_height <= 1:
+            self._loading = False
+            return
+        self._loading = True
+        chain = self.node.blockchain.chain
+        start = max(1, self._first_height - self.page_size)
+        rows = self.rows_for(chain[height] for height in range(start, self._first_height))
+        self._first_height = start
+        added = sum(row['height'] for row in rows)
+        self.data = rows + self.data
+
+        # Keep the rows that were on screen in place
+        def anchor(dt):
+            scrollable = self.layout_manager.height - self.height if self.layout_manager else 0
+            if scrollable > 0:
+                self.scroll_y = max(0.0, 1 - added / scrollable)
+            self._loading = False
+        Clock.schedule_once(anchor, 0)
+
+    def on_scroll(self, instance, value):
+        # Scrolling keeps firing at the top; load one page at a time
+        if value >= 1 and self.data and not self._loading:
+            self._loading = True
+            Clock.schedule_once(self.load_older, 0)
+
+    def append(self, block: Block, status: str = None, pending: bool = False) -> str:
+        """Add a message at the bottom; returns its row key"""
+        row_key = f"pending-{next(self._pending_keys)}" if pending else None
+        row = self.row_for(block, row_key, status)
+        at_bottom = self.scroll_y <= 0.01
+        self.data.append(row)
+        if len(self.data) > self.max_rows:
+            dropped = len(self.data) - self.max_rows
+            del self.data[:dropped]
+            first = next((r['block_index'] for r in self.data if not r['row_key'].startswith('pending-')), None)
+            if first is not None:
+                self._first_height = first
+        if at_bottom:
+            Clock.schedule_once(lambda dt: setattr(self, 'scroll_y', 0), 0)
+        return row['row_key']
+
+    def update_row(self, row_key: str, **changes):
+        # Recent rows are the likeliest to change, so search from the bottom
+        for row in reversed(self.data):
+            if row['row_key'] == row_key:
+                row.update(changes)
+                self.refresh_from_data()
+                return
+
+    def update_file(self, file_id: str, done: int, total: int, path: str = None):
+        """Show download progress, and the file once it is complete, on every row that shares it"""
+        changed = False
+        for row in self.data:
+            if row.get('file_id') == file_id:
+                row['progress'] = (done, total)
+                if path:
+                    row['source'] = path
+                changed = True
+        if changed:
+            self.refresh_from_data()
+
+    def remove_hashes(self, hashes):
+        self.data = [row for row in self.data if row['block_hash'] not in hashes]
+
+    def start_timers(self):
+        if self._timer_event is None:
+            self._timer_event = Clock.schedule_interval(self.update_timers, 1)
+
+    def update_timers(self, dt):
+        """Refresh countdowns on visible rows; stops once none is on screen"""
+        ticking = False
+        now = time.time()
+        for row in self.layout_manager.children if self.layout_manager else []:
+            if isinstance(row, MessageRow) and row.expiration_time and row.expiration_time > now:
+                row.update_timer()
+                ticking = True
+        if not ticking:
+            self._timer_event = None
+            return False
 
 
 class ConnectedDeviceItem(BoxLayout):
@@ -612,254 +506,6 @@ class GroupItem(BoxLayout):
         self.add_widget(join_btn)
 
 
-class BLENode:
-    def __init__(self):
-        self.blockchain = Blockchain()
-        self.connected_devices: Dict[str, BleakClient] = {}
-        self.message_callback = None
-        self.device_list_callback = None
-        self.running = True
-        self.loop = None
-        self.thread = None
-        self.device_name = "BlockchainChat"
-        self.is_server = False  # Flag to indicate if this device is acting as server
-        self.device_id = str(uuid.uuid4())  # Unique device ID
-        self.crypto_manager = CryptoManager()
-        self.groups = {}  # group_id: group_info
-        self.store = JsonStore('blockchain_chat.json')  # Local storage
-
-        # Load saved data
-        self._load_data()
-
-    def _load_data(self):
-        """Load saved data from local storage"""
-        try:
-            if 'contacts' in self.store:
-                for contact_id, public_key_pem in self.store['contacts'].items():
-                    self.crypto_manager.add_contact(contact_id, public_key_pem)
-
-            if 'groups' in self.store:
-                self.groups = self.store['groups']
-        except Exception as e:
-            Logger.error(f"Error loading data: {e}")
-
-    def _save_data(self):
-        """Save data to local storage"""
-        try:
-            self.store['contacts'] = {contact_id: self.crypto_manager.get_public_key_pem()
-                                      for contact_id in self.crypto_manager.contacts}
-            self.store['groups'] = self.groups
-        except Exception as e:
-            Logger.error(f"Error saving data: {e}")
-
-    def start(self):
-        """Start the BLE node in a separate thread"""
-        self.thread = threading.Thread(target=self._run_async_loop, daemon=True)
-        self.thread.start()
-
-    def _run_async_loop(self):
-        """Run the asyncio event loop in a separate thread"""
-        self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.loop)
-        self.loop.run_forever()
-
-    def validate_block(self, block: Block) -> bool:
-        """Validate a block before adding to blockchain"""
-        if block.index != self.blockchain.get_latest_block().index + 1:
-            return False
-        if block.previous_hash != self.blockchain.get_latest_block().hash:
-            return False
-        if block.hash != block.calculate_hash():
-            return False
-        return True
-
-    def send_message(self, message: str, recipient_id: str = None, message_type: str = "text",
-                     file_data: str = None, file_name: str = None, expiration_seconds: int = None):
-        """Send a message to all connected devices or specific recipient"""
-        expiration_time = None
-        if expiration_seconds:
-            expiration_time = time.time() + expiration_seconds
-
-        new_block = Block(
-            self.blockchain.get_latest_block().index + 1,
-            self.blockchain.get_latest_block().hash,
-            datetime.now().timestamp(),
-            message,
-            sender_id=self.device_id,
-            recipient_id=recipient_id,
-            message_type=message_type,
-            file_data=file_data,
-            file_name=file_name,
-            expiration_time=expiration_time
-        )
-
-        # Encrypt message if recipient is specified
-        if recipient_id and recipient_id in self.crypto_manager.contacts:
-            try:
-                encrypted_message, encryption_key = self.crypto_manager.encrypt_message(message, recipient_id)
-                new_block.data = encrypted_message
-                new_block.encryption_key = encryption_key
-            except Exception as e:
-                Logger.error(f"Encryption failed: {e}")
-                # Send unencrypted if encryption fails
-                new_block.encryption_key = None
-
-        mined_block = self.blockchain.proof_of_work(new_block)
-        self.blockchain.add_block(mined_block)
-
-        if self.message_callback:
-            self.message_callback(mined_block)
-
-        self.broadcast_block(mined_block)
-
-    def broadcast_block(self, block: Block):
-        """Broadcast a block to all connected devices"""
-        if not self.loop:
-            return
-
-        block_json = block.to_json()
-
-        # Schedule the broadcast in the asyncio loop
-        asyncio.run_coroutine_threadsafe(self._broadcast_data(block_json), self.loop)
-
-    async def _broadcast_data(self, data: str):
-        """Broadcast data to all connected devices"""
-        for address, client in self.connected_devices.items():
-            try:
-                # Write to the RX characteristic of the connected device
-                await client.write_gatt_char(RX_CHAR_UUID, data.encode('utf-8'))
-            except Exception as e:
-                print(f"Error broadcasting to client {address}: {e}")
-
-    async def scan_devices(self) -> List[dict]:
-        """Scan for nearby BLE devices"""
-        devices = []
-        try:
-            scanned_devices = await BleakScanner.discover()
-            for device in scanned_devices:
-                if device.name and device.name.startswith(self.device_name):
-                    devices.append({
-                        "name": device.name,
-                        "address": device.address
-                    })
-        except Exception as e:
-            print(f"Error scanning devices: {e}")
-        return devices
-
-    async def connect_to_device(self, address: str):
-        """Connect to a BLE device"""
-        try:
-            client = BleakClient(address)
-            await client.connect()
-
-            # Store the client
-            self.connected_devices[address] = client
-
-            # Update device list
-            if self.device_list_callback:
-                self.device_list_callback()
-
-            # Exchange public keys
-            await client.write_gatt_char(
-                RX_CHAR_UUID,
-                json.dumps({
-                    "type": "key_exchange",
-                    "device_id": self.device_id,
-                    "public_key": self.crypto_manager.get_public_key_pem()
-                }).encode('utf-8')
-            )
-
-            # Subscribe to notifications
-            def notification_handler(characteristic: BleakGATTCharacteristic, data: bytearray):
-                try:
-                    data_str = data.decode('utf-8')
-
-                    # Check if it's a key exchange
-                    try:
-                        msg_data = json.loads(data_str)
-                        if msg_data.get("type") == "key_exchange":
-                            # Add contact
-                            self.crypto_manager.add_contact(
-                                msg_data["device_id"],
-                                msg_data["public_key"]
-                            )
-                            self._save_data()
-                            return
-                    except json.JSONDecodeError:
-                        pass
-
-                    # Regular message
-                    block = Block.from_json(data_str)
-
-                    # Decrypt if encrypted
-                    if block.encryption_key and block.sender_id in self.crypto_manager.contacts:
-                        try:
-                            block.data = self.crypto_manager.decrypt_message(
-                                block.data,
-                                block.encryption_key
-                            )
-                        except Exception as e:
-                            Logger.error(f"Decryption failed: {e}")
-
-                    if self.validate_block(block):
-                        self.blockchain.add_block(block)
-                        if self.message_callback:
-                            self.message_callback(block)
-
-                        # Check for pending messages for this sender
-                        pending = self.blockchain.get_pending_blocks_for_recipient(block.sender_id)
-                        if pending:
-                            for pending_block in pending:
-                                asyncio.run_coroutine_threadsafe(
-                                    self._send_block_to_client(client, pending_block),
-                                    self.loop
-                                )
-                            self.blockchain.remove_pending_blocks(pending)
-                except Exception as e:
-                    print(f"Error processing notification: {e}")
-
-            # Subscribe to the TX characteristic
-            await client.start_notify(TX_CHAR_UUID, notification_handler)
-
-            # Send our latest block to the new device
-            latest_block = self.blockchain.get_latest_block()
-            block_json = latest_block.to_json()
-            await client.write_gatt_char(RX_CHAR_UUID, block_json.encode('utf-8'))
-
-            return True
-        except Exception as e:
-            print(f"Error connecting to device {address}: {e}")
-            return False
-
-    async def _send_block_to_client(self, client, block):
-        """Helper method to send a block to a client"""
-        try:
-            await client.write_gatt_char(
-                RX_CHAR_UUID,
-                block.to_json().encode('utf-8')
-            )
-        except Exception as e:
-            print(f"Error sending block to client: {e}")
-
-    def stop(self):
-        """Stop the BLE node"""
-        self.running = False
-        if self.loop and self.thread:
-            asyncio.run_coroutine_threadsafe(self._stop_server(), self.loop)
-            self.loop.call_soon_threadsafe(self.loop.stop)
-            self.thread.join(timeout=2)
-
-    async def _stop_server(self):
-        """Stop the BLE server"""
-        # Disconnect all clients
-        for address, client in self.connected_devices.items():
-            try:
-                await client.disconnect()
-            except:
-                pass
-        self.connected_devices.clear()
-
-
 class OnboardingScreen(Screen):
     def __init__(self, **kwargs):
         super(OnboardingScreen, self).__init__(**kwargs)
@@ -947,6 +593,7 @@ class MainScreen(Screen):
         super(MainScreen, self).__init__(**kwargs)
         self.name = 'main'
         self.node = kwargs.get('node')
+        self.pending_sends = {}  # SendHandle: chat row key
 
         # Main layout
         self.main_layout = BoxLayout(orientation='vertical')
@@ -993,11 +640,10 @@ class MainScreen(Screen):
         self.chats_tab_content = BoxLayout(orientation='vertical')
 
         # Chat display
-        self.chat_scroll = ScrollView(size_hint=(1, 0.6), effect_cls=ScrollEffect)
-        self.chat_layout = BoxLayout(orientation='vertical', size_hint_y=None, padding=[dp(10), dp(5)])
-        self.chat_layout.bind(minimum_height=self.chat_layout.setter('height'))
-        self.chat_scroll.add_widget(self.chat_layout)
-        self.chats_tab_content.add_widget(self.chat_scroll)
+        self.chat_view = ChatHistory(self.node, device_type=self.get_device_type(), size_hint=(1, 0.6),
+                                     effect_cls=ScrollEffect)
+        self.chats_tab_content.add_widget(self.chat_view)
+        self.chat_view.load_latest()
 
         # Connected devices section
         self.devices_section = BoxLayout(orientation='vertical', size_hint=(1, 0.15))
@@ -1172,6 +818,20 @@ class MainScreen(Screen):
         encrypt_layout.add_widget(encrypt_switch)
         settings_options.add_widget(encrypt_layout)
 
+        # Discovery duty cycle
+        discovery_layout = BoxLayout(size_hint_y=None, height=dp(40), spacing=dp(10))
+        discovery_label = AnimatedLabel(text="Device Discovery")
+        discovery_spinner = Spinner(
+            text=self.node.scanner.mode,
+            values=list(DeviceScanner.DUTY_CYCLES),
+            size_hint=(None, 1),
+            width=dp(120)
+        )
+        discovery_spinner.bind(text=lambda spinner, mode: self.node.scanner.set_mode(mode))
+        discovery_layout.add_widget(discovery_label)
+        discovery_layout.add_widget(discovery_spinner)
+        settings_options.add_widget(discovery_layout)
+
         # QR Code for pairing
         qr_btn = AnimatedButton(
             text="Show QR Code for Pairing",
@@ -1215,28 +875,47 @@ class MainScreen(Screen):
             expiration_seconds = None
             # In a real app, this would be based on user settings
 
-            self.node.send_message(message, expiration_seconds=expiration_seconds)
+            handle = self.node.send_message_async(message, expiration_seconds=expiration_seconds)
             self.message_input.text = ""
 
-    def update_chat(self, block):
-        # Animate existing messages up
-        for child in self.chat_layout.children:
-            anim = Animation(y=child.y + dp(60), duration=0.3)
-            anim.start(child)
+            # Show a pending row right away; the pipeline reports progress from its own threads
+            row_key = self.chat_view.append(Block(
+                index=0,
+                previous_hash="",
+                timestamp=time.time(),
+                data=message,
+                sender_id=self.node.device_id
+            ), status=handle.state, pending=True)
+            self.pending_sends[handle] = row_key
+            handle.add_state_callback(
+                lambda h: Clock.schedule_once(lambda dt: self.update_send_state(h), 0)
+            )
 
-        # Add new message
-        is_self = block.sender_id == self.node.device_id
-        device_type = self.get_device_type() if not is_self else None
-        bubble = MessageBubble(block, is_self=is_self, device_type=device_type)
-        self.chat_layout.add_widget(bubble)
+    def update_send_state(self, handle):
+        row_key = self.pending_sends.get(handle)
+        if row_key is None:
+            return
+        if handle.state == "broadcast":
+            self.chat_view.update_row(row_key, status="sent", block_hash=handle.block.hash,
+                                      block_index=handle.block.index)
+            del self.pending_sends[handle]
+        elif handle.state in ("failed", "cancelled"):
+            self.chat_view.update_row(row_key, status="failed")
+            del self.pending_sends[handle]
+        else:
+            self.chat_view.update_row(row_key, status=handle.state)
 
-        # Scroll to bottom
-        Clock.schedule_once(lambda dt: self.chat_scroll.scroll_to(bubble), 0.1)
+    def update_chat(self, block):
+        # Our own queued messages already have a pending row
+        for handle in self.pending_sends:
+            if handle.block is block:
+                return
 
-        # Mark as read if it's from someone else
-        if not is_self:
-            block.status = "read"
-            # In a real app, we would send a read receipt
+        # In a real app, we would send a read receipt
+        self.chat_view.append(block)
+
+    def remove_blocks(self, blocks):
+        self.chat_view.remove_hashes({block.hash for block in blocks})
 
     def scan_devices(self, instance):
         if not self.node.loop:
@@ -1254,8 +933,9 @@ class MainScreen(Screen):
 
             for device in devices:
                 device_type = self.infer_device_type(device['name'])
+                signal = f" ({device['rssi']} dBm)" if device['rssi'] is not None else ""
                 btn = AnimatedButton(
-                    text=f"{device['name']}\n{device_type}",
+                    text=f"{device['name']}\n{device_type}{signal}",
                     size_hint_y=None,
                     height=dp(60),
                     halign='left',
@@ -1309,7 +989,7 @@ class MainScreen(Screen):
                     data=f"Connected to {address[:8]}...",
                     sender_id=self.node.device_id
                 ))
-                self.status_label.text = f"Connected ({len(self.node.connected_devices)})"
+                self.update_status_label()
                 # Add to favorites by default
                 self.node.favorites[address] = {
                     "name": f"Device {address[:8]}...",
@@ -1330,8 +1010,12 @@ class MainScreen(Screen):
         Clock.schedule_once(lambda dt: update_ui(), 0)
 
     def update_device_list(self, dt):
-        # Update connected devices display if needed
-        pass
+        # Reads the scanner's cache, so this never waits on the radio
+        self.update_status_label()
+
+    def update_status_label(self):
+        nearby = len(self.node.scanner.devices())
+        self.status_label.text = f"Connected ({len(self.node.connected_devices)}) | {nearby} nearby"
 
     def update_connected_devices(self):
         # Clear the current list
@@ -1352,7 +1036,7 @@ class MainScreen(Screen):
             self.devices_layout.add_widget(device_item)
 
         # Update status
-        self.status_label.text = f"Connected ({len(self.node.connected_devices)})"
+        self.update_status_label()
 
     def toggle_favorite(self, address):
         if address in self.node.favorites:
@@ -1395,14 +1079,34 @@ class MainScreen(Screen):
         ))
 
     def attach_file(self, instance):
-        # Placeholder for file attachment
-        self.update_chat(Block(
-            index=0,
-            previous_hash="",
-            timestamp=time.time(),
-            data="File attachment feature coming soon!",
-            sender_id=self.node.device_id
-        ))
+        content = BoxLayout(orientation='vertical', spacing=dp(10), padding=dp(10))
+        chooser = FileChooserListView(path=os.path.expanduser("~"))
+        content.add_widget(chooser)
+
+        buttons = BoxLayout(size_hint_y=None, height=dp(50), spacing=dp(10))
+        send_btn = AnimatedButton(text="Send")
+        cancel_btn = AnimatedButton(text="Cancel")
+        buttons.add_widget(send_btn)
+        buttons.add_widget(cancel_btn)
+        content.add_widget(buttons)
+
+        popup = Popup(
+            title="Attach File",
+            content=content,
+            size_hint=(0.9, 0.9),
+            title_color=PRIMARY_COLOR
+        )
+
+        def send(btn):
+            if not chooser.selection:
+                return
+            popup.dismiss()
+            # Hashing a large file takes a while; the block shows up once its manifest is mined
+            threading.Thread(target=self.node.send_file, args=(chooser.selection[0],), daemon=True).start()
+
+        send_btn.bind(on_press=send)
+        cancel_btn.bind(on_press=lambda btn: popup.dismiss())
+        popup.open()
 
     def show_qr_code(self, instance):
         # Generate QR code with device ID and public key
@@ -1489,12 +1193,17 @@ class MainScreen(Screen):
 
 class BlockchainChatApp(App):
     def build(self):
+        # Imported here: importing it opens the window, and pool workers re-import this script
+        from kivy.core.window import Window
         Window.clearcolor = BACKGROUND_COLOR
 
         # Create BLE node
         self.node = BLENode()
         self.node.message_callback = self.update_chat
+        self.node.reorg_callback = self.remove_blocks
+        self.node.expired_callback = self.remove_expired
         self.node.device_list_callback = self.update_connected_devices
+        self.node.transfers.progress_callback = self.update_transfer
         self.node.start()
 
         # Initialize favorites and groups
@@ -1515,18 +1224,35 @@ class BlockchainChatApp(App):
         return self.sm
 
     def update_chat(self, block):
-        # Find the main screen and update chat
+        # Find the main screen and update chat; blocks arrive on worker threads
         main_screen = self.sm.get_screen('main')
-        main_screen.update_chat(block)
+        Clock.schedule_once(lambda dt: main_screen.update_chat(block), 0)
 
-    def update_connected_devices(self):
-        # Find the main screen and update connected devices
+    def remove_blocks(self, blocks):
+        # Blocks dropped by a reorg; their replacements arrive through update_chat
+        main_screen = self.sm.get_screen('main')
+        Clock.schedule_once(lambda dt: main_screen.remove_blocks(blocks), 0)
+
+    def remove_expired(self, block_hashes):
+        # Disappearing messages purged by the node's expiry scheduler
+        main_screen = self.sm.get_screen('main')
+        Clock.schedule_once(lambda dt: main_screen.chat_view.remove_hashes(block_hashes), 0)
+
+    def update_transfer(self, file_id, done, total, path):
+        # Chunks arrive on the inbound thread
+        main_screen = self.sm.get_screen('main')
+        Clock.schedule_once(lambda dt: main_screen.chat_view.update_file(file_id, done, total, path), 0)
+
+    def update_connected_devices(self, address=None, state=None):
+        # Link events arrive on the BLE thread; refresh the list on the main thread
         main_screen = self.sm.get_screen('main')
-        main_screen.update_connected_devices()
+        Clock.schedule_once(lambda dt: main_screen.update_connected_devices(), 0)
 
     def on_stop(self):
         self.node.stop()
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--benchmark':
+        sys.exit(benchmark_main(sys.argv[2:]))
     BlockchainChatApp().run()
\ No newline at end of file
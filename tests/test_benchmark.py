@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+import chat_core
+from chat_core import benchmark_main, compare_benchmarks
+
+
+def timing(p50_us: float) -> dict:
+    return {"ops_per_second": 1e6 / p50_us, "p50_us": p50_us, "p90_us": p50_us * 1.5, "p99_us": p50_us * 2}
+
+
+@pytest.fixture
+def results(monkeypatch):
+    """The results the next benchmark run reports, instead of timing the real suite"""
+    current = {"block.calculate_hash": timing(10.0), "wire_codecs": {"binary_bytes": 100, "json_bytes": 250}}
+    monkeypatch.setattr(chat_core, "run_benchmarks", lambda quick=False: current)
+    return current
+
+
+def test_saved_run_is_a_baseline(results, tmp_path, capsys):
+    baseline = tmp_path / "baseline.json"
+    assert benchmark_main(["--quick", "--save", str(baseline)]) == 0
+    assert json.loads(baseline.read_text()) == results
+    assert benchmark_main(["--baseline", str(baseline)]) == 0
+    assert "REGRESSION" not in capsys.readouterr().out
+
+
+def test_regression_past_the_threshold_fails(results, tmp_path, capsys):
+    baseline = tmp_path / "baseline.json"
+    baseline.write_text(json.dumps({"block.calculate_hash": timing(10.0), "wire_codecs": {"binary_bytes": 10}}))
+
+    results["block.calculate_hash"] = timing(11.5)
+    assert benchmark_main(["--baseline", str(baseline)]) == 0
+    assert benchmark_main(["--baseline", str(baseline), "--threshold", "0.1"]) == 1
+    assert "REGRESSION block.calculate_hash: p50 10.0 -> 11.5 us (+15.0%)" in capsys.readouterr().out
+
+    results["block.calculate_hash"] = timing(13.0)
+    assert benchmark_main(["--baseline", str(baseline)]) == 1
+
+
+def test_new_and_unmeasured_benchmarks_are_not_regressions():
+    baseline = {"old": timing(1.0)}
+    results = {"old": timing(1.1), "new": timing(500.0), "wire_codecs": {"binary_bytes": 1}}
+    assert compare_benchmarks(results, baseline) == []
@@ -0,0 +1,52 @@
+import os
+
+from chat_core import BlobStore
+
+
+def write_file(path, size):
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return path
+
+
+def test_blob_refcounts(tmp_path):
+    store = BlobStore(str(tmp_path / "blobs"), grace=0, fsync=False)
+    digest = store.put_file(write_file(str(tmp_path / "photo.png"), 1000))
+    # The same content stored twice is one blob
+    assert store.put_file(str(tmp_path / "photo.png")) == digest
+    assert os.listdir(os.path.join(str(tmp_path / "blobs"), digest[:2])) == [digest]
+
+    store.add_ref(digest, "block-a")
+    store.add_ref(digest, "block-b")
+    store.add_ref(digest, "block-b")
+    assert store.refcount(digest) == 2
+    assert store.release(["block-a"]) == []
+    assert digest not in store.collect_garbage()
+    assert store.has(digest)
+
+    reopened = BlobStore(str(tmp_path / "blobs"), grace=0, fsync=False)
+    assert reopened.refcount(digest) == 1
+    assert reopened.release(["block-b"]) == [digest]
+    assert digest in reopened.collect_garbage()
+    assert not reopened.has(digest)
+
+
+def test_reference_changes_are_logged_and_compacted(tmp_path):
+    directory = str(tmp_path / "blobs")
+    store = BlobStore(directory, fsync=False, compact_after=4)
+    digest = store.put_file(write_file(str(tmp_path / "notes.txt"), 100))
+    store.add_ref(digest, "block-a")
+    store.add_ref(digest, "block-b")
+    store.release(["block-a"])
+    # Changes go to the log; the snapshot is only rewritten once compact_after of them pile up
+    assert not os.path.exists(os.path.join(directory, "refs.json"))
+    with open(os.path.join(directory, "refs.log"), 'a') as f:
+        f.write('["add", "' + digest)  # Cut short by a crash
+
+    reopened = BlobStore(directory, fsync=False, compact_after=4)
+    assert reopened.refcount(digest) == 1
+    assert not os.path.exists(os.path.join(directory, "refs.log"))
+    for holder in ("block-c", "block-d", "block-e", "block-f"):
+        reopened.add_ref(digest, holder)
+    assert not os.path.exists(os.path.join(directory, "refs.log"))
+    assert BlobStore(directory, fsync=False).refcount(digest) == 5
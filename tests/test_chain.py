@@ -0,0 +1,49 @@
+import time
+
+from chat_core import Block, Blockchain
+
+
+def mined_chain(length: int = 5, difficulty: int = 1) -> Blockchain:
+    blockchain = Blockchain()
+    blockchain.difficulty = difficulty
+    for index in range(1, length + 1):
+        block = Block(index, blockchain.get_latest_block().hash, time.time(), f"message {index}")
+        blockchain.add_block(blockchain.proof_of_work(block))
+    return blockchain
+
+
+def test_valid_chain():
+    assert mined_chain().validate_chain(full=True) is None
+
+
+def test_tampered_body_is_rejected():
+    blockchain = mined_chain()
+    blockchain.chain[2].data = "tampered"
+    assert blockchain.validate_chain(full=True) == 2
+    assert not blockchain.is_chain_valid()
+
+
+def test_tampered_body_is_rejected_in_parallel():
+    blockchain = mined_chain(length=8)
+    blockchain.chain[6].data = "tampered"
+    assert blockchain.validate_chain(full=True, workers=2, segment_size=3) == 6
+
+
+def test_block_without_proof_of_work_is_rejected():
+    blockchain = mined_chain(length=3)
+    tip = blockchain.get_latest_block()
+    unmined = Block(tip.index + 1, tip.hash, time.time(), "unmined")
+    while unmined.hash.startswith("0"):
+        unmined.nonce += 1
+        unmined.hash = unmined.calculate_hash()
+    blockchain.chain.append(unmined)
+    assert blockchain.validate_chain(full=True) == 4
+
+
+def test_pruned_block_still_validates():
+    blockchain = Blockchain()
+    blockchain.difficulty = 1
+    block = Block(1, blockchain.get_latest_block().hash, time.time(), "gone soon", expiration_time=time.time() - 1)
+    blockchain.add_block(blockchain.proof_of_work(block))
+    blockchain.chain[1].prune_payload()
+    assert blockchain.validate_chain(full=True) is None
@@ -0,0 +1,66 @@
+import os
+import time
+
+from chat_core import Block, Blockchain, ChainStore, ExpiryScheduler
+
+
+def store_chain(path, count: int, expiring_every: int = 3):
+    blockchain = Blockchain(store=ChainStore(str(path), fsync=False))
+    blockchain.difficulty = 0
+    now = time.time()
+    for index in range(1, count + 1):
+        expiration_time = now + 60 if index % expiring_every == 0 else None
+        blockchain.add_block(Block(index, blockchain.get_latest_block().hash, now, f"message {index}",
+                                   expiration_time=expiration_time))
+    return blockchain
+
+
+def test_reopened_store_reads_only_the_tip(tmp_path):
+    store_chain(tmp_path, 20).chain.close()
+    store = ChainStore(str(tmp_path), fsync=False)
+    try:
+        assert len(store) == 21
+        assert store[-1].data == "message 20"
+        assert store[5].data == "message 5"
+    finally:
+        store.close()
+
+
+def test_expiry_index_survives_restart(tmp_path):
+    store_chain(tmp_path, 10).chain.close()
+    store = ChainStore(str(tmp_path), fsync=False)
+    reads = []
+    read = store._read
+    store._read = lambda height: reads.append(height) or read(height)
+    blockchain = Blockchain(store=store)
+    scheduler = ExpiryScheduler(blockchain)
+    scheduler._running = True
+    reads.clear()
+    scheduler._scan()
+    assert sorted(height for _, _, height in scheduler._heap) == [3, 6, 9]
+    assert reads == []  # Startup doesn't decode the chain
+    store.close()
+
+
+def test_expiry_index_follows_prune_and_truncate(tmp_path):
+    blockchain = store_chain(tmp_path, 10)
+    tip = blockchain.get_latest_block()
+    blockchain.add_block(Block(11, tip.hash, time.time(), "gone", expiration_time=time.time() - 1))
+    store = blockchain.chain
+    assert blockchain.prune_expired({11: store[11].hash}) == [store[11].hash]
+    assert sorted(height for _, _, height in store.expiring()) == [3, 6, 9]
+    blockchain.truncate(7)
+    assert sorted(height for _, _, height in store.expiring()) == [3, 6]
+    store.close()
+    reopened = ChainStore(str(tmp_path), fsync=False)
+    assert sorted(height for _, _, height in reopened.expiring()) == [3, 6]
+    reopened.close()
+
+
+def test_expiry_index_is_built_for_older_stores(tmp_path):
+    store_chain(tmp_path, 10).chain.close()
+    os.remove(os.path.join(str(tmp_path), "expiry.idx"))
+    store = ChainStore(str(tmp_path), fsync=False)
+    assert sorted(height for _, _, height in store.expiring()) == [3, 6, 9]
+    store.close()
+    assert os.path.exists(os.path.join(str(tmp_path), "expiry.idx"))
@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+import pytest
+
+from chat_core import BLENode, LoopbackMesh, LoopbackTransport, MeshSimulation
+
+
+def status(height, tip_hash):
+    return {"type": "sync_status", "height": height, "hash": tip_hash}
+
+
+def test_unanswered_request_is_asked_of_another_peer():
+    node = BLENode(transport=LoopbackTransport(LoopbackMesh(), "node"), persist=False)
+    sent = []
+    node.send_control = lambda address, message: sent.append((address, message["type"]))
+    node.peer_links = {"a": None, "b": None}
+    sync = node.chain_sync
+    sync.handle("b", status(0, node.blockchain.get_latest_block().hash))
+    sync.handle("a", status(5, "f" * 64))
+    assert sent == [("a", "get_headers")]
+
+    # b turns out to be ahead too, e.g. from a relayed block
+    sync.peers["b"].height = 5
+    sent.clear()
+    sync.expire_requests(time.time() + sync.request_timeout / 2)
+    assert sent == []
+    sync.expire_requests(time.time() + sync.request_timeout + 1)
+    assert sent == [("b", "get_headers")]
+    assert not sync.peers["a"].waiting
+    assert sync.timeout_count == 1
+
+
+def test_late_joiner_fetches_headers_then_bodies():
+    mesh = LoopbackMesh()
+    alice, bob = (BLENode(transport=LoopbackTransport(mesh, name), persist=False) for name in ("alice", "bob"))
+    alice.blockchain.difficulty = bob.blockchain.difficulty = 1
+    for index in range(20):
+        alice.send_message(f"message {index}")
+    # Small windows so the catch-up takes several header and body rounds
+    bob.chain_sync.headers_per_request, bob.chain_sync.batch_size = 8, 4
+    requests = []
+    send_control = bob.send_control
+    bob.send_control = lambda address, message: (requests.append(message["type"]), send_control(address, message))
+    alice.start()
+    bob.start()
+    try:
+        deadline = time.monotonic() + 10
+        while alice.loop is None or bob.loop is None:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        mesh.link("alice", "bob")
+        asyncio.run_coroutine_threadsafe(bob.connect_to_device("alice"), bob.loop).result(10)
+        while bob.blockchain.get_latest_block().hash != alice.blockchain.get_latest_block().hash:
+            assert time.monotonic() < deadline, "bob never caught up"
+            time.sleep(0.05)
+    finally:
+        alice.stop()
+        bob.stop()
+    assert [bob.blockchain.chain[height].data for height in range(1, 21)] == [f"message {i}" for i in range(20)]
+    assert requests.count("get_headers") >= 3
+    assert requests.count("get_blocks") >= 5
+    assert requests.index("get_headers") < requests.index("get_blocks")
+
+
+@pytest.mark.parametrize("seed", [1, 2])
+def test_lossy_grid_converges(seed):
+    simulation = MeshSimulation(size=9, topology="grid", latency=0.005, jitter=0.003, loss=0.01, seed=seed)
+    simulation.start()
+    try:
+        report = simulation.run(messages=5, timeout=30)
+    finally:
+        simulation.stop()
+    assert report["frames_dropped"] > 0
+    assert report["delivery_ratio"] == 1.0
+    assert report["convergence_seconds"] is not None
@@ -0,0 +1,35 @@
+import json
+import time
+
+import pytest
+
+from chat_core import Block, CryptoManager
+
+
+def sample_block() -> Block:
+    block = Block(7, "ab" * 32, time.time(), "héllo ✓ " * 20, nonce=12345, sender_id="alice", recipient_id="bob",
+                  message_type="file", file_data="manifest1:{}", file_name="notes.txt",
+                  encryption_key="aead1:0011223344556677:x25519:AAAA", expiration_time=time.time() + 60)
+    block.signature = CryptoManager().sign_data(block.payload_hash)
+    block.hash = block.calculate_hash()
+    return block
+
+
+def test_binary_round_trip():
+    block = sample_block()
+    decoded = Block.from_bytes(block.to_bytes())
+    assert json.loads(decoded.to_json()) == json.loads(block.to_json())
+    assert decoded.hash == decoded.calculate_hash()
+
+
+def test_json_round_trip():
+    block = sample_block()
+    decoded = Block.from_json(block.to_json())
+    assert json.loads(decoded.to_json()) == json.loads(block.to_json())
+
+
+def test_binary_codec_rejects_truncated_blocks():
+    data = sample_block().to_bytes()
+    for cut in (1, len(data) // 2, len(data) - 1):
+        with pytest.raises(ValueError):
+            Block.from_bytes(data[:cut])
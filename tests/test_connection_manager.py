@@ -0,0 +1,100 @@
+import asyncio
+
+import chat_core
+from chat_core import ConnectionManager
+
+
+class FakeNode:
+    """Just the BLENode surface the ConnectionManager drives; open_link results are scripted"""
+
+    def __init__(self, results=()):
+        self.connections = None
+        self.connected_devices = {}
+        self.favorites = {}
+        self.running = True
+        self.results = list(results)
+        self.events = []
+
+    async def _open_link(self, address, disconnected_callback=None):
+        connected = self.results.pop(0) if self.results else True
+        if connected:
+            self.connected_devices[address] = object()
+        return connected
+
+    async def _drop_peer(self, address):
+        if self.connected_devices.pop(address, None) is not None:
+            self.connections.on_dropped(address)
+
+    def _emit_link_event(self, address, state):
+        self.events.append((address, state))
+
+
+def manager_for(node, **kwargs) -> ConnectionManager:
+    node.connections = ConnectionManager(node, **kwargs)
+    return node.connections
+
+
+async def settle(manager, address, state, timeout=5.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while manager.peers[address].state != state:
+        assert loop.time() < deadline, f"{address} never reached {state}"
+        await asyncio.sleep(0.005)
+
+
+def test_failed_connects_back_off_exponentially(monkeypatch):
+    waits = []
+    monkeypatch.setattr(chat_core.random, "uniform", lambda low, high: waits.append(high) or high)
+    node = FakeNode(results=[False, False, False, False])
+    manager = manager_for(node, backoff_base=0.02, backoff_max=0.08)
+
+    async def run():
+        assert not await manager.connect("peer")
+        await settle(manager, "peer", "connected")
+    asyncio.run(run())
+
+    # Half of each delay is jitter; the cap holds once reached
+    assert waits == [0.01, 0.02, 0.04, 0.04]
+    assert manager.peers["peer"].attempts == 0
+    states = [state for _, state in node.events]
+    assert states == ["connecting", "backoff"] * 4 + ["connecting", "connected"]
+
+
+def test_drops_reconnect_but_explicit_disconnects_do_not():
+    node = FakeNode()
+    manager = manager_for(node, backoff_base=0.01)
+
+    async def run():
+        assert await manager.connect("peer")
+        await node._drop_peer("peer")
+        assert manager.peers["peer"].state == "backoff"
+        await settle(manager, "peer", "connected")
+        await manager.disconnect("peer")
+        await asyncio.sleep(0.05)
+    asyncio.run(run())
+
+    assert "peer" not in node.connected_devices
+    assert manager.peers["peer"].state == "disconnected"
+
+
+def test_full_manager_evicts_the_idlest_non_favourite():
+    node = FakeNode()
+    node.favorites = {"fav": {"is_favorite": True}}
+    manager = manager_for(node, max_connections=2)
+
+    async def run():
+        assert await manager.connect("fav")
+        assert await manager.connect("idle")
+        manager.peers["fav"].last_activity = manager.peers["idle"].last_activity = 0
+        assert await manager.connect("busy")
+        assert set(node.connected_devices) == {"fav", "busy"}
+        assert manager.peers["idle"].state == "evicted"
+        assert not manager.peers["idle"].wanted
+
+        # With only favourites left to close there's no room
+        node.favorites["busy"] = {"is_favorite": True}
+        assert not await manager.connect("late")
+        assert manager.peers["late"].state == "failed"
+    asyncio.run(run())
+
+    assert set(node.connected_devices) == {"fav", "busy"}
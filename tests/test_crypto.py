@@ -0,0 +1,89 @@
+import pytest
+
+from chat_core import CryptoManager
+
+
+def introduce(manager: CryptoManager, contact_id: str, contact: CryptoManager):
+    fast = contact.get_fast_public_keys()
+    manager.add_contact(contact_id, contact.get_public_key_pem(), fast["x25519"], fast["ed25519"])
+
+
+def test_contact_keys_are_pinned():
+    alice, bob, mallory = CryptoManager(), CryptoManager(), CryptoManager()
+    introduce(alice, "bob", bob)
+    # Announcing the same keys again is fine
+    introduce(alice, "bob", bob)
+    pinned = alice.get_contact_keys("bob")
+
+    with pytest.raises(ValueError):
+        introduce(alice, "bob", mallory)
+    with pytest.raises(ValueError):
+        alice.add_contact("bob", bob.get_public_key_pem(), bob.get_fast_public_keys()["x25519"],
+                          mallory.get_fast_public_keys()["ed25519"])
+    assert alice.get_contact_keys("bob") == pinned
+
+
+def test_signature_from_pinned_contact():
+    alice, bob = CryptoManager(), CryptoManager()
+    introduce(alice, "bob", bob)
+    signature = bob.sign_data("payload")
+    assert alice.verify_signature("payload", signature, "bob")
+    assert not alice.verify_signature("tampered", signature, "bob")
+    assert bob.verify_own_signature("payload", signature)
+
+
+def test_session_round_trip():
+    alice, bob = CryptoManager(), CryptoManager()
+    introduce(alice, "bob", bob)
+    sealed = [alice.encrypt_message(f"message {index}", "bob") for index in range(8)]
+    # Bob only sees the later messages; each still carries what he needs to read it
+    for index, (encrypted_message, encryption_key) in list(enumerate(sealed))[5:]:
+        assert bob.decrypt_message(encrypted_message, encryption_key, "alice") == f"message {index}"
+
+
+def test_inbound_sessions_survive_a_restart(tmp_path):
+    identity_path, sessions_path = str(tmp_path / "identity.json"), str(tmp_path / "sessions.bin")
+    alice, bob = CryptoManager(), CryptoManager(identity_path=identity_path, sessions_path=sessions_path)
+    introduce(alice, "bob", bob)
+    encrypted_message, encryption_key = alice.encrypt_message("hello", "bob")
+    assert bob.decrypt_message(encrypted_message, encryption_key, "alice") == "hello"
+    key_id = encryption_key.split(':')[1]
+    saved = (tmp_path / "sessions.bin").read_bytes()
+    assert bob.inbound_sessions[("alice", key_id)] not in saved
+    assert key_id.encode() not in saved
+    restarted = CryptoManager(identity_path=identity_path, sessions_path=sessions_path)
+    # Without the announcement only the saved key can decrypt it
+    assert restarted.decrypt_message(encrypted_message, f"aead1:{key_id}", "alice") == "hello"
+    assert list(restarted.inbound_sessions) == [("alice", key_id)]
+
+
+def test_announcement_stops_once_acknowledged():
+    alice, bob = CryptoManager(), CryptoManager()
+    alice.add_contact("bob", bob.get_public_key_pem())  # RSA only: the announcement is a wrapped key
+    first_message, first_key = alice.encrypt_message("first", "bob")
+    key_id = first_key.split(':')[1]
+    assert len(first_key.split(':')) == 3
+
+    alice.acknowledge("bob", "0" * 16)  # Not the current session
+    assert len(alice.encrypt_message("still announced", "bob")[1].split(':')) == 3
+    alice.acknowledge("bob", key_id)
+    later_message, later_key = alice.encrypt_message("later", "bob")
+    assert later_key == f"aead1:{key_id}"
+
+    assert bob.decrypt_message(first_message, first_key, "alice") == "first"
+    assert bob.decrypt_message(later_message, later_key, "alice") == "later"
+
+
+def test_identity_is_generated_once_and_reloaded(tmp_path):
+    identity_path = str(tmp_path / "identity.json")
+    first = CryptoManager(identity_path=identity_path)
+    # Nothing is generated or written until a key is needed
+    assert not (tmp_path / "identity.json").exists()
+    signature = first.sign_data("payload")
+    keys = (first.get_public_key_pem(), first.get_fast_public_keys())
+    assert (tmp_path / "identity.json").stat().st_mode & 0o777 == 0o600
+
+    reloaded = CryptoManager(identity_path=identity_path)
+    assert (reloaded.get_public_key_pem(), reloaded.get_fast_public_keys()) == keys
+    assert reloaded.verify_own_signature("payload", signature)
+    assert CryptoManager().get_fast_public_keys() != keys[1]
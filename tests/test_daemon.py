@@ -0,0 +1,77 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from chat_core import BLENode, LoopbackMesh, LoopbackTransport
+from chat_daemon import NodeDaemon, control
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+@pytest.fixture
+def mesh():
+    return LoopbackMesh(latency=0.002, jitter=0.001)
+
+
+@pytest.fixture
+def daemon(mesh, tmp_path):
+    (tmp_path / "relay").mkdir()
+    daemon = NodeDaemon(str(tmp_path / "relay"), auto_connect=False, transport=LoopbackTransport(mesh, "relay"))
+    thread = threading.Thread(target=asyncio.run, args=(daemon.serve(),), daemon=True)
+    thread.start()
+    wait_for(lambda: daemon.startup_ms is not None)
+    yield daemon
+    if not daemon._stopping.is_set():
+        control({"command": "stop"}, daemon.socket_path)
+    thread.join(10)
+
+
+def test_control_commands(daemon, mesh):
+    status = control({"command": "status"}, daemon.socket_path)
+    assert status["ok"] and status["height"] == 0 and status["peers"] == 0
+
+    sent = control({"command": "send", "text": "hello from the relay"}, daemon.socket_path)
+    assert sent["ok"] and sent["index"] == 1
+    assert control({"command": "status"}, daemon.socket_path)["tip"] == sent["hash"]
+
+    phone = BLENode(transport=LoopbackTransport(mesh, "phone"), persist=False)
+    phone.start()
+    try:
+        wait_for(lambda: phone.loop is not None)
+        mesh.link("relay", "phone")
+        assert control({"command": "connect", "address": "phone"}, daemon.socket_path)["connected"]
+        assert control({"command": "peers"}, daemon.socket_path)["connected"] == ["phone"]
+        wait_for(lambda: phone.blockchain.get_latest_block().hash == sent["hash"])
+
+        phone.send_message("hello relay")
+        # The daemon lists its own blocks too
+        wait_for(lambda: len(control({"command": "messages"}, daemon.socket_path)["messages"]) == 2)
+        messages = control({"command": "messages", "limit": 1}, daemon.socket_path)["messages"]
+        assert [(message["index"], message["data"]) for message in messages] == [(2, "hello relay")]
+
+        assert control({"command": "disconnect", "address": "phone"}, daemon.socket_path)["ok"]
+        wait_for(lambda: control({"command": "status"}, daemon.socket_path)["peers"] == 0)
+    finally:
+        phone.stop()
+
+
+def test_bad_requests_get_error_replies(daemon):
+    assert control({"command": "send"}, daemon.socket_path) == {"ok": False, "error": "send needs text"}
+    assert not control({"command": "reboot"}, daemon.socket_path)["ok"]
+    # A bad request doesn't take the daemon down
+    assert control({"command": "status"}, daemon.socket_path)["ok"]
+
+
+def test_stop_shuts_down_and_removes_the_socket(daemon):
+    assert control({"command": "stop"}, daemon.socket_path) == {"ok": True}
+    wait_for(lambda: not daemon.node.running)
+    wait_for(lambda: not daemon._server.is_serving())
+    wait_for(lambda: not os.path.exists(daemon.socket_path))
@@ -0,0 +1,82 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from chat_core import DeviceScanner, Transport
+
+
+class CountingScanner:
+    def __init__(self, detection_callback):
+        self.detection_callback = detection_callback
+        self.windows = []
+
+    async def start(self):
+        self.windows.append([time.monotonic(), None])
+        self.detection_callback(SimpleNamespace(address="aa", name="BlockChat-1"),
+                                SimpleNamespace(rssi=-50))
+        self.detection_callback(SimpleNamespace(address="bb", name="Headphones"), SimpleNamespace(rssi=-40))
+
+    async def stop(self):
+        self.windows[-1][1] = time.monotonic()
+
+
+class CountingTransport(Transport):
+    def __init__(self):
+        self.scanner = None
+
+    def create_client(self, address, disconnected_callback=None):
+        raise NotImplementedError
+
+    def create_scanner(self, detection_callback):
+        self.scanner = CountingScanner(detection_callback)
+        return self.scanner
+
+
+def test_duty_cycle_alternates_scan_and_pause():
+    transport = CountingTransport()
+    scanner = DeviceScanner("BlockChat", transport=transport)
+    scanner.scan_seconds, scanner.pause_seconds = 0.05, 0.15
+
+    async def run():
+        scanner.start()
+        await asyncio.sleep(0.65)
+        scanner.stop()
+    asyncio.run(run())
+
+    windows = [window for window in transport.scanner.windows if window[1] is not None]
+    assert 2 <= len(windows) <= 4
+    for (_, stopped), (started, _) in zip(windows, windows[1:]):
+        assert started - stopped >= 0.14
+    assert [device["address"] for device in scanner.devices()] == ["aa"]
+
+
+def test_modes_set_the_duty_cycle():
+    scanner = DeviceScanner("BlockChat", transport=CountingTransport(), mode="low_power")
+    assert (scanner.scan_seconds, scanner.pause_seconds) == DeviceScanner.DUTY_CYCLES["low_power"]
+    scanner.set_mode("low_latency")
+    assert scanner.pause_seconds == 0.0
+    with pytest.raises(ValueError):
+        scanner.set_mode("turbo")
+    assert scanner.mode == "low_latency"
+
+
+def test_devices_are_smoothed_ranked_and_aged():
+    scanner = DeviceScanner("BlockChat", transport=CountingTransport(), rssi_alpha=0.5, max_age=10, max_devices=2)
+    changes = []
+    scanner.change_callback = lambda: changes.append(len(scanner.devices()))
+    now = time.time()
+    scanner.observe("far", "BlockChat-far", -70, seen_at=now - 8)
+    scanner.observe("near", "BlockChat-near", -80, seen_at=now - 5)
+    scanner.observe("near", "BlockChat-near", -40, seen_at=now)
+    assert [(device["address"], device["rssi"]) for device in scanner.devices()] == [("near", -60), ("far", -70)]
+    assert changes == [1, 2]  # Repeat sightings aren't changes
+
+    # Beyond max_devices the least recently seen goes first
+    scanner.observe("new", "BlockChat-new", -90, seen_at=now - 1)
+    assert sorted(device["address"] for device in scanner.devices()) == ["near", "new"]
+
+    assert scanner.age(now + 9.5) == 1
+    assert [device["address"] for device in scanner.devices()] == ["near"]
+    assert scanner.age(now + 9.5) == 0
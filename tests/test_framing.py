@@ -0,0 +1,31 @@
+import random
+
+from chat_core import FrameReassembler, fragment_message
+
+
+def test_small_messages_are_not_framed():
+    assert fragment_message(b"{}", 185, 1) == [b"{}"]
+
+
+def test_frames_reassemble_in_any_order_per_peer():
+    first, second = "héllo ✓ ".encode('utf-8') * 40, bytes(range(256)) * 8
+    frames = [("a", frame) for frame in fragment_message(first, 23, 1)]
+    frames += [("b", frame) for frame in fragment_message(second, 40, 1)]
+    assert len(frames) > 20
+    random.Random(4).shuffle(frames)
+
+    reassembler = FrameReassembler()
+    complete = {}
+    for peer, frame in frames:
+        message = reassembler.feed(peer, frame)
+        if message is not None:
+            complete[peer] = message
+    assert complete == {"a": first, "b": second}
+    assert reassembler.dropped_count == 0
+
+
+def test_oversized_messages_are_dropped():
+    reassembler = FrameReassembler(max_message_bytes=1000)
+    frames = fragment_message(b"x" * 5000, 185, 9)
+    assert all(reassembler.feed("a", frame) is None for frame in frames)
+    assert reassembler.dropped_count > 0
@@ -0,0 +1,62 @@
+import threading
+import time
+
+from chat_core import InboundPipeline
+
+
+class RecordingNode:
+    """Decodes by sleeping for the number in the message, then records what it applies"""
+
+    def __init__(self):
+        self.applied = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def _decode_inbound(self, data: bytes) -> tuple:
+        time.sleep(max(0, int(data)) / 100)
+        return ("message", int(data))
+
+    def _apply_inbound(self, address, client, result):
+        self.gate.wait(10)
+        if result[1] < 0:
+            raise ValueError("bad message")
+        self.applied.append((address, result[1]))
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_results_apply_in_arrival_order():
+    node = RecordingNode()
+    pipeline = InboundPipeline(node, workers=4)
+    try:
+        # Later messages decode faster but still apply after earlier ones
+        for delay in (9, 1, 5, 0, 3):
+            assert pipeline.submit("peer", None, str(delay).encode())
+        wait_for(lambda: len(node.applied) == 5)
+        assert [value for _, value in node.applied] == [9, 1, 5, 0, 3]
+        assert pipeline.metrics()["applied"] == 5
+    finally:
+        pipeline.stop()
+
+
+def test_full_pipeline_drops_and_failures_are_counted():
+    node = RecordingNode()
+    node.gate.clear()
+    pipeline = InboundPipeline(node, workers=1, max_pending=2)
+    try:
+        assert pipeline.submit("peer", None, b"0")
+        wait_for(lambda: pipeline.metrics()["queued"] == 0)  # The writer holds it, waiting on the gate
+        assert pipeline.submit("peer", None, b"-1")
+        assert pipeline.submit("peer", None, b"0")
+        assert not pipeline.submit("peer", None, b"0")
+        node.gate.set()
+        wait_for(lambda: pipeline.metrics()["applied"] + pipeline.metrics()["failed"] == 3)
+        metrics = pipeline.metrics()
+        assert (metrics["received"], metrics["dropped"], metrics["applied"], metrics["failed"]) == (4, 1, 2, 1)
+    finally:
+        pipeline.stop()
@@ -0,0 +1,51 @@
+import threading
+import time
+
+import pytest
+
+from chat_core import Block, MiningCancelled, ProofOfWorkMiner
+
+
+def unmined_block() -> Block:
+    return Block(1, "0" * 64, time.time(), "mine me")
+
+
+@pytest.fixture
+def miner():
+    miner = ProofOfWorkMiner(workers=2, batch_size=500, progress_interval=0.05)
+    yield miner
+    miner.shutdown()
+
+
+def test_mines_a_valid_nonce(miner):
+    result = miner.mine(unmined_block(), 2)
+    assert result.found
+    assert result.block.hash.startswith("00")
+    assert result.block.hash == result.block.calculate_hash()
+
+
+def test_cancel_before_mine_is_not_lost(miner):
+    miner.cancel()
+    with pytest.raises(MiningCancelled):
+        miner.mine(unmined_block(), 2)
+    # The cancel is used up; the next job runs normally
+    assert miner.mine(unmined_block(), 1).found
+
+
+def test_cancel_stops_a_running_job(miner):
+    progress = []
+    miner.progress_callback = lambda hashes, rate: progress.append(hashes)
+    threading.Timer(0.3, miner.cancel).start()
+    started = time.monotonic()
+    with pytest.raises(MiningCancelled):
+        miner.mine(unmined_block(), 16)  # Far beyond what the workers could find in the time
+    assert time.monotonic() - started < 10
+    assert progress
+    assert not miner.last_result.found
+
+
+def test_pool_restarts_after_shutdown(miner):
+    assert miner.mine(unmined_block(), 1).found
+    miner.shutdown()
+    assert miner._executor is None
+    assert miner.mine(unmined_block(), 1).found
@@ -0,0 +1,160 @@
+import asyncio
+import os
+import time
+
+from chat_core import Block, BLENode, LoopbackMesh, LoopbackTransport
+
+
+def make_node(tmp_path, name="node"):
+    mesh = LoopbackMesh()
+    node = BLENode(transport=LoopbackTransport(mesh, name), data_dir=str(tmp_path / name))
+    node.blockchain.difficulty = 1
+    return node
+
+
+def test_check_chain_drops_a_corrupt_tail(tmp_path):
+    node = make_node(tmp_path)
+    for index in range(6):
+        node.send_message(f"message {index}")
+    assert node.check_chain()
+    assert node.blockchain.verified_height == 6
+    store = node.blockchain.chain
+    tampered = store[4]
+    tampered.data = tampered.data.replace("message", "massage")
+    store.rewrite({4: tampered})
+    store.close()
+    os.remove(os.path.join(store.path, "verified.json"))  # As after a crash before the watermark was saved
+
+    reopened = make_node(tmp_path)
+    assert not reopened.check_chain()
+    assert len(reopened.blockchain.chain) == 4
+    assert reopened.check_chain()
+    reopened.blockchain.chain.close()
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def start_node(mesh, tmp_path, name):
+    (tmp_path / name).mkdir()
+    node = BLENode(transport=LoopbackTransport(mesh, name), data_dir=str(tmp_path / name), persist=False)
+    node.blockchain.difficulty = 1
+    node.start()
+    return node
+
+
+def introduce(node, contact):
+    fast = contact.crypto_manager.get_fast_public_keys()
+    node.crypto_manager.add_contact(contact.device_id, contact.crypto_manager.get_public_key_pem(),
+                                    fast["x25519"], fast["ed25519"])
+
+
+def connect(mesh, a, b):
+    wait_for(lambda: a.loop is not None and b.loop is not None)
+    mesh.link(a.transport.address, b.transport.address)
+    asyncio.run_coroutine_threadsafe(a.connect_to_device(b.transport.address), a.loop).result(10)
+
+
+def test_direct_messages_wait_for_an_offline_recipient(tmp_path):
+    mesh = LoopbackMesh()
+    alice, bob = start_node(mesh, tmp_path, "alice"), start_node(mesh, tmp_path, "bob")
+    received = []
+    bob.message_callback = received.append
+    try:
+        introduce(alice, bob)
+        block = alice.send_message("are you there?", recipient_id=bob.device_id)
+        assert len(alice.blockchain.pending_blocks) == 1
+
+        connect(mesh, alice, bob)
+        wait_for(lambda: len(alice.blockchain.pending_blocks) == 0)
+        wait_for(lambda: any(shown.hash == block.hash for shown in received))
+        assert [shown.data for shown in received if shown.hash == block.hash] == ["are you there?"]
+    finally:
+        alice.stop()
+        bob.stop()
+
+
+def test_held_mail_is_not_handed_to_a_relay(tmp_path):
+    mesh = LoopbackMesh()
+    alice, bob, carol = (start_node(mesh, tmp_path, name) for name in ("alice", "bob", "carol"))
+    shown = []
+    alice.message_callback = shown.append
+    try:
+        introduce(alice, carol)
+        held = alice.send_message("for carol only", recipient_id=carol.device_id)
+        tip = alice.blockchain.get_latest_block().hash
+        connect(mesh, alice, bob)
+        wait_for(lambda: bob.blockchain.get_latest_block().hash == tip)
+        # Bob only relays it; holding it too would deliver it a second time
+        assert bob.blockchain.get_pending_blocks_for_recipient(carol.device_id) == []
+        connect(mesh, bob, carol)
+        wait_for(lambda: carol.blockchain.get_latest_block().hash == tip)
+
+        # A block from carol reaches alice through bob; the mail stays with alice
+        relayed = carol.send_message("hello mesh")
+        wait_for(lambda: any(block.hash == relayed.hash for block in shown))
+        held_blocks = alice.blockchain.get_pending_blocks_for_recipient(carol.device_id)
+        assert [block.hash for block in held_blocks] == [held.hash]
+
+        connect(mesh, alice, carol)
+        wait_for(lambda: len(alice.blockchain.pending_blocks) == 0)
+    finally:
+        for node in (alice, bob, carol):
+            node.stop()
+
+
+def test_transient_node_saves_nothing(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    node = BLENode(transport=LoopbackTransport(LoopbackMesh(), "node"), persist=False)
+    node.blockchain.difficulty = 1
+    node.send_message("hello")
+    node._save_data()
+    assert os.listdir(tmp_path) == []
+
+
+def test_unknown_senders_are_unauthenticated_unless_signatures_are_required():
+    node = BLENode(transport=LoopbackTransport(LoopbackMesh(), "node"), persist=False)
+    block = Block(1, node.blockchain.get_latest_block().hash, time.time(), "hi", sender_id="stranger")
+    assert node.check_block_signature(block)
+    node.require_signatures = True
+    assert not node.check_block_signature(block)
+    # Our own blocks always need our signature
+    block.sender_id = node.device_id
+    node.require_signatures = False
+    assert not node.check_block_signature(block)
+    block.signature = node.crypto_manager.sign_data(block.payload_hash)
+    assert node.check_block_signature(block)
+
+
+def test_session_is_announced_until_the_recipient_builds_on_it():
+    mesh = LoopbackMesh()
+    alice = BLENode(transport=LoopbackTransport(mesh, "alice"), persist=False)
+    bob = BLENode(transport=LoopbackTransport(mesh, "bob"), persist=False)
+    for node in (alice, bob):
+        node.blockchain.difficulty = 1
+    introduce(alice, bob)
+    announcing = alice.send_message("hi bob", recipient_id=bob.device_id)
+    assert len(alice.send_message("still there?", recipient_id=bob.device_id).encryption_key.split(':', 2)) == 3
+
+    for block in (announcing, alice.blockchain.get_latest_block()):
+        bob._apply_inbound("alice", None, bob._decode_inbound(block.to_bytes()))
+    reply = bob.send_message("hi alice")
+    alice._apply_inbound("bob", None, alice._decode_inbound(reply.to_bytes()))
+
+    quiet = alice.send_message("no key this time", recipient_id=bob.device_id)
+    assert len(quiet.encryption_key.split(':', 2)) == 2
+    assert bob.crypto_manager.decrypt_message(quiet.data, quiet.encryption_key, alice.device_id) == "no key this time"
+
+
+def test_device_id_survives_a_restart(tmp_path):
+    first = make_node(tmp_path)
+    device_id, public_key = first.device_id, first.crypto_manager.get_public_key_pem()
+    first.blockchain.chain.close()
+    restarted = make_node(tmp_path)
+    assert restarted.device_id == device_id
+    assert restarted.crypto_manager.get_public_key_pem() == public_key
+    restarted.blockchain.chain.close()
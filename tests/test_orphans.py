@@ -0,0 +1,22 @@
+from chat_core import BLENode, LoopbackMesh, LoopbackTransport
+
+
+def test_orphans_connect_and_relay_once_their_parent_arrives(tmp_path):
+    mesh = LoopbackMesh()
+    for name in ("sender", "receiver"):
+        (tmp_path / name).mkdir()
+    sender = BLENode(transport=LoopbackTransport(mesh, "sender"), data_dir=str(tmp_path / "sender"), persist=False)
+    receiver = BLENode(transport=LoopbackTransport(mesh, "receiver"), data_dir=str(tmp_path / "receiver"),
+                       persist=False)
+    for node in (sender, receiver):
+        node.blockchain.difficulty = 1
+    parent, child = sender.send_message("first"), sender.send_message("second")
+    forwarded = []
+    receiver.relay.forward = lambda block, ttl, source: forwarded.append((block.data, ttl, source))
+
+    receiver._apply_inbound("near", None, ("block", child, None, 5))
+    assert child.hash in receiver.orphans and len(receiver.blockchain.chain) == 1
+    receiver._apply_inbound("far", None, ("block", parent, None, 3))
+    assert [block.hash for block in receiver.blockchain.chain[1:]] == [parent.hash, child.hash]
+    # The orphan travels on with the hops and source it arrived with
+    assert forwarded == [("first", 3, "far"), ("second", 5, "near")]
@@ -0,0 +1,72 @@
+import asyncio
+import types
+
+from chat_core import PeerLink
+
+
+class SlowNode:
+    """Just enough of a node for a PeerLink: writes wait until the test releases them"""
+
+    def __init__(self):
+        self.written = []
+        self.release = asyncio.Event()
+        self.fail = False
+        self.connections = types.SimpleNamespace(touch=lambda address: None)
+
+    async def _write(self, client, data):
+        await self.release.wait()
+        if self.fail:
+            raise OSError("write failed")
+        self.written.append(data)
+
+    async def _drop_peer(self, address):
+        pass
+
+
+def test_block_policy_waits_for_the_writer():
+    async def scenario():
+        node = SlowNode()
+        link = PeerLink(node, "peer", None, max_queue=1, policy="block", write_timeout=5)
+        link.start()
+        await link.send(b"1")  # Taken by the writer, which stalls on it
+        await asyncio.sleep(0)
+        await link.send(b"2")  # Fills the queue
+        waiting = asyncio.ensure_future(link.send(b"3"))
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        node.release.set()
+        await asyncio.wait_for(waiting, 1)
+        while len(node.written) < 3:
+            await asyncio.sleep(0)
+        link.stop()
+        return node.written, link.dropped_count
+
+    written, dropped = asyncio.run(scenario())
+    assert written == [b"1", b"2", b"3"]
+    assert dropped == 0
+
+
+def test_demoted_peer_recovers_after_a_good_write():
+    async def scenario():
+        node = SlowNode()
+        node.fail = True
+        node.release.set()
+        link = PeerLink(node, "peer", None, demote_after=2, disconnect_after=10)
+        link.start()
+        for data in (b"1", b"2"):
+            await link.send(data)
+            await asyncio.sleep(0)
+        while link.failed_count < 2:
+            await asyncio.sleep(0)
+        demoted = link.demoted
+        node.fail = False
+        await link.send(b"3")
+        while link.sent_count < 1:
+            await asyncio.sleep(0)
+        link.stop()
+        return demoted, link.demoted, link.strikes
+
+    demoted_before, demoted_after, strikes = asyncio.run(scenario())
+    assert demoted_before
+    assert not demoted_after
+    assert strikes == 0
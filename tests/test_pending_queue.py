@@ -0,0 +1,16 @@
+import os
+import time
+
+from chat_core import Block, PendingQueue
+
+
+def test_queue_survives_restart_and_sweeps_torn_writes(tmp_path):
+    queue = PendingQueue(str(tmp_path), fsync=False)
+    block = Block(1, "0" * 64, time.time(), "for bob", recipient_id="bob")
+    queue.add(block)
+    torn = tmp_path / "00000000000000001_deadbeef_.json.tmp"
+    torn.write_text("{")
+
+    reopened = PendingQueue(str(tmp_path), fsync=False)
+    assert [queued.hash for queued in reopened.get("bob")] == [block.hash]
+    assert not os.path.exists(str(torn))
@@ -0,0 +1,62 @@
+import threading
+
+import pytest
+
+from chat_core import BLENode, LoopbackMesh, LoopbackTransport, SendHandle
+
+
+@pytest.fixture
+def node():
+    node = BLENode(transport=LoopbackTransport(LoopbackMesh(), "node"), persist=False)
+    node.blockchain.difficulty = 1
+    yield node
+    node.stop()
+
+
+def track(handle):
+    states = []
+    handle.add_state_callback(lambda h: states.append(h.state))
+    return states
+
+
+def test_handle_goes_through_every_state(node):
+    handle = SendHandle("hello")
+    states = track(handle)
+    node.send_pipeline.submit(handle)
+    block = handle.result(timeout=10)
+    assert states == ["encrypting", "mining", "broadcast"]
+    assert node.blockchain.get_latest_block().hash == block.hash
+    assert not handle.cancel()
+
+
+def test_queued_message_can_be_cancelled(node):
+    release = threading.Event()
+    mine = node._mine_and_append
+    node._mine_and_append = lambda block: release.wait(10) and mine(block)
+
+    first, second = SendHandle("first"), SendHandle("second")
+    node.send_pipeline.submit(first)
+    node.send_pipeline.submit(second)
+    assert second.cancel()
+    release.set()
+    assert first.result(timeout=10).data == "first"
+    assert second.future.cancelled()
+    assert second.state == "cancelled"
+    assert [node.blockchain.chain[height].data for height in range(1, len(node.blockchain.chain))] == ["first"]
+
+
+def test_failed_mining_fails_the_handle(node):
+    def broken(block):
+        raise RuntimeError("miner crashed")
+    node._mine_and_append = broken
+
+    handle = SendHandle("doomed")
+    states = track(handle)
+    node.send_pipeline.submit(handle)
+    with pytest.raises(RuntimeError):
+        handle.result(timeout=10)
+    assert states[-1] == "failed"
+    assert isinstance(handle.error, RuntimeError)
+    # A finished handle keeps its final state
+    handle.set_state("mining")
+    assert handle.state == "failed"